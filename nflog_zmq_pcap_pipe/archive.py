@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'''On-disk pcap archive - directory of size/time-rotated pcap segments,
+	each with a sidecar index of record chunks (time range -> file offset),
+	to pull packets for some time range out of it without scanning everything.
+
+	Index file ("<segment>.idx") has a small header, followed by fixed-size
+		entries - min/max timestamps of records in a chunk of the segment and its
+		start/end offsets, plus (if enabled) a small bloom filter of addresses in that chunk.
+	Records past the last indexed chunk (e.g. in a segment that is being written
+		right now, or was not closed properly) are scanned without any index.'''
+
+import itertools as it, operator as op, functools as ft
+from time import time, gmtime, strftime
+import os, errno, mmap, struct, zlib, logging
+import pcap, flows
+
+log = logging.getLogger('archive')
+
+index_hdr = struct.Struct('<4sBBH') # magic, version, flags, bloom size
+index_entry = struct.Struct('<ddQQ') # ts_min, ts_max, offset, end
+index_entry_v1 = struct.Struct('<ddQ') # ts_min, ts_max, offset
+index_magic, index_version = b'NZPI', 2
+IDX_HOSTS = 0x01
+bloom_size = 32 # bytes, 256 bits, 2 hashes per address
+
+
+_libc = None
+
+def fallocate(fd, size):
+	'''Allocates disk space for the file without changing its size (FALLOC_FL_KEEP_SIZE),
+		to keep segment contiguous on disk. Silently does nothing if not supported.'''
+	global _libc
+	import ctypes
+	if _libc is None:
+		from ctypes.util import find_library
+		_libc = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+		_libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+	if _libc.fallocate(fd, 1, 0, size) < 0: # FALLOC_FL_KEEP_SIZE
+		err = ctypes.get_errno()
+		if err not in (errno.EOPNOTSUPP, errno.ENOSYS):
+			log.warn('fallocate() failed for archive segment: {}'.format(os.strerror(err)))
+
+
+def bloom_bits(addr):
+	h = zlib.crc32(addr) & 0xffffffff
+	return h & 0xff, (h >> 8) & 0xff
+
+def bloom_add(bloom, addr):
+	for bit in bloom_bits(addr): bloom[bit >> 3] |= 1 << (bit & 7)
+
+def bloom_check(bloom, addr):
+	return all(ord(bloom[bit >> 3]) & (1 << (bit & 7)) for bit in bloom_bits(addr))
+
+
+def segment_name(ts):
+	return '{}.{:06d}.pcap'.format(strftime('%Y%m%d-%H%M%S', gmtime(ts)), int(ts % 1 * 1e6))
+
+def segments(path):
+	'Returns sorted (oldest first) list of segment paths in archive directory.'
+	try: names = os.listdir(path)
+	except OSError as err:
+		if err.errno != errno.ENOENT: raise
+		return list()
+	return list(os.path.join(path, name) for name in sorted(names) if name.endswith('.pcap'))
+
+
+class Archive(object):
+	'''Writes batches of pcap records to segments of up to "segment_size" bytes
+			or "segment_time" seconds, preallocated on disk, removing oldest ones
+			when total size of the archive goes over "budget" bytes.
+		Index entry is added for every "index_chunk" bytes of records,
+			with bloom filter of src/dst addresses in these, if "hosts" is set.
+		Data is written via pcap.BatchWriter, in "buffer_size" chunks,
+			flushed by the caller (see delay/flush), with index entries
+			written after corresponding data on flush, including one
+			for the current (possibly smaller) chunk, which is closed there.'''
+
+	def __init__( self, path, segment_size=256 * 2**20, segment_time=3600,
+			budget=None, index_chunk=64 * 2**10, hosts=False, buffer_size=2**20, latency=1.0 ):
+		self.path, self.segment_size, self.segment_time = path, segment_size, segment_time
+		self.budget, self.index_chunk, self.hosts = budget, index_chunk, hosts
+		self.buffer_size, self.latency = buffer_size, latency
+		self.fd = self.dst = self.idx = self.index_ts = None
+
+	def open(self):
+		if not os.path.isdir(self.path): os.makedirs(self.path)
+		ts = time()
+		self.seg_path = os.path.join(self.path, segment_name(ts))
+		self.fd = os.open(self.seg_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+		if self.segment_size: fallocate(self.fd, self.segment_size)
+		self.dst = pcap.BatchWriter(self.fd, self.buffer_size, self.latency)
+		self.idx = open(self.seg_path + '.idx', 'wb')
+		self.idx.write(index_hdr.pack( index_magic,
+			index_version, IDX_HOSTS if self.hosts else 0, bloom_size if self.hosts else 0 ))
+		self.seg_ts, self.offset = ts, 24 # pcap file header
+		self.chunk = None # [offset, ts_min, ts_max, bloom]
+		self.pending = list() # index entries for chunks not yet flushed to disk
+		self.expire()
+
+	def write(self, bodies):
+		'Writes list of record batches, returning number of bytes written.'
+		hdr_size, unpack_hdr, hosts = pcap.rec_hdr.size, pcap.rec_hdr.unpack_from, self.hosts
+		for body in bodies:
+			chunk = self.chunk
+			if chunk is None:
+				chunk = self.chunk = [self.offset, None, None, hosts and bytearray(bloom_size)]
+				if self.index_ts is None: self.index_ts = time()
+			for pos in pcap.index(body):
+				ts_s, ts_us, incl_len, orig_len = unpack_hdr(body, pos)
+				ts = ts_s + ts_us * 1e-6
+				if chunk[1] is None or ts < chunk[1]: chunk[1] = ts
+				if chunk[2] is None or ts > chunk[2]: chunk[2] = ts
+				if hosts:
+					flow = flows.parse(body, pos + hdr_size, pos + hdr_size + incl_len)
+					if flow:
+						bloom_add(chunk[3], flow[1])
+						bloom_add(chunk[3], flow[2])
+			self.offset += len(body)
+			if self.offset - chunk[0] >= self.index_chunk: self._index_add()
+		bs = self.dst.write(bodies)
+		if ( (self.segment_size and self.offset >= self.segment_size)
+				or (self.segment_time and time() - self.seg_ts >= self.segment_time) ):
+			self.close()
+			self.open()
+		return bs
+
+	def _index_add(self):
+		offset, ts_min, ts_max, bloom = self.chunk
+		if ts_min is not None: # not just empty batches
+			self.pending.append( index_entry.pack(ts_min, ts_max, offset, self.offset)
+				+ (bytes(bloom) if bloom else b'') )
+		self.chunk = None
+
+	def delay(self):
+		'Returns seconds until flush() should be called, for either buffered data or index entries.'
+		delay = self.dst.delay()
+		if self.index_ts is not None:
+			index_delay = self.index_ts + self.latency - time()
+			if delay is None or index_delay < delay: delay = index_delay
+		return delay
+
+	def flush(self):
+		self.dst.flush()
+		if self.chunk: self._index_add()
+		if self.pending:
+			self.idx.write(b''.join(self.pending))
+			self.pending = list()
+		self.idx.flush()
+		self.index_ts = None
+
+	def close(self):
+		if self.fd is None: return
+		fd, idx = self.fd, self.idx
+		try:
+			self.flush()
+			os.ftruncate(fd, self.offset) # release preallocated space beyond data
+		finally:
+			self.fd = self.dst = self.idx = None
+			idx.close()
+			os.close(fd)
+
+	def expire(self):
+		'Removes oldest segments (except current one) until archive size is within budget.'
+		if not self.budget: return
+		segs = list()
+		for seg in segments(self.path):
+			size = 0
+			for p in seg, seg + '.idx':
+				try: size += os.stat(p).st_size
+				except OSError: pass
+			if seg == self.seg_path: size += self.segment_size or 0 # preallocated for current one
+			segs.append((seg, size))
+		total = sum(size for seg, size in segs)
+		for seg, size in segs:
+			if total <= self.budget or seg == self.seg_path: break
+			log.debug('Removing archive segment: {}'.format(seg))
+			for p in seg, seg + '.idx':
+				try: os.unlink(p)
+				except OSError as err:
+					if err.errno != errno.ENOENT: raise
+			total -= size
+
+
+def read_index(path):
+	'''Returns list of (ts_min, ts_max, offset, end, bloom) tuples for segment from its index file,
+		with "end" being None for the last chunk in old-format indexes, which don't have it,
+		and "bloom" - None if disabled.'''
+	try: src = open(path + '.idx', 'rb')
+	except IOError as err:
+		if err.errno != errno.ENOENT: raise
+		return list()
+	with src:
+		size = os.fstat(src.fileno()).st_size
+		if size < index_hdr.size: return list()
+		idx = mmap.mmap(src.fileno(), size, access=mmap.ACCESS_READ)
+		try:
+			magic, version, flags, bloom_len = index_hdr.unpack_from(idx, 0)
+			if magic != index_magic or version not in (1, index_version):
+				raise ValueError('Unknown archive index format: {}'.format(path + '.idx'))
+			entry = index_entry if version == index_version else index_entry_v1
+			entry_size = entry.size + bloom_len
+			entries = list()
+			for pos in xrange(index_hdr.size, size - entry_size + 1, entry_size):
+				bloom = idx[pos + entry.size:pos + entry_size] if flags & IDX_HOSTS else None
+				entries.append(entry.unpack_from(idx, pos) + (bloom,))
+		finally: idx.close()
+	if version == index_version: return entries
+	return list( (ts_min, ts_max, offset, end, bloom) for (ts_min, ts_max, offset, bloom), end
+		in it.izip_longest(entries, list(e[2] for e in entries[1:])) )
+
+def read_records(src, offset, end, block=2**20):
+	'''Yields (ts, record) tuples for pcap records in [offset, end) range of the file,
+		reading it in "block"-sized chunks, stopping at partially-written record, if any.'''
+	hdr_size, unpack_hdr = pcap.rec_hdr.size, pcap.rec_hdr.unpack_from
+	while offset < end:
+		src.seek(offset)
+		buff, pos = src.read(min(block, end - offset)), 0
+		while pos + hdr_size <= len(buff):
+			ts_s, ts_us, incl_len, orig_len = unpack_hdr(buff, pos)
+			rec_end = pos + hdr_size + incl_len
+			if rec_end > len(buff): break
+			yield ts_s + ts_us * 1e-6, buffer(buff, pos, rec_end - pos)
+			pos = rec_end
+		if not pos or len(buff) < min(block, end - offset): break # partially-written record
+		offset += pos
+
+def query(path, since=None, until=None, host=None, port=None, proto=None):
+	'''Yields pcap records from archive directory matching all specified
+			filters (same as for ringbuf.IndexedPacketRing.query), oldest segments first.
+		Only chunks with matching time range (and bloom filter of addresses,
+			if index has these) are read, and records in them are checked one by one,
+			same as all records after the last indexed chunk, if there are any.'''
+	hdr_size = pcap.rec_hdr.size
+	for seg in segments(path):
+		try: entries = read_index(seg)
+		except ValueError as err:
+			log.warn('Scanning whole segment {}: {}'.format(seg, err))
+			entries = list()
+		with open(seg, 'rb') as src:
+			seg_size = os.fstat(src.fileno()).st_size # can be written to right now
+			chunks, tail = list(), 24 # pcap file header
+			for ts_min, ts_max, offset, end, bloom in entries:
+				tail = max(tail, end or seg_size)
+				if since is not None and ts_max < since: continue
+				if until is not None and ts_min > until: continue
+				if host is not None and bloom is not None and not bloom_check(bloom, host): continue
+				chunks.append((offset, min(seg_size, end or seg_size)))
+			chunks.append((tail, seg_size)) # not indexed yet
+			for offset, end in chunks:
+				for ts, rec in read_records(src, offset, end):
+					if since is not None and ts < since: continue
+					if until is not None and ts > until: continue
+					if host is not None or port is not None or proto is not None:
+						flow = flows.parse(rec, hdr_size)
+						if not flow: continue
+						if proto is not None and flow[0] != proto: continue
+						if host is not None and host not in flow[1:3]: continue
+						if port is not None and port not in flow[3:5]: continue
+					yield rec
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'Traffic-buffer interface, serving pcap dumps from a separate thread'
+
+import itertools as it, operator as op, functools as ft
+from time import time
+import json, socket, threading, logging
+import pcap, flows
+
+log = logging.getLogger('bif')
+
+
+def parse_query(req):
+	'''Returns dict of filters for IndexedPacketRing.candidates/matches from request.
+		Any non-JSON request means "everything".'''
+	if not req.startswith('{'): return dict()
+	req, query = json.loads(req), dict()
+	for k in 'since', 'until':
+		if req.get(k) is not None: query[k] = float(req[k])
+	if req.get('host'): query['host'] = flows.addr_pack(req['host'])
+	if req.get('port') is not None: query['port'] = int(req['port'])
+	if req.get('proto') is not None: query['proto'] = flows.proto_number(bytes(req['proto']))
+	return query
+
+def pcap_header():
+	chunk = list()
+	next(pcap.writer(chunk.append))
+	return chunk[0]
+
+
+class BufferInterface(threading.Thread):
+	'''Thread serving pcap dumps of IndexedPacketRing contents over ZMQ_ROUTER socket.
+
+		Protocol: client (e.g. ZMQ_REQ socket) sends a query (see parse_query),
+			and gets first chunk of the dump (pcap header + first records) in reply,
+			then keeps sending "n" requests to get subsequent chunks until empty one.
+		Any number of clients can be served at the same time, each one getting
+			next chunk of its dump in turn, with state of ones that didn't ask
+			for the next chunk for longer than "timeout" seconds being discarded.
+
+		Dump snapshot is only the range of record seqs matching time/host filters
+			at the time of request, and records are copied into chunks under a lock
+			shared with the code adding them (main thread), in small batches,
+			so that it is never blocked for long. Records evicted by the time
+			these are copied are skipped, and count of these is logged.'''
+
+	chunk_checks = 10000 # max number of records to check under one lock
+
+	def __init__(self, context, addr, ring, lock, chunk_size=2**20, timeout=10.0):
+		super(BufferInterface, self).__init__(name='bif')
+		self.daemon = True
+		self.context, self.addr, self.ring, self.lock = context, addr, ring, lock
+		self.chunk_size, self.timeout = chunk_size, timeout
+		self.stopping = threading.Event()
+
+	def stop(self):
+		self.stopping.set()
+		self.join()
+
+	def dump(self, query):
+		chunk = list()
+		pcap_chunk = pcap.writer(chunk.append)
+		next(pcap_chunk)
+		ring, lock, chunk_len, skipped = self.ring, self.lock, 0, 0
+
+		with lock: seqs = ring.candidates(query.get('since'), query.get('until'), query.get('host'))
+		seqs, done = iter(seqs), False
+		while not done:
+			checked = 0
+			with lock:
+				for seq in it.islice(seqs, self.chunk_checks):
+					checked += 1
+					if not ring.matches(seq, **query):
+						if seq < ring.seq_tail: skipped += 1
+						continue
+					chunk_len += pcap_chunk.send(ring.get(seq).tobytes())
+					if chunk_len >= self.chunk_size: break
+			done = checked < self.chunk_checks and chunk_len < self.chunk_size
+			if chunk and (done or chunk_len >= self.chunk_size):
+				yield b''.join(chunk)
+				del chunk[:]
+				chunk_len = 0
+		if skipped:
+			log.debug('Records evicted from buffer during dump: {}'.format(skipped))
+
+	def run(self):
+		import zmq
+		sock = self.context.socket(zmq.ROUTER)
+		sock.setsockopt(zmq.LINGER, 0)
+		sock.bind(self.addr)
+		clients = dict() # ident -> [dump generator, last request time]
+		try:
+			while not self.stopping.is_set():
+				if sock.poll(500):
+					msg = sock.recv_multipart()
+					ident, req = msg[0], msg[-1]
+					if req != b'n' or ident not in clients:
+						try: clients[ident] = [self.dump(parse_query(req)), None]
+						except (ValueError, KeyError, TypeError, socket.error) as err:
+							log.warn('Failed to parse buffer-interface request: {}'.format(err))
+							clients[ident] = [iter([pcap_header()]), None]
+					dump = clients[ident]
+					dump[1] = time()
+					try: chunk = next(dump[0])
+					except StopIteration:
+						del clients[ident]
+						chunk = b''
+					sock.send_multipart(msg[:-1] + [chunk])
+
+				ts_min = time() - self.timeout
+				for ident, (dump, ts) in clients.items():
+					if ts < ts_min:
+						log.debug('Discarding unfinished dump for idle client')
+						del clients[ident]
+		finally: sock.close()
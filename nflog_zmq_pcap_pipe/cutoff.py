@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'''Per-flow byte cutoff ("time machine" style) - only first N bytes of each
+	flow direction are captured in full, with the rest of it truncated to
+	protocol headers or dropped, as tails of bulk transfers are rarely useful
+	for inspection, but are usually most of the traffic by volume.'''
+
+import itertools as it, operator as op, functools as ft
+from time import time
+import flows
+
+modes = 'truncate', 'drop'
+
+
+def add_cutoff_optz(parser):
+	parser.add_argument('--cutoff',
+		type=float, metavar='KiB',
+		help='Only capture first specified amount of traffic (packet bytes)'
+				' for each direction of each flow, truncating packets after that'
+				' to IP + TCP/UDP headers (see --cutoff-mode), with original'
+				' packet length preserved in pcap records. Default is to not do that.')
+	parser.add_argument('--cutoff-mode',
+		metavar='name', choices=modes, default='truncate',
+		help='What to do with packets past --cutoff limit of their flow:'
+				' "truncate" - keep only headers, "drop" - discard these'
+				' (except for tcp SYN/FIN/RST packets, which are truncated instead),'
+				' default: %(default)s.')
+	parser.add_argument('--cutoff-flow-table',
+		type=int, metavar='count', default=2**16,
+		help='Max number of flow directions to track for --cutoff,'
+			' with least recently seen ones discarded first (default: %(default)s).')
+	parser.add_argument('--cutoff-idle',
+		type=float, metavar='seconds', default=60.0,
+		help='Forget flows after this much time without any packets,'
+			' i.e. their next packets are captured in full again (default: %(default)s).')
+
+def cutoff_from_optz(optz, stats=None):
+	if not optz.cutoff: return None
+	return FlowCutoff( int(optz.cutoff * 2**10), mode=optz.cutoff_mode,
+		flow_table=optz.cutoff_flow_table, idle=optz.cutoff_idle, stats=stats )
+
+
+class FlowCutoff(object):
+	'''Tracks number of bytes seen for each direction of each flow
+			(protocol, addresses, ports), and truncates (or drops, depending
+			on "mode") packets of flows which are over the "limit" already.
+		Flows idle for longer than "idle" seconds are reset on their next packet,
+			and removed from the table by periodic sweeps, which also evict
+			least recently seen quarter of it when it gets over "flow_table" entries,
+			instead of keeping it ordered on every packet.
+		Truncated packets are cut right after L4 header (tcp header with options,
+			8 bytes of any other protocol, or IP header for non-first fragments).
+		Packets that can't be parsed are passed as-is.
+		Counters in "stats" dict are incremented for truncated/dropped packets.'''
+
+	tcp_prio = flows.tcp_syn | flows.tcp_fin | flows.tcp_rst
+
+	def __init__(self, limit, mode='truncate', flow_table=2**16, idle=60.0, stats=None):
+		if mode not in modes: raise ValueError('Unknown cutoff mode: {}'.format(mode))
+		self.limit, self.mode, self.flow_table, self.idle = limit, mode, flow_table, idle
+		self.flows = dict() # flow key -> [bytes, last_ts]
+		self.ts_sweep = time()
+		self.stats = stats if stats is not None else dict()
+		for k in ( 'truncated_pkt', 'truncated_bytes',
+				'dropped_pkt', 'dropped_bytes', 'flows_evicted', 'flows_expired' ):
+			self.stats.setdefault(k, 0)
+
+	def __len__(self): return len(self.flows)
+
+	def sweep(self, ts):
+		table, stats = self.flows, self.stats
+		for key, (bs, ts_last) in table.items():
+			if ts - ts_last > self.idle:
+				del table[key]
+				stats['flows_expired'] += 1
+		if len(table) >= self.flow_table:
+			n = len(table) // 4 + 1
+			for key, state in sorted(table.iteritems(), key=lambda kv: kv[1][1])[:n]: del table[key]
+			stats['flows_evicted'] += n
+		self.ts_sweep = ts
+
+	def headers_len(self, pkt, proto, l4):
+		'Returns length of IP + L4 headers in the packet.'
+		end = len(pkt)
+		if l4 is None: # non-first fragment
+			ver_ihl = flows.u8.unpack_from(pkt, 0)[0]
+			return min(end, (ver_ihl & 0xf) * 4 if ver_ihl >> 4 == 4 else 40)
+		if proto == 6 and l4 + 13 <= end:
+			return min(end, l4 + (flows.u8.unpack_from(pkt, l4 + 12)[0] >> 4) * 4)
+		return min(end, l4 + 8)
+
+	def filter(self, pkt, pkt_len=None, ts=None):
+		'''Returns (pkt, pkt_len) tuple for captured packet,
+				with pkt possibly truncated and pkt_len being its original length,
+				or None if packet should be dropped.'''
+		if pkt_len is None: pkt_len = len(pkt)
+		flow = flows.parse_l4(pkt)
+		if not flow: return pkt, pkt_len
+		proto, src, dst, sport, dport, l4 = flow
+
+		ts, table, stats = ts or time(), self.flows, self.stats
+		if ts - self.ts_sweep > self.idle / 4.0: self.sweep(ts)
+		key = proto, src, dst, sport, dport
+		state = table.get(key)
+		if state is None:
+			if len(table) >= self.flow_table: self.sweep(ts)
+			state = table[key] = [0, ts]
+		elif ts - state[1] > self.idle: state[0] = 0
+		bs, state[0], state[1] = state[0], state[0] + pkt_len, ts
+		if bs < self.limit: return pkt, pkt_len
+
+		if self.mode == 'drop' and not ( proto == 6
+				and (flows.tcp_flags(pkt, l4, len(pkt)) or 0) & self.tcp_prio ):
+			stats['dropped_pkt'] += 1
+			stats['dropped_bytes'] += len(pkt)
+			return
+		hdr_len = self.headers_len(pkt, proto, l4)
+		if hdr_len < len(pkt):
+			stats['truncated_pkt'] += 1
+			stats['truncated_bytes'] += len(pkt) - hdr_len
+			pkt = pkt[:hdr_len]
+		return pkt, pkt_len
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'''Suppression of duplicate packets, e.g. same traffic captured by several
+	iptables rules (OUTPUT and FORWARD, both ends of a tunnel, etc) or senders,
+	by hash of packet contents that don't change between these hops.'''
+
+import itertools as it, operator as op, functools as ft
+from time import time
+import struct, zlib
+import pcap, wire
+
+u8 = struct.Struct('!B')
+
+
+def add_dedup_optz(parser):
+	parser.add_argument('--dedup-window',
+		type=float, metavar='seconds',
+		help='Drop packets identical to ones received within specified time window'
+				' (e.g. 0.5), except for IPv4 TTL/checksum and IPv6 hop limit,'
+				' i.e. same packets captured at different hops or by multiple senders.'
+			' Packets are remembered for 1-2 windows. Default is to not do that.')
+	parser.add_argument('--dedup-table',
+		type=int, metavar='count', default=2**20,
+		help='Max number of packet hashes to keep for --dedup-window,'
+			' with older ones discarded early if it fills up (default: %(default)s).')
+
+def dedup_from_optz(optz, registry=None):
+	'Returns Dedup instance for options, with its counters and gauges in metrics Registry.'
+	if not optz.dedup_window: return None
+	stats = registry.counters('dedup') if registry else None
+	dedup = Dedup(optz.dedup_window, optz.dedup_table, stats=stats)
+	if registry:
+		registry.gauges['dedup.entries'] = lambda: len(dedup.cur) + len(dedup.prev)
+		registry.gauges['dedup.hit_rate'] = lambda: dedup.hit_rate
+	return dedup
+
+
+def packet_hash(buff, pos, end):
+	'''Returns 64-bit hash of IPv4/IPv6 packet in buff[pos:end] without
+		fields that change between hops (TTL, header checksum, hop limit),
+		or None for anything else.
+		buff can be str or bytearray, but not memoryview (zlib doesn't accept these on python2).'''
+	if end - pos < 20: return
+	ver = u8.unpack_from(buff, pos)[0] >> 4
+	# Checksums are chained over parts of the packet, passed as buffers to avoid copying
+	if ver == 4: # ttl at 8, proto at 9, csum at 10-11
+		head = buffer(buff, pos, 8) + buffer(buff, pos + 9, 1)
+		tail = buffer(buff, pos + 12, end - pos - 12)
+	elif ver == 6: # hop limit at 7
+		head, tail = buffer(buff, pos, 7), buffer(buff, pos + 8, end - pos - 8)
+	else: return
+	crc = zlib.crc32(tail, zlib.crc32(head)) & 0xffffffff
+	return crc << 32 | (zlib.adler32(tail, zlib.adler32(head)) & 0xffffffff)
+
+
+class Dedup(object):
+	'''Filters out records of packets with the same hash (see packet_hash)
+			as ones seen within "window" seconds, tracking these in two
+			generations of hash sets - current and previous one, with current
+			becoming previous after "window" seconds or when it has table_size/2 entries,
+			so that seen hashes are remembered for 1-2 windows in bounded memory.
+		hit_rate attribute is a fraction of duplicates among
+			packets checked during the last complete generation.
+		Counters in "stats" dict are incremented for checked/dropped packets.'''
+
+	def __init__(self, window=0.5, table_size=2**20, stats=None):
+		self.window, self.table_size = window, table_size
+		self.cur, self.prev, self.ts_rotate = set(), set(), time()
+		self.hit_rate, self.gen_pkt, self.gen_dup = None, 0, 0
+		self.stats = stats if stats is not None else dict()
+		for k in 'pkt', 'dup_pkt', 'dup_bytes', 'rotations':
+			self.stats.setdefault(k, 0)
+
+	def rotate(self, ts):
+		self.prev, self.cur, self.ts_rotate = self.cur, set(), ts
+		self.hit_rate = self.gen_dup / float(self.gen_pkt) if self.gen_pkt else None
+		self.gen_pkt = self.gen_dup = 0
+		self.stats['rotations'] += 1
+
+	def filter(self, body, offsets, ts=None):
+		'''Returns (body, offsets) for pcap records in body (with record offsets
+			as returned by pcap.index), with duplicate ones removed, if any.
+			Body of any other type than str (e.g. memoryview of zmq frame
+				or decoded bytearray) is copied to str, as zlib checksums
+				don't accept memoryviews on python2 and str is returned.'''
+		if not isinstance(body, bytes): body = wire.as_bytes(body)
+		ts = ts or time()
+		if ts - self.ts_rotate > self.window: self.rotate(ts)
+		cur, prev, hdr_size = self.cur, self.prev, pcap.rec_hdr.size
+		max_size = self.table_size // 2
+		keep, pos_keep, dup_pkt, dup_bytes = list(), 0, 0, 0
+		for a, b in it.izip(offsets, it.chain(it.islice(offsets, 1, None), [len(body)])):
+			h = packet_hash(body, a + hdr_size, b)
+			if h is None: continue
+			if h in cur or h in prev:
+				if a > pos_keep: keep.append(body[pos_keep:a])
+				pos_keep, dup_pkt, dup_bytes = b, dup_pkt + 1, dup_bytes + b - a
+				continue
+			cur.add(h)
+			if len(cur) >= max_size:
+				self.rotate(ts)
+				cur, prev = self.cur, self.prev
+		self.gen_pkt += len(offsets)
+		self.gen_dup += dup_pkt
+		self.stats['pkt'] += len(offsets)
+		if not dup_pkt: return body, offsets
+		self.stats['dup_pkt'] += dup_pkt
+		self.stats['dup_bytes'] += dup_bytes
+		if pos_keep < len(body): keep.append(body[pos_keep:])
+		body = b''.join(keep)
+		return body, pcap.index(body)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'Minimal IPv4/IPv6 header parser to get flow 5-tuples from raw packets'
+
+import itertools as it, operator as op, functools as ft
+import socket, struct
+
+
+protos = dict(icmp=1, tcp=6, udp=17, dccp=33, ipv6_icmp=58, icmpv6=58, sctp=132, udplite=136)
+protos_with_ports = frozenset([6, 17, 33, 132, 136])
+tcp_fin, tcp_syn, tcp_rst = 0x01, 0x02, 0x04
+ipv6_ext_hdrs = frozenset([0, 43, 60]) # hop-by-hop, routing, destination options
+
+ipv4_hdr = struct.Struct('!BBHHHBBH4s4s') # ver_ihl, tos, len, id, frag, ttl, proto, csum, src, dst
+ipv6_hdr = struct.Struct('!IHBB16s16s') # ver_tc_fl, len, next_hdr, hop_limit, src, dst
+ipv6_ext_hdr = struct.Struct('!BBH') # next_hdr, len, fragment offset (for fragment header)
+ports = struct.Struct('!HH')
+u8 = struct.Struct('!B')
+
+
+def parse(buff, pos=0, end=None):
+	'''Returns (proto, src, dst, sport, dport) tuple for raw
+			IPv4/IPv6 packet in buff[pos:end] or None if it can't be parsed.
+		buff can be str, bytearray or memoryview.
+		src/dst are packed (4 or 16 byte) addresses, ports are 0 if
+			protocol doesn't have these or they're not in the first fragment.'''
+	flow = parse_l4(buff, pos, end)
+	return flow and flow[:5]
+
+def parse_l4(buff, pos=0, end=None):
+	'''Same as parse(), but with offset of L4 header (e.g. tcp/udp) in buff
+			added as the last tuple element, or None for non-first fragments.'''
+	if end is None: end = len(buff)
+	if end - pos < ipv4_hdr.size: return
+	ver = u8.unpack_from(buff, pos)[0] >> 4
+
+	if ver == 4:
+		ver_ihl, tos, ip_len, ip_id, frag, ttl, proto, csum, src, dst = ipv4_hdr.unpack_from(buff, pos)
+		if frag & 0x1fff: return proto, src, dst, 0, 0, None # non-first fragment
+		pos += (ver_ihl & 0xf) * 4
+
+	elif ver == 6:
+		if end - pos < ipv6_hdr.size: return
+		ver_tc_fl, ip_len, proto, hop_limit, src, dst = ipv6_hdr.unpack_from(buff, pos)
+		pos += ipv6_hdr.size
+		while pos + 8 <= end:
+			next_hdr, hdr_len, frag = ipv6_ext_hdr.unpack_from(buff, pos)
+			if proto in ipv6_ext_hdrs: hdr_len = (hdr_len + 1) * 8
+			elif proto == 51: hdr_len = (hdr_len + 2) * 4 # AH
+			elif proto == 44: # fragment
+				if frag & 0xfff8: return next_hdr, src, dst, 0, 0, None
+				hdr_len = 8
+			else: break
+			proto, pos = next_hdr, pos + hdr_len
+
+	else: return
+
+	if proto in protos_with_ports and pos + ports.size <= end:
+		sport, dport = ports.unpack_from(buff, pos)
+	else: sport = dport = 0
+	return proto, src, dst, sport, dport, pos
+
+
+def tcp_flags(buff, pos, end):
+	'Returns flags byte of tcp header at buff[pos:end], or None if it is truncated.'
+	if pos is None or pos + 14 > end: return
+	return u8.unpack_from(buff, pos + 13)[0]
+
+def flow_key(proto, src, dst, sport, dport):
+	'Returns direction-independent key for the flow, same for packets both ways.'
+	a, b = (src, sport), (dst, dport)
+	return (proto, a, b) if a <= b else (proto, b, a)
+
+
+def addr_pack(addr):
+	'Converts IPv4/IPv6 address string to packed form, as returned by parse().'
+	return socket.inet_pton(socket.AF_INET6 if ':' in addr else socket.AF_INET, addr)
+
+def addr_unpack(addr):
+	return socket.inet_ntop(socket.AF_INET6 if len(addr) == 16 else socket.AF_INET, addr)
+
+def proto_number(proto):
+	'Returns IP protocol number for its name or number string.'
+	try: return int(proto)
+	except ValueError: return protos[proto.lower().replace('-', '_')]
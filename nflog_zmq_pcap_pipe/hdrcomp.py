@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'''Flow-aware header compression for uncompressed frames, similar in spirit
+	to Van Jacobson TCP/IP (RFC 1144) and ROHC ones, but lossless for pcap records.
+
+	Both ends keep a table of per-flow contexts (last IP + TCP/UDP header for
+		each flow direction), with sender encoding records as changes from these -
+		deltas of IP id, tcp seq/ack/window/timestamps and record timestamp,
+		raw bytes of checksums/flags, lengths derived from packet length -
+		followed by unchanged packet payload.
+
+	Encoded frame body: stream id - crc32 of sender host name, its pid and
+		random epoch (all u32, unique for each HeaderCompressor instance),
+		frame seq (u32), followed by records, each starting with type byte:
+			T_RAW - pcap record as-is, for packets that can't be compressed.
+			T_FULL - u16 context id + pcap record, which sets that context.
+			T_DELTA - u16 context id, varint length of the rest
+				and compressed record (see HeaderCompressor.encode for details).
+	Contexts are refreshed by T_FULL records every "refresh" packets, to resync
+		after losses that sender can't see, and receiver invalidates all contexts
+		for the stream on any gap in frame seq numbers, dropping T_DELTA records
+		for these until then.
+	Frames of each stream must be decoded in the same order as they were encoded,
+		but frames of different streams (e.g. sender worker processes) can be interleaved.'''
+
+import itertools as it, operator as op, functools as ft
+from collections import OrderedDict
+import os, struct, zlib, logging
+import pcap, flows, wire
+
+log = logging.getLogger('hdrcomp')
+
+T_RAW, T_FULL, T_DELTA = 0, 1, 2
+F_DELTA, F_RAW, F_LEN = 0, 1, 2 # how dynamic header fields are encoded
+
+frame_hdr = struct.Struct('<IIII') # host crc32, pid, epoch, seq
+ctx_id = struct.Struct('<H')
+u8, fields_fmt = struct.Struct('!B'), {2: struct.Struct('!H'), 4: struct.Struct('!I')}
+
+
+def add_hdrcomp_optz(parser):
+	parser.add_argument('--header-compression', action='store_true',
+		help='Compress IP + TCP/UDP headers of packets in uncompressed frames'
+				' (i.e. when --rate-control is not used or traffic rate is below --lwm),'
+				' by encoding changes from previous packet of the same flow.'
+			' Can save a lot of bandwidth on small packets (ACKs, DNS, VoIP),'
+				' where headers are most of the traffic. Receiver must support it.')
+	parser.add_argument('--header-contexts',
+		type=int, metavar='count', default=1024,
+		help='Max number of flow contexts (last headers for each'
+			' flow direction) to keep for --header-compression (default: %(default)s, max: 65536).')
+	parser.add_argument('--header-refresh',
+		type=int, metavar='packets', default=64,
+		help='Send full headers for each flow after this many compressed ones,'
+			' so that receiver can resync after lost frames (default: %(default)s).')
+
+def hdrcomp_from_optz(optz, stats=None):
+	if not optz.header_compression: return None
+	return HeaderCompressor(optz.header_contexts, optz.header_refresh, stats=stats)
+
+
+def stream(body):
+	'Returns stream id tuple from header-compressed frame body, raising WireError if truncated.'
+	try: return frame_hdr.unpack_from(body, 0)[:3]
+	except struct.error as err:
+		raise wire.WireError('Malformed header-compressed frame: {}'.format(err))
+
+
+def varint_pack(n, out):
+	while n > 0x7f:
+		out.append(n & 0x7f | 0x80)
+		n >>= 7
+	out.append(n)
+
+def varint_unpack(buff, pos):
+	n = shift = 0
+	while True:
+		b = ord(buff[pos])
+		pos += 1
+		n |= (b & 0x7f) << shift
+		if b < 0x80: return n, pos
+		shift += 7
+
+def zigzag(n): return n << 1 if n >= 0 else (-n << 1) - 1
+def unzigzag(z): return z >> 1 if not z & 1 else -((z + 1) >> 1)
+
+
+def layout(buff, pos, end):
+	'''Returns (hdr_len, fields) for compressible packet in buff[pos:end] or None.
+		"fields" is a tuple of (offset, size, mode, base) for dynamic header fields,
+			with the rest of the header expected to be same for all packets in a flow.
+		Only non-fragmented IPv4 without options and IPv6 without extension headers,
+			carrying TCP or UDP with full headers captured, are compressible.'''
+	if end - pos < 20: return
+	ver_ihl = u8.unpack_from(buff, pos)[0]
+	if ver_ihl == 0x45:
+		frag, = fields_fmt[2].unpack_from(buff, pos + 6)
+		if frag & 0x3fff: return # fragment
+		proto, l4 = u8.unpack_from(buff, pos + 9)[0], 20
+		fields = [(2, 2, F_LEN, 0), (4, 2, F_DELTA, 0), (10, 2, F_RAW, 0)]
+	elif ver_ihl >> 4 == 6:
+		if end - pos < 40: return
+		proto, l4 = u8.unpack_from(buff, pos + 6)[0], 40
+		fields = [(4, 2, F_LEN, 40)]
+	else: return
+
+	if proto == 6:
+		if end - pos < l4 + 20: return
+		doff = (u8.unpack_from(buff, pos + l4 + 12)[0] >> 4) * 4
+		if doff < 20 or end - pos < l4 + doff: return
+		fields.extend([ (l4 + 4, 4, F_DELTA, 0), (l4 + 8, 4, F_DELTA, 0),
+			(l4 + 12, 2, F_RAW, 0), (l4 + 14, 2, F_DELTA, 0), (l4 + 16, 2, F_RAW, 0) ])
+		o, o_end = l4 + 20, l4 + doff
+		while o < o_end: # only timestamps option is dynamic, any other changes force full header
+			kind = u8.unpack_from(buff, pos + o)[0]
+			if kind == 0: break
+			if kind == 1:
+				o += 1
+				continue
+			if o + 2 > o_end: break
+			o_len = u8.unpack_from(buff, pos + o + 1)[0]
+			if o_len < 2: break
+			if kind == 8 and o_len == 10 and o + 10 <= o_end:
+				fields.extend([(o + 2, 4, F_DELTA, 0), (o + 6, 4, F_DELTA, 0)])
+			o += o_len
+		return l4 + doff, tuple(fields)
+
+	if proto == 17:
+		if end - pos < l4 + 8: return
+		fields.extend([(l4 + 4, 2, F_LEN, l4), (l4 + 6, 2, F_RAW, 0)])
+		return l4 + 8, tuple(fields)
+
+def masked(hdr, fields):
+	'Returns header with all dynamic fields zeroed, to compare static parts.'
+	hdr = bytearray(hdr)
+	for off, size, mode, base in fields: hdr[off:off + size] = b'\0' * size
+	return bytes(hdr)
+
+
+class HeaderCompressor(object):
+	'''Encodes bodies of pcap records into header-compressed frame bodies,
+			keeping up to "contexts" flow contexts in LRU order.
+		reset() should be called when encoded frame was not sent (e.g. dropped
+			due to zmq hwm), so that all flows start from full headers again.
+		Counters in "stats" dict are incremented for each record type and bytes in/out.'''
+
+	def __init__(self, contexts=1024, refresh=64, stats=None):
+		self.contexts, self.refresh = max(1, min(contexts, 2**16)), refresh
+		# Epoch is from os.urandom(), as random module state is same in forked worker processes
+		self.host = zlib.crc32(os.uname()[1]) & 0xffffffff
+		self.pid, self.epoch, self.seq = os.getpid(), struct.unpack('<I', os.urandom(4))[0], 0
+		self.flows, self.next_id = OrderedDict(), 0 # flow key -> [id, masked, fields, hdr, ts, count]
+		self.stats = stats if stats is not None else dict()
+		for k in 'raw_pkt', 'full_pkt', 'delta_pkt', 'bytes_in', 'bytes_out', 'resets':
+			self.stats.setdefault(k, 0)
+
+	def reset(self):
+		self.flows.clear()
+		self.next_id = 0
+		self.stats['resets'] += 1
+
+	def encode(self, body):
+		'''Returns encoded frame body (bytearray) for concatenated pcap records.
+			T_DELTA record is: varint zigzag ts delta (us), varint payload length,
+				varint zigzag (orig_len - incl_len), dynamic fields in header order
+				(varint zigzag delta, raw bytes or varint zigzag difference from value
+				expected from orig_len) and payload bytes after headers.'''
+		if isinstance(body, memoryview): body = body.tobytes()
+		out = bytearray(frame_hdr.pack(self.host, self.pid, self.epoch, self.seq))
+		self.seq = (self.seq + 1) & 0xffffffff
+		table, refresh, stats = self.flows, self.refresh, self.stats
+		hdr_size, unpack_hdr = pcap.rec_hdr.size, pcap.rec_hdr.unpack_from
+		n_raw = n_full = n_delta = 0
+
+		offsets = pcap.index(body)
+		for a, b in it.izip(offsets, it.chain(it.islice(offsets, 1, None), [len(body)])):
+			ts_s, ts_us, incl_len, orig_len = unpack_hdr(body, a)
+			p = a + hdr_size
+			lay = layout(body, p, b)
+			flow = lay and flows.parse(body, p, b)
+			if not flow:
+				out.append(T_RAW)
+				out += body[a:b]
+				n_raw += 1
+				continue
+
+			hdr_len, fields = lay
+			hdr, ts = body[p:p + hdr_len], ts_s * 1000000 + ts_us
+			hdr_static = masked(hdr, fields)
+			ctx = table.pop(flow, None)
+
+			if ctx and ctx[5] < refresh and ctx[2] == fields and ctx[1] == hdr_static:
+				rec, hdr_prev = bytearray(), ctx[3]
+				varint_pack(zigzag(ts - ctx[4]), rec)
+				varint_pack(incl_len - hdr_len, rec)
+				varint_pack(zigzag(orig_len - incl_len), rec)
+				for off, size, mode, base in fields:
+					if mode == F_RAW: rec += hdr[off:off + size]
+					else:
+						fmt = fields_fmt[size]
+						v = fmt.unpack_from(hdr, off)[0]
+						if mode == F_LEN: d = v - (orig_len - base)
+						else:
+							d, bits = v - fmt.unpack_from(hdr_prev, off)[0], size * 8
+							d &= (1 << bits) - 1 # wraparound, as shortest signed delta
+							if d >> (bits - 1): d -= 1 << bits
+						varint_pack(zigzag(d), rec)
+				rec += body[p + hdr_len:b]
+				out.append(T_DELTA)
+				out += ctx_id.pack(ctx[0])
+				varint_pack(len(rec), out)
+				out += rec
+				ctx[3], ctx[4], ctx[5] = hdr, ts, ctx[5] + 1
+				n_delta += 1
+
+			else:
+				if ctx: cid = ctx[0]
+				elif self.next_id < self.contexts:
+					cid, self.next_id = self.next_id, self.next_id + 1
+				else: cid = table.popitem(last=False)[1][0] # reuse id of least recently seen flow
+				ctx = [cid, hdr_static, fields, hdr, ts, 0]
+				out.append(T_FULL)
+				out += ctx_id.pack(cid)
+				out += body[a:b]
+				n_full += 1
+
+			table[flow] = ctx
+
+		stats['raw_pkt'] += n_raw
+		stats['full_pkt'] += n_full
+		stats['delta_pkt'] += n_delta
+		stats['bytes_in'] += len(body)
+		stats['bytes_out'] += len(out)
+		return out
+
+
+class HeaderDecompressor(object):
+	'''Decodes header-compressed frame bodies back to pcap records,
+			keeping separate context tables for up to "senders" streams (see stream()),
+			least recently seen ones discarded first.
+		Counters in "stats" dict are incremented for resyncs (gaps in frame seq numbers,
+			which invalidate all contexts of the sender) and records that could not be
+			decoded due to missing context (until it's refreshed by sender).'''
+
+	def __init__(self, senders=256, stats=None):
+		self.senders, self.states = senders, OrderedDict() # stream -> [next_seq, {id: [hdr, fields, ts]}]
+		self.stats = stats if stats is not None else dict()
+		for k in 'resyncs', 'lost_pkt':
+			self.stats.setdefault(k, 0)
+
+	def decode(self, body):
+		'Returns pcap records (bytearray) for header-compressed body, raising WireError if malformed.'
+		try: return self._decode(body)
+		except (struct.error, IndexError, KeyError) as err:
+			raise wire.WireError('Malformed header-compressed frame: {}'.format(err))
+
+	def _decode(self, body):
+		host, pid, epoch, seq = frame_hdr.unpack_from(body, 0)
+		key = host, pid, epoch
+		state = self.states.pop(key, None)
+		if state is None:
+			state = [seq, dict()]
+			if len(self.states) >= self.senders: self.states.popitem(last=False)
+		elif state[0] != seq:
+			log.debug( 'Frame seq gap for stream {:08x}/{}/{:08x} ({} -> {}),'
+				' dropping all contexts'.format(host, pid, epoch, state[0], seq) )
+			state[1].clear()
+			self.stats['resyncs'] += 1
+		state[0] = (seq + 1) & 0xffffffff
+		self.states[key] = state
+
+		contexts, out, lost = state[1], bytearray(), 0
+		hdr_size, unpack_hdr, pack_hdr = pcap.rec_hdr.size, pcap.rec_hdr.unpack_from, pcap.rec_hdr.pack
+		pos, end = frame_hdr.size, len(body)
+		while pos < end:
+			rtype = ord(body[pos])
+			pos += 1
+
+			if rtype == T_RAW:
+				rec_end = pos + hdr_size + unpack_hdr(body, pos)[2]
+				if rec_end > end: raise wire.WireError('Truncated header-compressed record')
+				out += body[pos:rec_end]
+
+			elif rtype == T_FULL:
+				cid, = ctx_id.unpack_from(body, pos)
+				pos += ctx_id.size
+				ts_s, ts_us, incl_len, orig_len = unpack_hdr(body, pos)
+				p = pos + hdr_size
+				rec_end = p + incl_len
+				if rec_end > end: raise wire.WireError('Truncated header-compressed record')
+				lay = layout(body, p, rec_end)
+				if not lay: raise wire.WireError('Uncompressible packet in full-header record')
+				contexts[cid] = [body[p:p + lay[0]], lay[1], ts_s * 1000000 + ts_us]
+				out += body[pos:rec_end]
+
+			elif rtype == T_DELTA:
+				cid, = ctx_id.unpack_from(body, pos)
+				rec_len, pos = varint_unpack(body, pos + ctx_id.size)
+				rec_end = pos + rec_len
+				if rec_end > end: raise wire.WireError('Truncated header-compressed record')
+				ctx = contexts.get(cid)
+				if not ctx: lost += 1
+				else:
+					hdr_prev, fields, ts = ctx
+					z, pos = varint_unpack(body, pos)
+					ts += unzigzag(z)
+					payload_len, pos = varint_unpack(body, pos)
+					z, pos = varint_unpack(body, pos)
+					incl_len = len(hdr_prev) + payload_len
+					orig_len = incl_len + unzigzag(z)
+					hdr = bytearray(hdr_prev)
+					for off, size, mode, base in fields:
+						if mode == F_RAW:
+							hdr[off:off + size] = body[pos:pos + size]
+							pos += size
+							continue
+						z, pos = varint_unpack(body, pos)
+						fmt = fields_fmt[size]
+						if mode == F_LEN: v = orig_len - base + unzigzag(z)
+						else: v = (fmt.unpack_from(hdr_prev, off)[0] + unzigzag(z)) & ((1 << size * 8) - 1)
+						fmt.pack_into(hdr, off, v)
+					if rec_end - pos != payload_len:
+						raise wire.WireError('Payload length mismatch in header-compressed record')
+					hdr = bytes(hdr)
+					out += pack_hdr(ts // 1000000, ts % 1000000, incl_len, orig_len)
+					out += hdr
+					out += body[pos:rec_end]
+					ctx[0], ctx[2] = hdr, ts
+
+			else: raise wire.WireError('Unknown header-compressed record type: {}'.format(rtype))
+			pos = rec_end
+
+		if lost: self.stats['lost_pkt'] += lost
+		return out
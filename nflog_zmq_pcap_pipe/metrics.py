@@ -1,75 +1,300 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
-'Simple ad-hoc statsd client implementation'
+'''In-process metrics registry, periodically flushed to
+	statsd (many metrics per udp datagram) and/or prometheus text format.'''
 
 import itertools as it, operator as op, functools as ft
+from time import time
+import os, math, socket, threading, logging
 
+log = logging.getLogger('metrics')
 
-def add_statsd_optz(parser):
+
+def add_metrics_optz(parser):
 	parser.add_argument('-m', '--statsd', metavar='host[:port]',
 		help='host or host:port of statsd to send performance metrics to.'
-			'Metrics are sent as increments since the last send.')
+			' Counters are sent as increments since the last flush.')
 	parser.add_argument('-n', '--statsd-metrics-prefix',
 		metavar='prefix', default='{host}.nflog_pipe.',
-		help='Prefix for metric names, passed to statsd (default: %(default)s).')
-	parser.add_argument('-i', '--statsd-sampling',
-		metavar='count[/interval]', default='50/60',
-		help='Statsd sampling rate. Chance the counter is being sent is'
-			' calculated as (samples / count)[ * ((time_last_sent - time) / interval)]'
-			'(default: %(default)s).')
-	parser.add_argument('-t', '--statsd-type', metavar='type', default='d',
-		help='Statsd type suffix to use, as in "send \'some_metric:123|c\'", where \'c\''
-			'  is the type in question (see statsd implementation docs for the'
+		help='Prefix for metric names, passed to statsd (default: %(default)s).'
+			' For multi-process operation, "{worker}" key (id or "supervisor")'
+			' is also available, and "worker_{worker}." is appended if it is not used.')
+	parser.add_argument('-i', '--statsd-sampling', metavar='count[/interval]',
+		help='Obsolete option, ignored. All values are aggregated and flushed'
+			' every --metrics-interval seconds now.')
+	parser.add_argument('-t', '--statsd-type', metavar='type', default='c',
+		help='Statsd type suffix to use for counters, as in "send \'some_metric:123|c\'",'
+			' where \'c\' is the type in question (see statsd implementation docs for the'
 			' list of supported types, default: %(default)s).')
+	parser.add_argument('--metrics-interval',
+		type=float, metavar='seconds', default=10.0,
+		help='Interval between sending/dumping'
+			' all collected metrics (default: %(default)s).')
+	parser.add_argument('--metrics-file', metavar='path',
+		help='File to (atomically) write all metrics to on every flush,'
+				' in prometheus text exposition format (e.g. for node_exporter textfile collector).'
+			' For multi-process operation, "{worker}" key is available in the path,'
+				' and ".worker_{worker}" is appended if it is not used.')
+	parser.add_argument('--metrics-http', metavar='[host:]port',
+		help='Address to serve metrics on via http, in prometheus text format.'
+			' For multi-process operation, worker N uses port + N + 1.')
 
-def statsd_from_optz(optz):
+def registry_from_optz(optz, worker=None, reactor=None):
+	'''Returns Registry with flushing to destinations
+			specified in command-line options started, if any.
+		Flushes are done from a timer, if Reactor is passed, or from a separate thread otherwise.'''
+	registry = Registry(worker=worker)
+	sinks, worker_n = list(), worker if isinstance(worker, int) else None
 	if optz.statsd:
-		import os
-		statsd_obj = optz.statsd.rsplit(':', 1)
-		if len(statsd_obj) > 1: statsd_obj[1] = int(statsd_obj[1])
-		try:
-			sampling = map(float, optz.statsd_sampling.split('/'))
-			try: sampling, interval = sampling
-			except TypeError: interval = None
-		except:
-			parser.error('Invalid value for --statsd-sampling: {}'.format(optz.statsd_sampling))
-		statsd_obj = statsd( *statsd_obj,
-			prefix=optz.statsd_metrics_prefix.format(host=os.uname()[1]),
-			sampling=sampling, interval=interval, mtype=optz.statsd_type )
-		next(statsd_obj)
-		return statsd_obj
-	else: return None
-
-
-def statsd( host, port=8125, prefix=None,
-		sampling=None, interval=None, threshold=None, mtype='m' ):
-	import socket
-	from random import random
-	from time import time
-
-	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-	dst = host, port
-	yield sock.fileno()
-
-	values = dict()
-	while True:
-		name = yield
-		if isinstance(name, bytes): inc = 1
-		else: name, inc = name
-
-		try: ts_send, ts_sampling, ts_chance, val = values[name]
-		except KeyError:
-			ts_send, ts_sampling, ts_chance, val =\
-				time(), 1.0, max(int(sampling / 2), 1), 0
-
-		val += inc
-		if sampling and interval and val % ts_sampling == 0:
-			ts_chance = (time() - ts_send) / interval
-		if not sampling or ts_chance * (val / sampling) > random():
-			if prefix: name = prefix + name
-			sock.sendto('{}:{}|{}'.format(name, val, mtype), dst)
-			val = 0
-			if interval: ts_send = time()
-
-		values[name] = ts_send, ts_sampling, ts_chance, val
+		host, port = (optz.statsd.rsplit(':', 1) + [8125])[:2]
+		prefix = optz.statsd_metrics_prefix
+		if worker is not None and '{worker}' not in prefix: prefix += 'worker_{worker}.'
+		sinks.append(StatsdSink( host, int(port),
+			prefix=prefix.format(host=os.uname()[1], worker=worker), mtype=optz.statsd_type ))
+	if optz.metrics_file:
+		path = optz.metrics_file
+		if worker is not None and '{worker}' not in path: path += '.worker_{worker}'
+		sinks.append(PromFileSink(path.format(worker=worker), worker))
+	if optz.metrics_http:
+		host, port = ([''] + optz.metrics_http.rsplit(':', 1))[-2:]
+		port = int(port) + (worker_n + 1 if worker_n is not None else 0)
+		sinks.append(PromHTTPSink(host, port, worker))
+	registry.sinks = sinks
+	if sinks:
+		flusher = Flusher(registry, sinks, optz.metrics_interval)
+		if reactor: reactor.call_every(optz.metrics_interval, flusher.flush)
+		else: flusher.start()
+	return registry
+
+
+class Histogram(object):
+	'''Histogram with log-linear buckets (8 per power of 2, ~9% error),
+			to get approximate percentiles of values (e.g. latencies) added
+			since the last flush, and exact max, sum and count of these.
+		add() is cheap enough to be called for every value.'''
+
+	sub = 8
+
+	def __init__(self):
+		self.buckets, self.count, self.sum, self.max = dict(), 0, 0, None
+		self.total_count = self.total_sum = 0 # never reset, for prometheus
+
+	def add(self, value):
+		if value > 0:
+			m, e = math.frexp(value)
+			k = e * self.sub + int((m - 0.5) * 2 * self.sub)
+		else: k = None
+		try: self.buckets[k] += 1
+		except KeyError: self.buckets[k] = 1
+		self.count += 1
+		self.sum += value
+		if self.max is None or value > self.max: self.max = value
+
+	def flush(self, quantiles=(0.5, 0.99)):
+		'''Returns (count, sum, max, [value for each quantile])
+			for values added since last flush, resetting these.'''
+		buckets, count, value_sum, value_max = self.buckets, self.count, self.sum, self.max
+		self.buckets, self.count, self.sum, self.max = dict(), 0, 0, None
+		self.total_count += count
+		self.total_sum += value_sum
+		values, n, keys = list(), 0, iter(sorted(buckets.viewitems()))
+		for q in quantiles:
+			while n < q * count:
+				k, v = next(keys)
+				n += v
+			if not count: values.append(None)
+			elif k is None: values.append(0)
+			else: # upper bound of the bucket, but not above max value
+				e, m = divmod(k, self.sub)
+				values.append(min(value_max, math.ldexp(0.5 + (m + 1) / (2.0 * self.sub), e)))
+		return count, value_sum, value_max, values
+
+
+class Registry(object):
+	'''Collection of named metrics of different types:
+			- counters: groups of plain dicts (name prefix -> {name: int}),
+				incremented directly by the code, usually once per batch, not per packet.
+			- gauges: dict of name -> number or callable returning one.
+			- histograms: dict of name -> Histogram, see histogram() method.
+		Flusher thread reads these periodically and sends
+			increments of counters, current gauges and histogram percentiles.
+		"sinks" list is set by registry_from_optz, for close() to release their sockets.'''
+
+	def __init__(self, worker=None):
+		self.worker, self.sinks = worker, list()
+		self.counter_groups, self.gauges, self.histograms = dict(), dict(), dict()
+
+	def close(self):
+		'''Closes sockets of all sinks, e.g. ones inherited by forked process,
+			which does not have Flusher/http threads of the parent running.'''
+		for sink in self.sinks: sink.close()
+		self.sinks = list()
+
+	def counters(self, prefix, keys=(), stats=None):
+		'''Returns (and registers) dict with counters, with all "keys" set to 0.
+			Existing dict (e.g. "stats" one passed to nflog_generator) can be passed.'''
+		if stats is None: stats = self.counter_groups.get(prefix, dict())
+		for k in keys: stats.setdefault(k, 0)
+		self.counter_groups[prefix] = stats
+		return stats
+
+	def histogram(self, name):
+		try: return self.histograms[name]
+		except KeyError: hist = self.histograms[name] = Histogram()
+		return hist
+
+	def latencies(self, host, delays):
+		'Adds (stage, delay) values to "latency.<host>.<stage>" histograms.'
+		host = host.replace('.', '_')
+		for stage, delay in delays: self.histogram('latency.{}.{}'.format(host, stage)).add(delay)
+
+	def collect(self):
+		'''Returns list of (name, type, value) tuples for all metrics,
+			with counter values being totals, and histograms flushed.'''
+		res = list()
+		for prefix, stats in self.counter_groups.items():
+			for k, v in stats.items(): res.append(('{}.{}'.format(prefix, k), 'counter', v))
+		for name, v in self.gauges.items():
+			if callable(v):
+				try: v = v()
+				except Exception as err:
+					log.warn('Failed to get value for gauge {}: {}'.format(name, err))
+					continue
+			if v is not None: res.append((name, 'gauge', v))
+		for name, hist in self.histograms.items():
+			count, value_sum, value_max, (p50, p99) = hist.flush()
+			res.append((name, 'histogram', ( count, value_sum,
+				value_max, p50, p99, hist.total_count, hist.total_sum )))
+		return res
+
+
+class Flusher(threading.Thread):
+	'''Daemon thread, passing metrics from the Registry to sinks every "interval" seconds.
+		flush() can also be called from an event loop timer instead of starting the thread.'''
+
+	def __init__(self, registry, sinks, interval=10.0):
+		super(Flusher, self).__init__(name='metrics')
+		self.daemon = True
+		self.registry, self.sinks, self.interval = registry, sinks, interval
+
+	def run(self):
+		from time import sleep
+		ts = time()
+		while True:
+			ts += self.interval
+			sleep(max(0, ts - time()))
+			self.flush()
+
+	def flush(self):
+		metrics = self.registry.collect()
+		for sink in self.sinks:
+			try: sink.send(metrics)
+			except Exception as err: log.warn('Failed to send metrics ({}): {}'.format(sink, err))
+
+
+class StatsdSink(object):
+	'''Sends counter increments, gauges and histogram
+			count/p50/p99/max as gauges, packed into as few
+			datagrams as possible, not exceeding dgram_max bytes.'''
+
+	dgram_max = 1432 # safe payload size for 1500 mtu
+
+	def __init__(self, host, port=8125, prefix='', mtype='c'):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.dst, self.prefix, self.mtype = (host, port), prefix, mtype
+		self.counters = dict() # last sent counter values
+
+	def __str__(self): return 'statsd {}:{}'.format(*self.dst)
+
+	def close(self): self.sock.close()
+
+	def lines(self, metrics):
+		prefix = self.prefix
+		for name, mtype, v in metrics:
+			if mtype == 'counter':
+				inc, self.counters[name] = v - self.counters.get(name, 0), v
+				if inc: yield '{}{}:{}|{}'.format(prefix, name, inc, self.mtype)
+			elif mtype == 'gauge': yield '{}{}:{}|g'.format(prefix, name, v)
+			else:
+				count, value_sum, value_max, p50, p99 = v[:5]
+				if not count: continue
+				yield '{}{}.count:{}|{}'.format(prefix, name, count, self.mtype)
+				for k, v in ('p50', p50), ('p99', p99), ('max', value_max):
+					yield '{}{}.{}:{:.6g}|g'.format(prefix, name, k, v)
+
+	def send(self, metrics):
+		dgram, dgram_len = list(), 0
+		for line in it.chain(self.lines(metrics), [None]):
+			if dgram and (line is None or dgram_len + len(line) + 1 > self.dgram_max):
+				self.sock.sendto('\n'.join(dgram), self.dst)
+				dgram, dgram_len = list(), 0
+			if line is not None:
+				dgram.append(line)
+				dgram_len += len(line) + 1
+
+
+def prom_text(metrics, worker=None, prefix='nflog_pipe_'):
+	'Returns prometheus text exposition format representation of metrics from Registry.'
+	labels = '{{worker="{}"}}'.format(worker) if worker is not None else ''
+	label_q = lambda q: '{{{}quantile="{}"}}'.format(
+		'worker="{}",'.format(worker) if worker is not None else '', q )
+	lines = list()
+	for name, mtype, v in sorted(metrics):
+		name = prefix + ''.join((c if c.isalnum() else '_') for c in name)
+		if mtype == 'counter':
+			lines.append('# TYPE {}_total counter'.format(name))
+			lines.append('{}_total{} {}'.format(name, labels, v))
+		elif mtype == 'gauge':
+			lines.append('# TYPE {} gauge'.format(name))
+			lines.append('{}{} {}'.format(name, labels, v))
+		else:
+			count, value_sum, value_max, p50, p99, total_count, total_sum = v
+			lines.append('# TYPE {} summary'.format(name))
+			for q, qv in ('0.5', p50), ('0.99', p99), ('1', value_max):
+				lines.append('{}{} {}'.format( name,
+					label_q(q), '{:.6g}'.format(qv) if qv is not None else 'NaN' ))
+			lines.append('{}_sum{} {:.6g}'.format(name, labels, total_sum))
+			lines.append('{}_count{} {}'.format(name, labels, total_count))
+	return '\n'.join(lines) + '\n'
+
+class PromFileSink(object):
+
+	def __init__(self, path, worker=None):
+		self.path, self.worker = path, worker
+
+	def __str__(self): return 'file {}'.format(self.path)
+
+	def close(self): pass
+
+	def send(self, metrics):
+		tmp = '{}.tmp.{}'.format(self.path, os.getpid())
+		with open(tmp, 'wb') as dst: dst.write(prom_text(metrics, self.worker))
+		os.rename(tmp, self.path)
+
+class PromHTTPSink(object):
+	'Serves prometheus text representation of metrics from the last flush via http.'
+
+	def __init__(self, host, port, worker=None):
+		import BaseHTTPServer
+		sink = self
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = sink.text
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+			def log_message(self, fmt, *args): pass
+		self.worker, self.text = worker, ''
+		self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+		thread = threading.Thread(name='metrics_http', target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def __str__(self): return 'http {}:{}'.format(*self.server.server_address)
+
+	def close(self): self.server.socket.close() # no shutdown(), as it'd affect other processes
+
+	def send(self, metrics): self.text = prom_text(metrics, self.worker)
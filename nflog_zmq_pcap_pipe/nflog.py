@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
-'ctypes wrapper for libnetfilter_log'
+'ctypes wrapper for libnetfilter_log and pure-python netlink NFULNL parser'
 
 import itertools as it, operator as op, functools as ft
-import os, errno, ctypes, socket, logging
+import os, errno, ctypes, socket, struct, logging
 
 log = logging.getLogger('nflog')
 
@@ -41,15 +41,125 @@ def libnflog_init():
 		libnflog.recv.errcheck = ft.partial(_chk_int, gt0=True)
 		libnflog.nflog_get_payload.errcheck = _chk_int
 		libnflog.nflog_get_timestamp.errcheck = _chk_int
+
+		libnflog.nflog_get_nfmark.restype = ctypes.c_uint32
+		libnflog.nflog_get_indev.restype = ctypes.c_uint32
+		libnflog.nflog_get_outdev.restype = ctypes.c_uint32
+		libnflog.nflog_get_prefix.restype = ctypes.c_char_p
 	return libnflog
 
 
-_cb_result = None # pity there's no "nonlocal" in py2.X
+class c_iovec(ctypes.Structure):
+	_fields_ = [
+		('iov_base', ctypes.c_void_p),
+		('iov_len', ctypes.c_size_t) ]
 
-def nflog_generator(qids,
-		pf=(socket.AF_INET, socket.AF_INET6),
-		qthresh=None, timeout=None, nlbufsiz=None,
-		recv_buff=None, extra_attrs=None ):
+class c_msghdr(ctypes.Structure):
+	_fields_ = [
+		('msg_name', ctypes.c_void_p),
+		('msg_namelen', ctypes.c_uint32),
+		('msg_iov', ctypes.POINTER(c_iovec)),
+		('msg_iovlen', ctypes.c_size_t),
+		('msg_control', ctypes.c_void_p),
+		('msg_controllen', ctypes.c_size_t),
+		('msg_flags', ctypes.c_int) ]
+
+class c_mmsghdr(ctypes.Structure):
+	_fields_ = [
+		('msg_hdr', c_msghdr),
+		('msg_len', ctypes.c_uint) ]
+
+MSG_DONTWAIT, MSG_TRUNC, MSG_WAITFORONE = 0x40, 0x20, 0x10000
+
+libc = None
+def libc_init():
+	global libc
+	if not libc:
+		from ctypes.util import find_library
+		libc = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+		libc.recv.errcheck = _chk_int
+		try: libc.recvmmsg.errcheck = _chk_int
+		except AttributeError: pass # old libc, drain loop will be used
+	return libc
+
+
+class RecvPool(object):
+	'''Pool of preallocated buffers to read many netlink
+			datagrams into with as few syscalls as possible - one recvmmsg()
+			or, if it's unavailable, blocking recv() and non-blocking ones until EAGAIN.
+		"stats" dict (if passed) gets counters for wakeups (calls that returned data),
+			syscalls, datagrams, bytes and enobufs errors updated on every call.'''
+
+	def __init__(self, fd, count, size, stats=None):
+		self.fd, self.count, self.size, self.stats = fd, count, size, stats
+		self.bufs = list(bytearray(size) for n in xrange(count))
+		self.views = map(memoryview, self.bufs)
+		self.c_bufs = list((ctypes.c_char * size).from_buffer(buf) for buf in self.bufs)
+		self.err, self.libc = None, libc_init()
+		if stats is not None:
+			for k in 'wakeups', 'syscalls', 'datagrams', 'bytes', 'enobufs': stats.setdefault(k, 0)
+		if not hasattr(self.libc, 'recvmmsg'): self.msgs = None
+		else:
+			self.iovs = (c_iovec * count)(*(
+				(ctypes.addressof(buf), size) for buf in self.c_bufs ))
+			self.msgs = (c_mmsghdr * count)()
+			for n in xrange(count):
+				self.msgs[n].msg_hdr.msg_iov = ctypes.pointer(self.iovs[n])
+				self.msgs[n].msg_hdr.msg_iovlen = 1
+
+	def recv(self):
+		'''Blocks until at least one datagram is available,
+				reading as many of them as possible, up to pool size.
+			Returns list of (buff_idx, data_len) tuples,
+				raises NFLogError (OSError) on errors, e.g. EAGAIN on timeout.'''
+		stats = self.stats
+		if self.err: # deferred from non-empty drain loop
+			err, self.err = self.err, None
+			raise err
+		try:
+			if self.msgs is not None:
+				if stats is not None: stats['syscalls'] += 1
+				n = self.libc.recvmmsg(self.fd, self.msgs, self.count, MSG_WAITFORONE, None)
+				res = list((n, self.msgs[n].msg_len) for n in xrange(n))
+				if any(self.msgs[n].msg_hdr.msg_flags & MSG_TRUNC for n in xrange(n)):
+					log.warn('Truncated netlink datagram(s), recv buffer size is too small')
+			else:
+				res, flags = list(), 0
+				while len(res) < self.count:
+					if stats is not None: stats['syscalls'] += 1
+					try:
+						res.append((len(res), self.libc.recv(
+							self.fd, self.c_bufs[len(res)], self.size, flags )))
+					except NFLogError as err:
+						if not res: raise
+						if err.errno != errno.EAGAIN: self.err = err
+						break
+					flags = MSG_DONTWAIT
+		except NFLogError as err:
+			if stats is not None and err.errno == errno.ENOBUFS: stats['enobufs'] += 1
+			raise
+		if stats is not None:
+			stats['wakeups'] += 1
+			stats['datagrams'] += len(res)
+			stats['bytes'] += sum(it.imap(op.itemgetter(1), res))
+		return res
+
+
+def _set_recv_timeout(fd, timeout):
+	# socket options are shared with the original fd, dup is closed right away
+	sock = socket.fromfd(fd, socket.AF_NETLINK, socket.SOCK_RAW)
+	try:
+		sock.setsockopt( socket.SOL_SOCKET, socket.SO_RCVTIMEO,
+			struct.pack('ll', int(timeout), int(timeout % 1 * 1e6)) )
+	finally: sock.close()
+
+def _warn_nobufs():
+	log.warn( 'nlbufsiz seem'
+		' to be insufficient to hold unprocessed packets,'
+		' consider raising it via corresponding function keyword' )
+
+
+def nflog_generator(qids, backend='libnflog', **kws):
 	'''Generator that yields:
 			- on first iteration - netlink fd that can be poll'ed
 				or integrated into some event loop (twisted, gevent, ...).
@@ -57,16 +167,41 @@ def nflog_generator(qids,
 			- on all subsequent iterations it does recv() on that fd,
 				returning either None (if no packet can be assembled yet)
 				or captured packet payload.
+				None is also yielded after all packets from each
+					recv() are processed, so it can be used as a batch boundary.
 		qids: nflog group ids to bind to (nflog_bind_group)
 		Keywords:
+			backend: "libnflog" (ctypes wrapper), "netlink" (pure-python parser)
+				or "synthetic" (generated packets, see synthetic module, for testing)
 			pf: address families to pass to nflog_bind_pf
 			extra_attrs: metadata to extract from captured packets,
-				returned in a list after packet payload, in the same order
+				returned in a list after packet payload, in the same order,
+				supported ones: len, ts, mark, prefix, indev, outdev
 			nlbufsiz (bytes): set size of netlink socket buffer for the created queues
 			qthresh (packets): set the maximum amount of logs in buffer for each group
 			timeout (seconds): set the maximum time to push log buffer for this group
-			recv_buff (bytes): size of the batch to fetch
-				from libnflog to process in python (default: min(nlbufsiz, 1 MiB))'''
+			recv_buff (bytes): size of each buffer to fetch netlink datagrams into
+				for processing in python (default: min(nlbufsiz, 128 KiB) - kernel nflog limit)
+			recv_count (datagrams): max number of netlink datagrams
+				to read per recvmmsg() call (or drain loop), i.e. size of buffer pool
+			recv_timeout (seconds): max time to block in recv() before yielding None,
+				so that caller can do some periodic work (e.g. flush batches) without traffic
+			stats: dict to update counters in, see RecvPool'''
+	if backend == 'libnflog': return libnflog_generator(qids, **kws)
+	elif backend == 'netlink': return netlink_generator(qids, **kws)
+	elif backend == 'synthetic':
+		import synthetic
+		return synthetic.nflog_generator(qids, **kws)
+	else: raise ValueError('Unknown nflog backend: {}'.format(backend))
+
+
+_cb_result = None # pity there's no "nonlocal" in py2.X
+
+def libnflog_generator(qids,
+		pf=(socket.AF_INET, socket.AF_INET6),
+		qthresh=None, timeout=None, nlbufsiz=None, recv_buff=None,
+		recv_count=16, recv_timeout=None, extra_attrs=None, stats=None ):
+	'nflog_generator implementation, using libnetfilter_log via ctypes.'
 	global _cb_result
 
 	libnflog = libnflog_init()
@@ -97,6 +232,10 @@ def nflog_generator(qids,
 							if err.errno not in ts_err_mask: raise
 							result.append(None)
 						else: result.append(ts.contents.tv_sec + ts.contents.tv_usec * 1e-6)
+					elif attr == 'mark': result.append(libnflog.nflog_get_nfmark(nfad))
+					elif attr == 'prefix': result.append(libnflog.nflog_get_prefix(nfad))
+					elif attr == 'indev': result.append(libnflog.nflog_get_indev(nfad) or None)
+					elif attr == 'outdev': result.append(libnflog.nflog_get_outdev(nfad) or None)
 					else: raise NotImplementedError('Unknown nflog attribute: {}'.format(attr))
 			_cb_result.append(result)
 		except:
@@ -116,24 +255,169 @@ def nflog_generator(qids,
 		libnflog.nflog_callback_register(qh, c_cb)
 
 	fd = libnflog.nflog_fd(handle)
-	if not recv_buff: recv_buff = min(nlbufsiz, 1*2**20)
-	buff = ctypes.create_string_buffer(recv_buff)
+	if not recv_buff: recv_buff = min(nlbufsiz or 128*2**10, 128*2**10)
+	pool = RecvPool(fd, recv_count, recv_buff, stats=stats)
+
+	if recv_timeout: _set_recv_timeout(fd, recv_timeout)
 
 	yield fd # yield fd for poll() on first iteration
 	while True:
 		_cb_result = list()
-		try: pkt = libnflog.recv(fd, buff, recv_buff, 0)
+		try: bufs = pool.recv()
 		except OSError as err:
 			if err.errno == errno.ENOBUFS:
-				log.warn( 'nlbufsiz seem'
-					' to be insufficient to hold unprocessed packets,'
-					' consider raising it via corresponding function keyword' )
+				_warn_nobufs()
+				continue
+			elif err.errno in (errno.EAGAIN, errno.EINTR):
+				yield None
 				continue
 			raise
-		libnflog.nflog_handle_packet(handle, buff, pkt)
+		for n, buff_len in bufs:
+			libnflog.nflog_handle_packet(handle, pool.c_bufs[n], buff_len)
 		for result in _cb_result:
 			if result is StopIteration: raise result
 			yield result
+		yield None # batch boundary
+
+
+NETLINK_NETFILTER = 12
+NFNL_SUBSYS_ULOG = 4
+NFULNL_MSG_PACKET, NFULNL_MSG_CONFIG = NFNL_SUBSYS_ULOG << 8, NFNL_SUBSYS_ULOG << 8 | 1
+NLM_F_REQUEST, NLM_F_ACK = 0x1, 0x4
+NLMSG_ERROR, NLMSG_DONE = 0x2, 0x3
+NLA_TYPE_MASK = 0x3fff # w/o NLA_F_NESTED and NLA_F_NET_BYTEORDER
+
+NFULNL_CFG_CMD_BIND, NFULNL_CFG_CMD_PF_BIND, NFULNL_CFG_CMD_PF_UNBIND = 1, 3, 4
+NFULA_CFG_CMD, NFULA_CFG_MODE, NFULA_CFG_NLBUFSIZ,\
+	NFULA_CFG_TIMEOUT, NFULA_CFG_QTHRESH = range(1, 6)
+NFULA_MARK, NFULA_TIMESTAMP, NFULA_IFINDEX_INDEV,\
+	NFULA_IFINDEX_OUTDEV, NFULA_PAYLOAD, NFULA_PREFIX = 2, 3, 4, 5, 9, 10
+
+nlmsg_hdr = struct.Struct('=IHHII') # len, type, flags, seq, pid
+nfgen_hdr = struct.Struct('!BBH') # family, version, res_id
+nla_hdr = struct.Struct('=HH') # len, type
+nla_u32 = struct.Struct('!I')
+nla_ts = struct.Struct('!QQ')
+nlmsg_err = struct.Struct('=i')
+
+def _nl_align(n): return (n + 3) & ~3
+
+def _nl_attr(attr_type, data):
+	attr_len = nla_hdr.size + len(data)
+	return nla_hdr.pack(attr_len, attr_type)\
+		+ data + b'\0' * (_nl_align(attr_len) - attr_len)
+
+def _nl_config(sock, seq, family, res_id, *attrs):
+	'Sends NFULNL_MSG_CONFIG message and waits for kernel ack to it.'
+	msg = nfgen_hdr.pack(family, 0, res_id) + b''.join(it.starmap(_nl_attr, attrs))
+	msg = nlmsg_hdr.pack( nlmsg_hdr.size + len(msg),
+		NFULNL_MSG_CONFIG, NLM_F_REQUEST | NLM_F_ACK, seq, 0 ) + msg
+	sock.send(msg)
+	while True:
+		buff = sock.recv(8192)
+		pos = 0
+		while pos + nlmsg_hdr.size <= len(buff):
+			msg_len, msg_type, msg_flags, msg_seq, msg_pid = nlmsg_hdr.unpack_from(buff, pos)
+			if msg_type == NLMSG_ERROR and msg_seq == seq:
+				err, = nlmsg_err.unpack_from(buff, pos + nlmsg_hdr.size)
+				if err: raise NFLogError(-err, os.strerror(-err))
+				return
+			if msg_len < nlmsg_hdr.size: break
+			pos += _nl_align(msg_len)
+
+def _nl_parse(buff, view, pos, end, extra_attrs, results):
+	'''Appends NFULNL packets from buff[pos:end] to results list.
+		Payloads are memoryview slices of the same buffer, not copies.'''
+	hdr_size = nlmsg_hdr.size + nfgen_hdr.size
+	unpack_msg, unpack_attr = nlmsg_hdr.unpack_from, nla_hdr.unpack_from
+	while pos + nlmsg_hdr.size <= end:
+		msg_len, msg_type, msg_flags, msg_seq, msg_pid = unpack_msg(buff, pos)
+		if msg_len < nlmsg_hdr.size or pos + msg_len > end: break # truncated
+		if msg_type == NFULNL_MSG_PACKET:
+			pkt = ts = mark = prefix = indev = outdev = None
+			attr, attr_end = pos + hdr_size, pos + msg_len
+			while attr + nla_hdr.size <= attr_end:
+				attr_len, attr_type = unpack_attr(buff, attr)
+				if attr_len < nla_hdr.size: break
+				attr_type &= NLA_TYPE_MASK
+				if attr_type == NFULA_PAYLOAD:
+					pkt = view[attr + nla_hdr.size:attr + attr_len]
+				elif attr_type == NFULA_TIMESTAMP:
+					ts = nla_ts.unpack_from(buff, attr + nla_hdr.size)
+					ts = ts[0] + ts[1] * 1e-6
+				elif attr_type == NFULA_MARK:
+					mark, = nla_u32.unpack_from(buff, attr + nla_hdr.size)
+				elif attr_type == NFULA_IFINDEX_INDEV:
+					indev, = nla_u32.unpack_from(buff, attr + nla_hdr.size)
+				elif attr_type == NFULA_IFINDEX_OUTDEV:
+					outdev, = nla_u32.unpack_from(buff, attr + nla_hdr.size)
+				elif attr_type == NFULA_PREFIX:
+					prefix = bytes(buff[attr + nla_hdr.size:attr + attr_len]).rstrip(b'\0')
+				attr += _nl_align(attr_len)
+			if pkt is not None:
+				if extra_attrs:
+					pkt, attrs = [pkt], dict( len=len(pkt), ts=ts,
+						mark=mark or 0, prefix=prefix, indev=indev, outdev=outdev )
+					for k in extra_attrs: pkt.append(attrs[k])
+				results.append(pkt)
+		elif msg_type == NLMSG_ERROR:
+			err, = nlmsg_err.unpack_from(buff, pos + nlmsg_hdr.size)
+			if err: raise NFLogError(-err, os.strerror(-err))
+		pos += _nl_align(msg_len)
+
+def netlink_generator(qids,
+		pf=(socket.AF_INET, socket.AF_INET6),
+		qthresh=None, timeout=None, nlbufsiz=None, recv_buff=None,
+		recv_count=16, recv_timeout=None, extra_attrs=None, stats=None ):
+	'''nflog_generator implementation, talking NFULNL over
+			NETLINK_NETFILTER socket directly, without libnetfilter_log.
+		Yielded payloads are memoryview slices of the receive buffer,
+			which are only valid until next iteration of the generator.'''
+	if isinstance(extra_attrs, bytes): extra_attrs = [extra_attrs]
+	for k in extra_attrs or list():
+		if k not in ['len', 'ts', 'mark', 'prefix', 'indev', 'outdev']:
+			raise NotImplementedError('Unknown nflog attribute: {}'.format(k))
+
+	sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+	sock.bind((0, 0))
+	seq = it.count(1)
+
+	cmd = lambda cmd: (NFULA_CFG_CMD, struct.pack('B', cmd))
+	for pf in (pf if not isinstance(pf, int) else [pf]):
+		_nl_config(sock, next(seq), pf, 0, cmd(NFULNL_CFG_CMD_PF_UNBIND))
+		_nl_config(sock, next(seq), pf, 0, cmd(NFULNL_CFG_CMD_PF_BIND))
+
+	for qid in (qids if not isinstance(qids, int) else [qids]):
+		_nl_config(sock, next(seq), socket.AF_UNSPEC, qid, cmd(NFULNL_CFG_CMD_BIND))
+		attrs = [(NFULA_CFG_MODE, struct.pack('!IBB', 0xffff, 0x2, 0))] # NFULNL_COPY_PACKET
+		if qthresh: attrs.append((NFULA_CFG_QTHRESH, nla_u32.pack(qthresh)))
+		if timeout: attrs.append((NFULA_CFG_TIMEOUT, nla_u32.pack(int(timeout * 100))))
+		if nlbufsiz: attrs.append((NFULA_CFG_NLBUFSIZ, nla_u32.pack(nlbufsiz)))
+		_nl_config(sock, next(seq), socket.AF_UNSPEC, qid, *attrs)
+
+	fd = sock.fileno()
+	if not recv_buff: recv_buff = min(nlbufsiz or 128*2**10, 128*2**10)
+	pool = RecvPool(fd, recv_count, recv_buff, stats=stats)
+
+	if recv_timeout: _set_recv_timeout(fd, recv_timeout)
+
+	yield fd # yield fd for poll() on first iteration
+	results = list()
+	while True:
+		try: bufs = pool.recv()
+		except OSError as err:
+			if err.errno == errno.ENOBUFS:
+				_warn_nobufs()
+				continue
+			elif err.errno in (errno.EAGAIN, errno.EINTR):
+				yield None
+				continue
+			raise
+		for n, buff_len in bufs:
+			_nl_parse(pool.bufs[n], pool.views[n], 0, buff_len, extra_attrs, results)
+		for result in results: yield result
+		del results[:]
+		yield None # batch boundary
 
 
 if __name__ == '__main__':
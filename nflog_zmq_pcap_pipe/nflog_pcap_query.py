@@ -4,12 +4,33 @@ from __future__ import print_function
 
 def main():
 	from contextlib import closing
-	import os, sys, logging
+	from time import time
+	import os, sys, json, logging, reactor
 
 	import argparse
 	parser = argparse.ArgumentParser(
-		description='Query nflog_pcap_recv daemon for buffered packets.')
-	parser.add_argument('bif', help='ZMQ socket address to query.')
+		description='Query nflog_pcap_recv daemon for buffered packets,'
+			' or its on-disk archive, writing pcap dump of these to stdout.')
+	parser.add_argument('bif', nargs='?', help='ZMQ socket address to query.')
+	parser.add_argument('-A', '--archive', metavar='dir',
+		help='Read packets from the archive directory (see "archive" output type'
+			' in nflog-pcap-recv) instead of querying daemon, using index files there.')
+	parser.add_argument('-s', '--since', type=float, metavar='ts',
+		help='Only return packets captured after specified unix timestamp'
+			' or, if value is negative, this many seconds ago (e.g. "-30" - last 30s).')
+	parser.add_argument('-e', '--until', type=float, metavar='ts',
+		help='Only return packets captured before specified'
+			' unix timestamp or, if negative, this many seconds ago.')
+	parser.add_argument('-a', '--host', metavar='address',
+		help='Only return packets with specified IPv4/IPv6 source or destination address.')
+	parser.add_argument('-p', '--port', type=int,
+		help='Only return packets with specified source or destination port.')
+	parser.add_argument('-P', '--proto', metavar='name-or-number',
+		help='Only return packets of specified IP protocol (e.g. tcp, udp, icmp, 132).')
+	parser.add_argument('-t', '--timeout',
+		type=float, metavar='seconds', default=30.0,
+		help='Max time to wait for each chunk of the dump'
+			' before giving up (default: %(default)s, 0 - wait forever).')
 	parser.add_argument('--debug', action='store_true', help='Verbose operation mode.')
 	optz = parser.parse_args()
 
@@ -19,20 +40,58 @@ def main():
 		datefmt='%Y-%m-%d %H:%M:%S' )
 	log = logging.getLogger('pcap_query')
 
+	if not optz.bif and not optz.archive:
+		parser.error('Either zmq socket address or --archive directory must be specified')
+	query = dict( (k, getattr(optz, k))
+		for k in ['since', 'until', 'host', 'port', 'proto']
+		if getattr(optz, k) is not None )
+	for k in 'since', 'until':
+		if query.get(k, 0) < 0: query[k] += time()
+
+	if optz.archive:
+		import archive, pcap, bif
+		query = bif.parse_query(json.dumps(query))
+		sys.stdout.write(pcap.file_header())
+		for rec in archive.query(optz.archive, **query): sys.stdout.write(rec)
+		return 0
+
 	import zmq
 	context = zmq.Context()
 
+	reactor, state = reactor.Reactor(), dict(timer=None, done=False)
+
 	try:
 		with closing(context.socket(zmq.REQ)) as bif:
+			bif.setsockopt(zmq.LINGER, 0)
+
+			def timeout():
+				log.error('Timed out waiting for response from {}'.format(optz.bif))
+				reactor.stop()
+
+			def request(msg):
+				bif.send(msg)
+				if optz.timeout: state['timer'] = reactor.call_later(optz.timeout, timeout)
+
+			def read():
+				# Dump is returned in chunks, until empty one
+				if state['timer']: reactor.cancel(state['timer'])
+				chunk = bif.recv()
+				if not chunk:
+					state['done'] = True
+					return reactor.stop()
+				sys.stdout.write(chunk)
+				request('n')
+
 			log.debug('Sending request')
 			bif.connect(optz.bif)
-			bif.send('q')
+			request(json.dumps(query) if query else 'q')
 			log.debug('Request sent')
 
-			sys.stdout.write(bif.recv())
-			while bif.getsockopt(zmq.RCVMORE):
-				sys.stdout.write(bif.recv())
+			reactor.add_reader(bif, read)
+			reactor.run()
 
 	finally:
 		log.debug('Finishing')
 		context.term()
+
+	return 0 if state['done'] else 1
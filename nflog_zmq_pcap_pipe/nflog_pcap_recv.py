@@ -4,29 +4,55 @@ from __future__ import print_function
 
 def main():
 	import itertools as it, operator as op, functools as ft
-	from time import sleep
-	from collections import deque
-	import os, logging, pcap, metrics, shaper
+	from time import time
+	import os, threading, logging, pcap, wire, ringbuf, bif, metrics, reactor, outputs, partition, workers, dedup, hdrcomp
 
 	import argparse
 	parser = argparse.ArgumentParser(
-		description='Receive pcap stream from zeromq and push it to a fifo socket.')
+		description='Receive pcap stream from zeromq and push it to fifo(s), files or other sockets.')
 	parser.add_argument('src', help='ZMQ socket address to bind to.')
-	parser.add_argument('dst', help='Path to fifo to write stream to.')
-	parser.add_argument('--rate-control',
-		action='store_true', help='Handle possibly-compressed stream.')
+	parser.add_argument('dst', nargs='?',
+		help='Path to fifo to write stream to, same as "--output fifo:<path>".')
+	parser.add_argument('--rate-control', action='store_true',
+		help='Obsolete, has no effect - compressed frames are detected automatically.')
 
 	parser.add_argument('--buffer-interface',
 		help='ZMQ socket to access traffic-buffer interface.'
 			' Upon receiving request on it, pcap dump of'
-				' a traffic will be generated and sent as a response.')
+				' a traffic will be generated and sent as a response in chunks,'
+				' without blocking the main traffic flow, see nflog-pcap-query.'
+			' Request can be a JSON object with any of the'
+				' "since", "until" (unix timestamps), "host", "port" and "proto"'
+				' keys to only return matching packets.')
 	parser.add_argument('--buffer-window',
 		type=float, metavar='MiB', help='Amount of last traffic to keep buffered.')
-	parser.add_argument('--buffer-timeout', default=1.0,
-		type=float, metavar='s', help='Timeout for sending buffered stuff (default: %(default)s).')
+	parser.add_argument('--buffer-chunk', default=1024,
+		type=float, metavar='KiB', help='Size of chunks to send dumps in (default: %(default)s).')
+	parser.add_argument('--buffer-timeout', default=10.0,
+		type=float, metavar='s',
+		help='Timeout for client to request next chunk of the'
+			' dump before discarding its state (default: %(default)s).')
+
+	parser.add_argument('--decompress-workers',
+		type=int, metavar='count', default=0,
+		help='Number of threads to decompress and index received frames in,'
+				' to use more than one cpu core with many compressed streams.'
+			' Order of batches from each sender (as identified by header compression stream'
+				' or --stage-timestamps host name, all streams without these are treated'
+				' as one sender) is preserved.'
+			' Default is to do it in the main thread, same as for uncompressed frames.')
+	parser.add_argument('--decompress-queue',
+		type=int, metavar='msg_count',
+		help='Max number of received messages queued for or being processed'
+				' by --decompress-workers, before pausing reading from the socket'
+				' (and letting its zmq buffer fill up instead).'
+			' Default is 16 messages per worker thread.')
 
 	parser.add_argument('--debug', action='store_true', help='Verbose operation mode.')
-	metrics.add_statsd_optz(parser)
+	outputs.add_output_optz(parser)
+	partition.add_partition_optz(parser)
+	dedup.add_dedup_optz(parser)
+	metrics.add_metrics_optz(parser)
 	optz = parser.parse_args()
 
 	logging.basicConfig(
@@ -35,100 +61,144 @@ def main():
 		datefmt='%Y-%m-%d %H:%M:%S' )
 	log = logging.getLogger('pcap_recv')
 
-	optz.reopen = True # only fifo dst for now
+	if optz.dst: optz.output.insert(0, 'fifo:{}'.format(optz.dst))
+	if not optz.output: parser.error('At least one destination (dst or --output) must be specified')
 	if optz.buffer_window:
 		optz.buffer_window = optz.buffer_window * 2**20
 
-	statsd = metrics.statsd_from_optz(optz)
-
-	if optz.rate_control:
-		shaper = shaper.decompress_pipe()
-		next(shaper)
-	else: shaper = None
+	reactor = reactor.Reactor()
+	registry = metrics.registry_from_optz(optz, reactor=reactor)
+	stats_in = registry.counters('raw_in', ['pkt', 'bytes', 'malformed'])
+	stats_out = registry.counters('raw_out', ['pkt', 'bytes'])
+	dedup = dedup.dedup_from_optz(optz, registry)
+	hdr_dec = hdrcomp.HeaderDecompressor(stats=registry.counters('hdrcomp'))
+
+	def unpack(frames, ts_recv):
+		'''Returns (ts_recv, batches) with (body, offsets, stages) or None for malformed frames.
+			Header-compressed bodies have None offsets, and are decoded in write(),
+				as these have to be processed strictly in order for each sender.'''
+		batches = list()
+		for frame in frames:
+			try:
+				body = wire.unframe(frame)
+				offsets = None if wire.frame_flags(frame) & wire.F_HDRCOMP else pcap.index(body)
+				batches.append((body, offsets, wire.frame_stages(frame)))
+			except ValueError as err:
+				log.warn('Discarding malformed frame: {}'.format(err))
+				batches.append(None)
+		return ts_recv, batches
+
+	def sender(frame):
+		'''Returns key to keep order of batches from the same sender by - header-compression
+			stream id (see hdrcomp.stream) or host name from stages block, if any.'''
+		try:
+			if wire.frame_flags(frame) & wire.F_HDRCOMP: return hdrcomp.stream(wire.unframe(frame))
+			return (wire.frame_stages(frame) or (None,))[0]
+		except ValueError: pass
 
 	import zmq
 	context = zmq.Context()
 
-	src = bif = None
+	try: dsts = outputs.outputs_from_optz(optz, context, registry)
+	except outputs.OutputError as err: parser.error(err)
+	groups = dict() # name -> (partitioner, outputs)
+	for dst in dsts:
+		if dst.group: groups.setdefault(dst.group, list()).append(dst)
+	for name, members in groups.items():
+		groups[name] = partition.partitioner_from_optz(optz, len(members), name, registry), members
+		reactor.call_every(optz.partition_interval, groups[name][0].rebalance)
+	dsts_full = list(dst for dst in dsts if not dst.group)
+
+	src = bif_srv = pool = None
 	try:
 		src = context.socket(zmq.PULL)
 		src.bind(optz.src)
-		zmq_poll = zmq.Poller()
-		zmq_poll.register(src, zmq.POLLIN)
 
 		if optz.buffer_interface and optz.buffer_window:
-			def bif_init():
-				bif = context.socket(zmq.REP)
-				bif.setsockopt(zmq.LINGER, 0)
-				bif.bind(optz.buffer_interface)
-				for k in zmq.RCVTIMEO, zmq.SNDTIMEO:
-					bif.setsockopt(k, int(optz.buffer_timeout * 1e3))
-				return bif
-			bif_buff, bif_buff_len, bif = deque(), 0, bif_init()
-			zmq_poll.register(bif, zmq.POLLIN)
-
-		buff = None
-
-		while True:
-			with open(optz.dst, 'wb', 0) as dst:
-				pcap_dst = pcap.writer(dst.write)
-				next(pcap_dst)
-				log.debug('(Re-)opened destination path')
-
-				while True:
-					if not buff:
-						if bif in it.imap(op.itemgetter(0), zmq_poll.poll()):
-							# Break from main activity to send traffic dump
-							pcap_bif = pcap.writer(ft.partial(bif.send, flags=zmq.SNDMORE))
-							try:
-								bif.recv() # contents aren't used
-								next(pcap_bif)
-								for pkt_len, pkt in bif_buff: pcap_bif.send(pkt)
-								bif.send('')
-							except zmq.ZMQError as err:
-								if err.errno != zmq.EAGAIN: raise
-								zmq_poll.unregister(bif)
-								bif.close()
-								bif = bif_init()
-								zmq_poll.register(bif, zmq.POLLIN)
-							finally: del pcap_bif
-							continue
-
-						buff = ''.join(src.recv_multipart())
-
-						if statsd:
-							statsd.send('raw_in.pkt')
-							statsd.send('raw_in.bytes', len(buff))
-						buff = shaper.send(buff) if shaper else [buff]
-
-					try:
-						buff_len = 0
-						if bif: bif_tmp = list()
-						for pkt in buff:
-							pkt_len = pcap_dst.send(pkt)
-							buff_len += pkt_len
-							if bif: bif_tmp.append((pkt_len, pkt))
-					except IOError: break
-
-					if bif:
-						bif_buff.extend(bif_tmp)
-						del bif_tmp
-						bif_buff_len += buff_len
-						while bif_buff and bif_buff_len >= optz.buffer_window:
-							pkt_len, pkt = bif_buff.popleft()
-							bif_buff_len -= pkt_len
-
-					if statsd:
-						statsd.send('raw_out.pkt', len(buff))
-						statsd.send('raw_out.bytes', buff_len)
-					buff = None
-
-			if not optz.reopen: break
-			sleep(1)
+			bif_buff, bif_lock = ringbuf.IndexedPacketRing(int(optz.buffer_window)), threading.Lock()
+			bif_srv = bif.BufferInterface( context, optz.buffer_interface,
+				bif_buff, bif_lock, chunk_size=int(optz.buffer_chunk * 2**10),
+				timeout=optz.buffer_timeout )
+			bif_srv.start()
+			registry.gauges['buffer.records'] = bif_buff.__len__
+			registry.gauges['buffer.bytes'] = lambda: bif_buff.used
+
+		for dst in dsts: dst.start()
+
+		if optz.decompress_workers > 0:
+			pool = workers.OrderedPool( unpack,
+				optz.decompress_workers, max_pending=optz.decompress_queue )
+			registry.gauges['decompress.pending'] = lambda: pool.pending
+
+		def read():
+			# Each frame of a multipart message is a separate batch of records,
+			#  passed around as memoryviews of zmq message buffers, without copying these
+			buff = list(frame.buffer for frame in src.recv_multipart(copy=False))
+			ts_recv = time()
+
+			stats_in['pkt'] += len(buff)
+			stats_in['bytes'] += sum(it.imap(len, buff))
+			if not pool: return write(*unpack(buff, ts_recv))
+			pool.submit(sender(buff[0]), buff, ts_recv)
+			if pool.full(): reactor.remove_reader(src) # until some results are processed
+
+		def read_pool():
+			for res in pool.results():
+				if res: write(*res)
+			if not pool.full() and src not in reactor.readers: reactor.add_reader(src, read)
+
+		def write(ts_recv, buff):
+			for n, batch in enumerate(buff):
+				if not batch or batch[1] is not None: continue
+				body, offsets, stages = batch
+				try:
+					body = hdr_dec.decode(body)
+					buff[n] = body, pcap.index(body), stages
+				except ValueError as err:
+					log.warn('Discarding malformed frame: {}'.format(err))
+					buff[n] = None
+			buff_len = len(buff)
+			buff = list(batch for batch in buff if batch)
+			if len(buff) != buff_len: stats_in['malformed'] += buff_len - len(buff)
+			if dedup:
+				for n, (body, offsets, stages) in enumerate(buff):
+					buff[n] = dedup.filter(body, offsets, ts_recv) + (stages,)
+				buff = list(batch for batch in buff if batch[1])
+			if not buff: return
+
+			# Outputs only block here with "block" policy, dropping batches otherwise
+			bodies = list(body for body, offsets, stages in buff)
+			buff_count = sum(len(offsets) for body, offsets, stages in buff)
+			for dst in dsts_full: dst.put(bodies, buff_count, ts_recv)
+			for part, members in groups.viewvalues():
+				batches = list((body, offsets) for body, offsets, stages in buff)
+				for dst, (body, count) in it.izip(members, part.split(batches)):
+					if count: dst.put([body], count, ts_recv)
+
+			ts = time()
+			for body, offsets, stages in buff:
+				if not stages: continue
+				host, stamps = stages
+				stamps.extend([(wire.stages['receive'], ts_recv), (wire.stages['write'], ts)])
+				registry.latencies(host, wire.stage_delays(stamps))
+
+			if bif_srv:
+				with bif_lock:
+					for body, offsets, stages in buff: bif_buff.add_batch(body, offsets)
+
+			stats_out['pkt'] += buff_count
+			stats_out['bytes'] += sum(it.imap(len, bodies))
+
+		reactor.add_reader(src, read)
+		if pool: reactor.add_reader(pool, read_pool)
+		reactor.run()
 
 	finally:
 		if src: src.close()
-		if bif: bif.close()
+		for dst in dsts:
+			if dst.is_alive(): dst.stop()
+		if bif_srv: bif_srv.stop()
+		if pool: pool.close()
 		log.debug('Finishing')
 		context.term()
 
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+
+def read_metric(src, name):
+	'''Returns sum of all values for prometheus text-format metric
+		from http url or file path (see --metrics-* options), None if there is no such metric.'''
+	if src.startswith(('http://', 'https://')):
+		import urllib2
+		text = urllib2.urlopen(src, timeout=10).read()
+	else:
+		with open(src, 'rb') as src: text = src.read()
+	value = None
+	for line in text.splitlines():
+		if not line.startswith(name): continue
+		metric, v = line.rsplit(None, 1)
+		if metric.split('{', 1)[0] != name: continue
+		value = (value or 0) + float(v)
+	return value
+
+
+def main():
+	import itertools as it, operator as op, functools as ft
+	from time import time, sleep
+	import sys, json, logging, pcap, wire
+
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='Replay packets from pcap files to zmq socket'
+			' in the same format as nflog-zmq-send, e.g. to load-test receiving side.')
+	parser.add_argument('dst', help='ZMQ socket address to send data to.')
+	parser.add_argument('pcap', nargs='+',
+		help='Pcap files to replay packets from, in order.'
+			' Link-layer headers (ethernet, linux sll) are stripped, non-IP packets skipped.')
+
+	parser.add_argument('-s', '--speed',
+		type=float, metavar='multiplier', default=1.0,
+		help='Replay packets with original timing, sped up'
+			' (or slowed down) by this factor (default: %(default)s).')
+	parser.add_argument('-r', '--pps',
+		type=float, metavar='rate',
+		help='Replay packets at a fixed rate (packets per second) instead of original timing,'
+			' 0 - as fast as possible.')
+	parser.add_argument('-l', '--loop',
+		type=int, metavar='count', default=1,
+		help='Number of times to replay all files (default: %(default)s, 0 - forever).')
+	parser.add_argument('-n', '--senders',
+		type=int, metavar='count', default=1,
+		help='Number of separate zmq sockets to distribute'
+			' batches between, to simulate many senders (default: %(default)s).')
+
+	parser.add_argument('--batch-size',
+		type=float, metavar='KiB', default=64.0,
+		help='Send packets in batches (one zmq message each)'
+			' of up to this size, as nflog-zmq-send does (default: %(default)s).')
+	parser.add_argument('--batch-latency',
+		type=float, metavar='seconds', default=0.1,
+		help='Max time to hold packets in a batch before sending it out'
+			' when replaying with delays between packets (default: %(default)s).')
+	parser.add_argument('--zmq-buffer',
+		type=int, metavar='msg_count', default=100,
+		help='ZMQ_SNDHWM for each socket - number of batches'
+			' to buffer in RAM before dropping these (default: %(default)s).')
+	parser.add_argument('--blocking', action='store_true',
+		help='Block when zmq send buffer is full instead of'
+			' dropping batches (as nflog-zmq-send does), i.e. slow down replay.')
+	parser.add_argument('--now-timestamps', action='store_true',
+		help='Use current time for packet timestamps instead of ones from pcap files.')
+	parser.add_argument('--stage-timestamps', action='store_true',
+		help='Add stage timestamps to each frame, as nflog-zmq-send does'
+			' with the same option, with replay time being used as capture time,'
+			' and "replay-N" as host name for N-th sender socket.')
+
+	parser.add_argument('--recv-metrics', metavar='url-or-path',
+		help='Prometheus text-format metrics of the receiving side'
+				' (see --metrics-http and --metrics-file options there),'
+				' to get number of packets received from "raw_out.pkt" counter'
+				' before and after replay and report loss.'
+			' Should only be used if nothing else is sending packets there at the same time.')
+	parser.add_argument('--recv-metrics-wait',
+		type=float, metavar='seconds', default=15.0,
+		help='Delay before checking --recv-metrics after replay, which should'
+			' be longer than metrics interval there (default: %(default)s).')
+	parser.add_argument('--report-interval',
+		type=float, metavar='seconds',
+		help='Interval to print stats to stderr at during replay.'
+			' Final stats are always printed to stdout as json object.')
+	parser.add_argument('--debug', action='store_true', help='Verbose operation mode.')
+	optz = parser.parse_args()
+
+	logging.basicConfig(
+		level=logging.DEBUG if optz.debug else logging.WARNING,
+		logfmt='%(asctime)s :: %(levelname)s :: %(name)s: %(message)s',
+		datefmt='%Y-%m-%d %H:%M:%S' )
+	log = logging.getLogger('pcap_replay')
+
+	optz.batch_size = int(optz.batch_size * 2**10)
+	if optz.speed <= 0: parser.error('--speed must be positive')
+	recv_metric = 'nflog_pipe_raw_out_pkt_total'
+	if optz.recv_metrics:
+		recv_before = read_metric(optz.recv_metrics, recv_metric)
+		if recv_before is None:
+			parser.error('No {} metric in --recv-metrics source'.format(recv_metric))
+
+	import zmq
+	context = zmq.Context()
+
+	stats = dict(pkt=0, bytes=0, frames=0, dropped=0, dropped_pkt=0)
+	ts_start = ts_report = time()
+
+	def report(dst=sys.stderr):
+		ts = time() - ts_start
+		res = dict(stats, seconds=round(ts, 3))
+		if ts > 0:
+			res.update( pps=round(stats['pkt'] / ts, 1),
+				mib_per_s=round(stats['bytes'] / ts / 2**20, 3) )
+		if dst: print(json.dumps(res, sort_keys=True), file=dst)
+		return res
+
+	senders = list()
+	try:
+		for n in xrange(optz.senders):
+			sock = context.socket(zmq.PUSH)
+			sock.setsockopt(zmq.SNDHWM, optz.zmq_buffer)
+			sock.setsockopt(zmq.LINGER, 5000) # to send out everything at the end
+			sock.connect(optz.dst)
+			senders.append((sock, 'replay-{}'.format(n)))
+
+		batch = bytearray(optz.batch_size + pcap.rec_hdr.size + 2**16 + 1)
+		batch[:1], batch_pos, batch_ts, batch_count = wire.frame_byte(), 1, None, 0
+		send_flags = 0 if optz.blocking else zmq.NOBLOCK
+
+		def flush():
+			frame, (sock, host) = memoryview(batch)[:batch_pos], senders[stats['frames'] % len(senders)]
+			if optz.stage_timestamps:
+				frame = wire.frame_add_stages( frame, host,
+					[(wire.stages['capture'], batch_ts), (wire.stages['send'], time())] )
+			stats['frames'] += 1
+			try: sock.send(frame, send_flags)
+			except zmq.ZMQError as err:
+				if err.errno != zmq.EAGAIN: raise
+				stats['dropped'] += 1
+				stats['dropped_pkt'] += batch_count
+			if optz.report_interval and time() - ts_report > optz.report_interval: return report()
+
+		t_last = 0 # replay-relative time of the last packet
+		try:
+			for loop in it.count() if not optz.loop else xrange(optz.loop):
+				for path in optz.pcap:
+					log.debug('Replaying packets from {} (loop: {})'.format(path, loop))
+					t_base, ts_first = t_last, None
+					with open(path, 'rb') as src:
+						for ts, incl_len, orig_len, pkt in pcap.reader(src):
+							if optz.pps is not None:
+								t_last = stats['pkt'] / optz.pps if optz.pps else 0
+							else:
+								if ts_first is None: ts_first = ts
+								t_last = max(t_last, t_base + (ts - ts_first) / optz.speed)
+							if t_last:
+								delay = ts_start + t_last - time()
+								if delay > 0:
+									if batch_pos > 1 and time() + delay - batch_ts >= optz.batch_latency:
+										if flush(): ts_report = time()
+										batch_pos, batch_count = 1, 0
+									sleep(delay)
+
+							if batch_pos == 1: batch_ts = time()
+							batch_pos = pcap.construct_into( batch, batch_pos, pkt,
+								pkt_len=orig_len, ts=None if optz.now_timestamps else ts )
+							batch_count += 1
+							stats['pkt'] += 1
+							stats['bytes'] += incl_len
+							if batch_pos > optz.batch_size:
+								if flush(): ts_report = time()
+								batch_pos, batch_count = 1, 0
+		except KeyboardInterrupt: log.debug('Interrupted, stopping replay')
+
+		if batch_pos > 1: flush()
+		res = report(None)
+
+	finally:
+		for sock, host in senders: sock.close()
+		log.debug('Waiting for queued messages to be sent')
+		context.term()
+
+	if optz.recv_metrics:
+		sleep(optz.recv_metrics_wait)
+		recv = read_metric(optz.recv_metrics, recv_metric) - recv_before
+		sent = stats['pkt'] - stats['dropped_pkt']
+		res.update( recv_pkt=int(recv),
+			recv_loss_pkt=int(sent - recv), recv_loss=round((sent - recv) / float(sent or 1), 6) )
+	print(json.dumps(res, sort_keys=True))
+
+if __name__ == '__main__': main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+
+def measure(name, func, duration, **info):
+	'''Runs func() repeatedly for "duration" seconds,
+			summing (packets, bytes) tuples returned by it.
+		Returns dict with pps, bytes/s, cpu time per packet and peak rss.'''
+	from time import time
+	import resource
+	ru0, ts0 = resource.getrusage(resource.RUSAGE_SELF), time()
+	pkts = bs = 0
+	while True:
+		n, b = func()
+		pkts, bs = pkts + n, bs + b
+		ts = time()
+		if ts - ts0 >= duration: break
+	ru1 = resource.getrusage(resource.RUSAGE_SELF)
+	cpu = (ru1.ru_utime + ru1.ru_stime) - (ru0.ru_utime + ru0.ru_stime)
+	return result(name, pkts, bs, ts - ts0, cpu, ru1.ru_maxrss, **info)
+
+def result(name, pkts, bs, seconds, cpu, rss, **info):
+	res = dict( name=name, packets=pkts, bytes=bs, seconds=round(seconds, 3),
+		pps=round(pkts / seconds, 1), bytes_per_s=round(bs / seconds, 1),
+		cpu_per_pkt_us=round(cpu / pkts * 1e6, 3) if pkts else None,
+		cpu_per_mib_ms=round(cpu / (bs / float(2**20)) * 1e3, 3) if bs else None,
+		peak_rss_kib=rss )
+	res.update(info)
+	return res
+
+
+def batches(pkts, batch_size):
+	'Returns list of pcap record batches (bodies) of up to batch_size bytes.'
+	import pcap
+	res, buff, pos = list(), bytearray(), 0
+	for pkt in pkts:
+		pos = pcap.construct_into(buff, pos, pkt)
+		if pos >= batch_size:
+			res.append(bytes(buff[:pos]))
+			pos = 0
+	if pos: res.append(bytes(buff[:pos]))
+	return res
+
+
+def bench_construct(optz, pkts, bodies):
+	import pcap
+	batch, batch_size = bytearray(optz.batch_size + 2**16), optz.batch_size
+	def run():
+		pos = n = 0
+		for pkt in pkts:
+			pos = pcap.construct_into(batch, pos, pkt, ts=1.0)
+			if pos > batch_size: n, pos = n + pos, 0
+		return len(pkts), n + pos
+	yield measure('construct', run, optz.duration)
+
+def compress_pipe(optz, bodies, codec):
+	'Returns compress_pipe, fed with plain data until it starts compressing it.'
+	import itertools as it, logging, shaper
+	pipe = shaper.compress_pipe( optz.window, lwm=1, hwm=0,
+		log=logging.getLogger('bench'), policy=shaper.CodecPolicy([codec], lwm=1) )
+	next(pipe)
+	for body in it.cycle(bodies):
+		if pipe.send(body) is None: break
+	return pipe
+
+def bench_compress(optz, pkts, bodies):
+	import wire
+	for name in optz.codecs.split(','):
+		pipe, frames = compress_pipe(optz, bodies, wire.codec_get(name)), list()
+		def run():
+			bs = 0
+			for body in bodies:
+				frame = pipe.send(body)
+				if frame is not None: frames.append(len(frame))
+				bs += len(body)
+			return len(pkts), bs
+		res = measure('compress.{}'.format(name), run, optz.duration)
+		res['ratio'] = round(sum(frames) / float(res['bytes']), 4) if frames else None
+		yield res
+
+def bench_decompress(optz, pkts, bodies):
+	import wire, pcap
+	for name in optz.codecs.split(','):
+		pipe, frames = compress_pipe(optz, bodies, wire.codec_get(name)), list()
+		while not frames:
+			for body in bodies:
+				frame = pipe.send(body)
+				if frame is not None: frames.append(frame)
+		frames_pkts = sum(len(pcap.index(wire.unframe(frame))) for frame in frames)
+		def run(): return frames_pkts, sum(len(wire.unframe(frame)) for frame in frames)
+		yield measure('decompress.{}'.format(name), run, optz.duration)
+
+def bench_writer(optz, pkts, bodies):
+	import functools as ft
+	import os, pcap
+	fd = os.open(os.devnull, os.O_WRONLY)
+	try:
+		dst = pcap.writer(ft.partial(os.write, fd))
+		next(dst)
+		def run():
+			return len(pkts), sum(dst.send(body) for body in bodies)
+		yield measure('writer', run, optz.duration, syscalls_per_batch=1.0)
+
+		# Same batches in multipart-message-sized groups, coalesced into larger writes
+		dst = pcap.BatchWriter(fd, optz.write_buffer, latency=1.0)
+		groups, runs, syscalls = list(bodies[n:n+4] for n in xrange(0, len(bodies), 4)), [0], dst.syscalls
+		def run():
+			runs[0] += 1
+			return len(pkts), sum(dst.write(group) for group in groups)
+		res = measure('writer.batched', run, optz.duration)
+		res['syscalls_per_batch'] = round((dst.syscalls - syscalls) / float(runs[0] * len(bodies)), 4)
+		yield res
+	finally: os.close(fd)
+
+def bench_ring(optz, pkts, bodies):
+	import pcap, ringbuf
+	ring = ringbuf.IndexedPacketRing(optz.ring_size)
+	indexed = list((body, pcap.index(body)) for body in bodies)
+	def run():
+		for body, offsets in indexed: ring.add_batch(body, offsets)
+		return len(pkts), sum(len(body) for body in bodies)
+	yield measure('ring', run, optz.duration)
+
+def bench_recv(optz, pkts, bodies):
+	'''Receiving end of nflog-pcap-recv over inproc:// zmq socket - receiving
+			multipart messages, unframing, indexing and writing records via pcap.BatchWriter,
+			with frames received as str copies ("recv.copy", as it was done before)
+			and as memoryviews of zmq message buffers ("recv.zerocopy", as it is done now).
+		copies_per_pkt is how many times bytes of each packet get copied into new
+			str/bytearray objects on the way there, not counting sending side of the socket.'''
+	import itertools as it, os, pcap, wire
+	import zmq
+	groups = list(list(wire.frame(body) for body in bodies[n:n+4]) for n in xrange(0, len(bodies), 4))
+	context = zmq.Context()
+	src, sink = context.socket(zmq.PULL), context.socket(zmq.PUSH)
+	fd = os.open(os.devnull, os.O_WRONLY)
+	try:
+		src.bind('inproc://bench-recv')
+		sink.connect('inproc://bench-recv')
+		for name, copy in ('recv.copy', True), ('recv.zerocopy', False):
+			dst, copied = pcap.BatchWriter(fd, optz.write_buffer, latency=1.0), [0]
+			def run():
+				pkts_n = bs = 0
+				for group in groups: sink.send_multipart(group, copy=False)
+				for group in groups:
+					frames = src.recv_multipart(copy=copy)
+					if not copy: frames = list(frame.buffer for frame in frames)
+					batches = list(wire.unframe(frame) for frame in frames)
+					pkts_n += sum(len(pcap.index(body)) for body in batches)
+					bs += dst.write(batches)
+					copied[0] += sum( len(buff) for buff in it.chain(frames, batches)
+						if not isinstance(buff, memoryview) )
+					copied[0] += sum(len(body) for body in batches if len(body) < dst.size)
+				return pkts_n, bs
+			res = measure(name, run, optz.duration)
+			res['copies_per_pkt'] = round(copied[0] / float(res['bytes']), 3)
+			yield res
+	finally:
+		os.close(fd)
+		src.close(linger=0)
+		sink.close(linger=0)
+		context.term()
+
+def bench_pipeline(optz, pkts, bodies):
+	'''Runs nflog-zmq-send with synthetic source in a subprocess,
+		with receiving end of the pipeline (like in nflog-pcap-recv) in this one.'''
+	import functools as ft
+	from time import time
+	import os, sys, signal, tempfile, resource, wire, pcap
+	import zmq
+	for name, extra_args in ('pipeline', []), ('pipeline.rate_control', optz.rate_control_args.split()):
+		tmp_dir = tempfile.mkdtemp(prefix='nflog-pipe-bench.')
+		addr = 'ipc://{}/sock'.format(tmp_dir)
+		context = zmq.Context()
+		src = context.socket(zmq.PULL)
+		src.bind(addr)
+		pid = os.fork()
+		if not pid:
+			try:
+				import nflog_zmq_send
+				sys.argv = [ 'nflog-zmq-send',
+					'--nflog-backend', 'synthetic', '--zmq-buffer', '100',
+					'--batch-size', str(optz.batch_size // 2**10) ] + extra_args + ['0', addr]
+				nflog_zmq_send.main()
+			finally: os._exit(0)
+		try:
+			fd = os.open(os.devnull, os.O_WRONLY)
+			dst = pcap.writer(ft.partial(os.write, fd))
+			next(dst)
+			ru0 = resource.getrusage(resource.RUSAGE_SELF)
+			pkts_n = bs = 0
+			src.poll(10000) # wait for sender to start
+			ts0 = time()
+			while time() - ts0 < optz.duration:
+				if not src.poll(1000): break
+				for frame in src.recv_multipart(copy=False):
+					body = wire.unframe(frame.buffer)
+					pkts_n += len(pcap.index(body))
+					bs += dst.send(body)
+			ts = time()
+			ru1 = resource.getrusage(resource.RUSAGE_SELF)
+		finally:
+			os.kill(pid, signal.SIGTERM)
+			os.waitpid(pid, 0)
+			os.close(fd)
+			src.close()
+			context.term()
+			os.unlink(os.path.join(tmp_dir, 'sock'))
+			os.rmdir(tmp_dir)
+		ru_send = resource.getrusage(resource.RUSAGE_CHILDREN) # cumulative for all runs
+		cpu = (ru1.ru_utime + ru1.ru_stime) - (ru0.ru_utime + ru0.ru_stime)
+		yield result( name, pkts_n, bs, ts - ts0, cpu, ru1.ru_maxrss,
+			sender_cpu_total_s=round(ru_send.ru_utime + ru_send.ru_stime, 3),
+			sender_peak_rss_kib=ru_send.ru_maxrss )
+
+
+benchmarks = ['construct', 'compress', 'decompress', 'writer', 'ring', 'recv', 'pipeline']
+
+def main():
+	import itertools as it, operator as op, functools as ft
+	from time import time
+	import os, sys, json, logging, socket, synthetic
+
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='Run throughput benchmarks for pipeline components on synthetic'
+			' traffic, printing results as json (one object per benchmark).')
+	parser.add_argument('benchmark', nargs='*',
+		help='Benchmarks to run: {} (default: all).'.format(', '.join(benchmarks)))
+	parser.add_argument('-d', '--duration',
+		type=float, metavar='seconds', default=3.0,
+		help='How long to run each benchmark for (default: %(default)s).')
+	parser.add_argument('-p', '--packets',
+		type=int, metavar='count', default=4096,
+		help='Number of distinct synthetic packets to cycle through (default: %(default)s).')
+	parser.add_argument('--mix', metavar='size:weight[,...]',
+		help='Packet size mix (default: {}).'.format(
+			','.join('{}:{}'.format(*v) for v in synthetic.size_mix)))
+	parser.add_argument('--batch-size',
+		type=float, metavar='KiB', default=64.0,
+		help='Size of record batches, as in nflog-zmq-send (default: %(default)s).')
+	parser.add_argument('--codecs',
+		metavar='name[,name...]', default='zlib-1,zlib-6',
+		help='Compression codecs to benchmark (default: %(default)s).')
+	parser.add_argument('--window',
+		type=float, metavar='MiB', default=4.0,
+		help='Compression window size (default: %(default)s).')
+	parser.add_argument('--write-buffer',
+		type=float, metavar='KiB', default=256.0,
+		help='Buffer size for pcap.BatchWriter in "writer" benchmark (default: %(default)s).')
+	parser.add_argument('--ring-size',
+		type=float, metavar='MiB', default=64.0,
+		help='Size of the ring buffer (default: %(default)s).')
+	parser.add_argument('--rate-control-args',
+		metavar='args', default='--rate-control --lwm 0.001 --hwm 0',
+		help='Options for nflog-zmq-send in the'
+			' "pipeline.rate_control" benchmark (default: %(default)s).')
+	parser.add_argument('-o', '--output', metavar='path',
+		help='File to write results to (default: stdout).')
+	parser.add_argument('--debug', action='store_true', help='Verbose operation mode.')
+	optz = parser.parse_args()
+
+	logging.basicConfig(level=logging.DEBUG if optz.debug else logging.ERROR)
+	optz.batch_size = int(optz.batch_size * 2**10)
+	optz.window = int(optz.window * 2**20)
+	optz.ring_size = int(optz.ring_size * 2**20)
+	optz.write_buffer = int(optz.write_buffer * 2**10)
+	for name in optz.benchmark:
+		if name not in benchmarks: parser.error('Unknown benchmark: {}'.format(name))
+
+	pkts = synthetic.packets(optz.packets, optz.mix and synthetic.parse_mix(optz.mix))
+	bodies = batches(pkts, optz.batch_size)
+
+	results = list()
+	for name in optz.benchmark or benchmarks:
+		for res in globals()['bench_{}'.format(name)](optz, pkts, bodies):
+			res['ts'], res['host'] = round(time(), 3), socket.gethostname()
+			results.append(res)
+			if optz.debug: print(json.dumps(res), file=sys.stderr)
+
+	dst = open(optz.output, 'wb') if optz.output else sys.stdout
+	try:
+		for res in results: dst.write(json.dumps(res, sort_keys=True) + '\n')
+	finally:
+		if optz.output: dst.close()
+
+if __name__ == '__main__': main()
@@ -4,8 +4,10 @@ from __future__ import print_function
 
 
 def main():
+	import itertools as it, operator as op, functools as ft
 	from contextlib import closing
-	import os, errno, logging, metrics, shaper
+	from time import time
+	import os, errno, logging, wire, metrics, shaper, reactor
 
 	import argparse
 	parser = argparse.ArgumentParser(
@@ -19,8 +21,9 @@ def main():
 			' compressed) packets to buffer in RAM before blocking (default: %(default)s).')
 	parser.add_argument('--debug', action='store_true', help='Verbose operation mode.')
 	shaper.add_compress_optz(parser, always_enabled=True)
-	metrics.add_statsd_optz(parser)
+	metrics.add_metrics_optz(parser)
 	optz = parser.parse_args()
+	if optz.hwm and optz.lwm > optz.hwm: parser.error('hwm must be > than lwm')
 
 	logging.basicConfig(
 		level=logging.DEBUG if optz.debug else logging.WARNING,
@@ -28,9 +31,33 @@ def main():
 		datefmt='%Y-%m-%d %H:%M:%S' )
 	log = logging.getLogger('zmq_compress')
 
-	statsd = metrics.statsd_from_optz(optz)
-	compressor = shaper\
-		.compress_pipe_from_optz(optz, always_enabled=True)
+	reactor = reactor.Reactor()
+	registry = metrics.registry_from_optz(optz, reactor=reactor)
+	stats_in = registry.counters('compress_in', ['pkt', 'bytes'])
+	stats_out = registry.counters('compress_out', ['pkt', 'bytes', 'dropped', 'dropped_bytes'])
+	compressor = shaper.compress_pipe_from_optz( optz,
+		always_enabled=True, stats=registry.counters('shaper') )
+
+	stages = [None] # from the first frame that went into the next output one
+	def add_stages(frame):
+		if stages[0]:
+			host, stamps = stages[0]
+			if ord(frame[0]) & wire.F_COMPRESSED: stamps.append((wire.stages['compress'], time()))
+			frame, stages[0] = wire.frame_add_stages(frame, host, stamps), None
+		return frame
+
+	def compress(frames):
+		for frame in frames:
+			if wire.frame_flags(frame) & wire.F_HDRCOMP:
+				yield frame # stateful encoding, can't be shed or reordered
+				continue
+			try:
+				if stages[0] is None: stages[0] = wire.frame_stages(frame)
+				frame = compressor.send(wire.unframe(frame))
+			except wire.WireError as err:
+				log.warn('Discarding malformed frame: {}'.format(err))
+				continue
+			if frame is not None: yield add_stages(frame)
 
 	import zmq
 	context = zmq.Context()
@@ -43,26 +70,32 @@ def main():
 			dst.setsockopt(zmq.LINGER, 0) # it's lossy either way
 			dst.connect(optz.dst)
 
-			log.debug('Starting pipeline loop')
-			while True:
-				buff = src.recv()
-				while src.getsockopt(zmq.RCVMORE): buff += src.recv()
+			def send(buff):
+				try: dst.send_multipart(buff, zmq.NOBLOCK)
+				except zmq.ZMQError as err:
+					if err.errno != errno.EAGAIN: raise
+					stats_out['dropped'] += len(buff)
+					stats_out['dropped_bytes'] += sum(it.imap(len, buff))
+				else:
+					stats_out['pkt'] += len(buff)
+					stats_out['bytes'] += sum(it.imap(len, buff))
 
-				if statsd:
-					statsd.send('compress_in.pkt')
-					statsd.send(('compress_in.bytes', len(buff)))
+			def read():
+				buff = src.recv_multipart()
+				stats_in['pkt'] += len(buff)
+				stats_in['bytes'] += sum(it.imap(len, buff))
+				buff = list(compress(buff))
+				if buff: send(buff)
 
-				pkt = compressor.send(buff)
-				if pkt is None: continue
+			def tick(): # closes compression window when traffic stops
+				frame = compressor.send(None)
+				if frame is not None: send([add_stages(frame)])
 
-				try: dst.send(pkt, zmq.NOBLOCK)
-				except zmq.ZMQError as err:
-					if err.errno != errno.EAGAIN: raise
-					continue # so zmq-dropped packets won't be counted in statsd
+			reactor.add_reader(src, read)
+			if optz.wm_latency: reactor.call_every(optz.wm_latency / 2.0, tick)
 
-				if statsd:
-					statsd.send('compress_out.pkt')
-					statsd.send(('compress_out.bytes', len(pkt)))
+			log.debug('Starting pipeline loop')
+			reactor.run()
 
 	finally:
 		log.debug('Finishing')
@@ -4,8 +4,10 @@ from __future__ import print_function
 
 
 def main():
+	import itertools as it, operator as op, functools as ft
 	from contextlib import closing
-	import os, errno, logging, metrics, shaper
+	from time import time
+	import os, errno, logging, wire, metrics, reactor
 
 	import argparse
 	parser = argparse.ArgumentParser(
@@ -18,7 +20,7 @@ def main():
 		help='ZMQ_SNDHWM for the sending socket - number of'
 			' packets to buffer in RAM before blocking (default: %(default)s).')
 	parser.add_argument('--debug', action='store_true', help='Verbose operation mode.')
-	metrics.add_statsd_optz(parser)
+	metrics.add_metrics_optz(parser)
 	optz = parser.parse_args()
 
 	logging.basicConfig(
@@ -27,9 +29,24 @@ def main():
 		datefmt='%Y-%m-%d %H:%M:%S' )
 	log = logging.getLogger('zmq_decompress')
 
-	statsd = metrics.statsd_from_optz(optz)
-	decompressor = shaper.decompress_pipe()
-	next(decompressor)
+	reactor = reactor.Reactor()
+	registry = metrics.registry_from_optz(optz, reactor=reactor)
+	stats_in = registry.counters('decompress_in', ['pkt', 'bytes'])
+	stats_out = registry.counters('decompress_out', ['pkt', 'bytes', 'dropped', 'dropped_bytes'])
+
+	def decompress(frames):
+		for frame in frames:
+			try: stages, body = wire.frame_stages(frame), wire.unframe(frame)
+			except wire.WireError as err:
+				log.warn('Discarding malformed frame: {}'.format(err))
+				continue
+			frame = wire.frame(body, wire.frame_flags(frame) & wire.F_HDRCOMP)
+			if stages:
+				host, stamps = stages
+				stamps.append((wire.stages['decompress'], time()))
+				registry.latencies(host, wire.stage_delays(stamps))
+				frame = wire.frame_add_stages(frame, host, stamps)
+			yield frame
 
 	import zmq
 	context = zmq.Context()
@@ -42,24 +59,27 @@ def main():
 			dst.setsockopt(zmq.LINGER, 0) # it's lossy either way
 			dst.connect(optz.dst)
 
-			log.debug('Starting pipeline loop')
-			while True:
-				buff = src.recv()
-				while src.getsockopt(zmq.RCVMORE): buff += src.recv()
+			def read():
+				buff = src.recv_multipart()
+				stats_in['pkt'] += len(buff)
+				stats_in['bytes'] += sum(it.imap(len, buff))
 
-				if statsd:
-					statsd.send('decompress_in.pkt')
-					statsd.send(('decompress_in.bytes', len(buff)))
+				# Decompressed batches are relayed as one multipart message
+				buff = list(decompress(buff))
+				if not buff: return
 
-				for pkt in decompressor.send(buff):
-					try: dst.send(pkt, zmq.NOBLOCK)
-					except zmq.ZMQError as err:
-						if err.errno != errno.EAGAIN: raise
-						continue # so zmq-dropped packets won't be counted in statsd
+				try: dst.send_multipart(buff, zmq.NOBLOCK)
+				except zmq.ZMQError as err:
+					if err.errno != errno.EAGAIN: raise
+					stats_out['dropped'] += len(buff)
+					stats_out['dropped_bytes'] += sum(it.imap(len, buff))
+				else:
+					stats_out['pkt'] += len(buff)
+					stats_out['bytes'] += sum(it.imap(len, buff))
 
-					if statsd:
-						statsd.send('decompress_out.pkt')
-						statsd.send(('decompress_out.bytes', len(pkt)))
+			reactor.add_reader(src, read)
+			log.debug('Starting pipeline loop')
+			reactor.run()
 
 	finally:
 		log.debug('Finishing')
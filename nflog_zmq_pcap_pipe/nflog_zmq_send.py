@@ -2,16 +2,100 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+
+def set_cpu_affinity(cpus):
+	import ctypes, os
+	from ctypes.util import find_library
+	libc = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+	mask = (ctypes.c_ulong * 16)() # cpu_set_t, 1024 cpus
+	bits = ctypes.sizeof(ctypes.c_ulong) * 8
+	for cpu in cpus: mask[cpu // bits] |= 1 << (cpu % bits)
+	if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) < 0:
+		err = ctypes.get_errno()
+		raise OSError(err, os.strerror(err))
+
+def set_parent_death_signal(sig):
+	import ctypes
+	from ctypes.util import find_library
+	libc = ctypes.CDLL(find_library('c') or 'libc.so.6')
+	libc.prctl(1, sig) # PR_SET_PDEATHSIG
+
+
+def supervise(optz, group_sets, log):
+	'''Runs a worker process for each set of nflog groups,
+		restarting these (with backoff) if they exit or crash.'''
+	from time import time, sleep
+	import os, errno, signal, metrics
+
+	# Registry is created after initial fork, so that workers don't inherit
+	#  its sinks (e.g. bound http socket), and closed in ones restarted later
+	registry, restarts = None, dict(restarts=0)
+	workers, stopping = dict(), list()
+	fails = [0] * len(group_sets)
+
+	def spawn(n):
+		pid = os.fork()
+		if pid:
+			workers[pid] = n, time()
+			log.debug('Started worker {} (pid: {}, groups: {})'.format(n, pid, group_sets[n]))
+			return
+		code = 1
+		try:
+			for sig in signal.SIGTERM, signal.SIGINT: signal.signal(sig, signal.SIG_DFL)
+			set_parent_death_signal(signal.SIGTERM)
+			if registry is not None: registry.close()
+			if optz.worker_cpus:
+				set_cpu_affinity([optz.worker_cpus[n % len(optz.worker_cpus)]])
+			run(optz, group_sets[n], log, worker=n)
+			code = 0
+		except: log.exception('Worker {} failed'.format(n))
+		finally: os._exit(code)
+
+	def shutdown(sig, frame):
+		stopping.append(sig)
+		for pid in workers:
+			try: os.kill(pid, signal.SIGTERM)
+			except OSError: pass
+	for sig in signal.SIGTERM, signal.SIGINT: signal.signal(sig, shutdown)
+
+	for n in xrange(len(group_sets)): spawn(n)
+	registry = metrics.registry_from_optz(optz, worker='supervisor')
+	registry.counters('workers', stats=restarts)
+	while workers:
+		try: pid, status = os.wait()
+		except OSError as err:
+			if err.errno == errno.EINTR: continue
+			raise
+		n, ts = workers.pop(pid)
+		if stopping: continue
+
+		if time() - ts > optz.worker_restart_delay * 60: fails[n] = 0
+		delay = min(optz.worker_restart_delay * 2**fails[n], 60)
+		fails[n] += 1
+		log.error( 'Worker {} (pid: {}, groups: {}) exited (status: {}),'
+			' restarting in {:.1f}s'.format(n, pid, group_sets[n], status, delay) )
+		restarts['restarts'] += 1
+		sleep(delay)
+		if not stopping: spawn(n)
+
+
 def main():
-	from contextlib import closing
-	import os, logging, nflog, pcap, metrics, shaper
+	import logging, metrics, shaper, partition, cutoff, hdrcomp, spool
 
 	import argparse
 	parser = argparse.ArgumentParser(description='Pipe nflog packet stream to zeromq.')
 	parser.add_argument('src', help='Comma-separated list of nflog groups to receive.')
-	parser.add_argument('dst', help='ZMQ socket address to send data to.')
+	parser.add_argument('dst',
+		help='ZMQ socket address to send data to,'
+			' or comma-separated list of these with --partition option.')
 	parser.add_argument('-u', '--user', help='User name to drop privileges to.')
 
+	parser.add_argument('--nflog-backend',
+		metavar='name', choices=['libnflog', 'netlink', 'synthetic'], default='libnflog',
+		help='Implementation to use for getting packets from NFLOG:'
+			' "libnflog" - libnetfilter_log via ctypes, "netlink" - pure-python'
+			' netlink protocol parser, which does not need any libs,'
+			' "synthetic" - generated packets, for testing and benchmarks (default: %(default)s).')
 	parser.add_argument('--libnflog-nlbufsiz',
 		type=float, metavar='MiB', default=10.0,
 		help='Netlink socket buffer size ("nlbufsiz", default: %(default)s).')
@@ -23,16 +107,60 @@ def main():
 		type=float, metavar='seconds',
 		help='NFLOG queue kernel-to-userspace'
 			' flush timeout ("timeout", default: nlbufsiz / 5).')
+	parser.add_argument('--libnflog-recv-batch',
+		type=int, metavar='datagrams', default=16,
+		help='Max number of netlink datagrams to read with one recvmmsg() call'
+			' (each into its own preallocated buffer) before processing them (default: %(default)s).')
 	parser.add_argument('--zmq-buffer',
 		type=int, metavar='msg_count',
-		help='ZMQ_SNDHWM for the socket - number of packets to'
-			' buffer in RAM before blocking (default: qthresh / 10).')
+		help='ZMQ_SNDHWM for the socket - number of messages (packet batches)'
+			' to buffer in RAM before dropping these or writing to --spool (default: qthresh / 10).')
+
+	parser.add_argument('--batch-size',
+		type=float, metavar='KiB', default=64.0,
+		help='Send packets in batches (one zmq message each) of up to this size'
+			' (checked after adding each packet, default: %(default)s, 0 - disable batching).')
+	parser.add_argument('--batch-latency',
+		type=float, metavar='seconds', default=0.1,
+		help='Max time to hold packets in a batch before sending it out,'
+			' if batch size limit is not reached by then (default: %(default)s).')
+	parser.add_argument('--stage-timestamps', action='store_true',
+		help='Add capture/send (and compression, if used) timestamps and host name'
+			' to each sent frame, for receiving side to measure latency of each pipeline stage.')
+
+	parser.add_argument('--partition', action='store_true',
+		help='Split traffic between multiple destinations (specified as'
+				' comma-separated list of addresses) by flow, see --partition-* options,'
+				' e.g. to feed multiple IDS instances on the receiving side(s).'
+			' Rate control (if enabled) is done separately for each destination.')
+
+	parser.add_argument('-w', '--workers',
+		type=int, metavar='count',
+		help='Run specified number of worker processes (0 - one per group),'
+			' each with its own netlink socket and subset of nflog groups,'
+			' distributed round-robin, under supervisor process that restarts'
+			' these on crashes. Runs everything in one process, if not specified.')
+	parser.add_argument('--worker-cpus',
+		metavar='cpu-list',
+		help='Comma-separated list of cpus to pin worker processes to,'
+			' i.e. N-th worker will only run on N-th cpu from that list (cycling it, if necessary),'
+			' or "auto" to pin N-th worker to N-th cpu. Can be used to match per-cpu NFLOG'
+			' groups (e.g. set by iptables rules with "-m cpu"). Default is to not pin workers.')
+	parser.add_argument('--worker-restart-delay',
+		type=float, metavar='seconds', default=1.0,
+		help='Delay before restarting worker after it exits, doubled for'
+			' each consecutive quick (within 60 delays) failure, up to 60s (default: %(default)s).')
 
 	parser.add_argument('--debug', action='store_true', help='Verbose operation mode.')
 
 	shaper.add_compress_optz(parser)
-	metrics.add_statsd_optz(parser)
+	cutoff.add_cutoff_optz(parser)
+	hdrcomp.add_hdrcomp_optz(parser)
+	spool.add_spool_optz(parser)
+	partition.add_partition_optz(parser)
+	metrics.add_metrics_optz(parser)
 	optz = parser.parse_args()
+	if optz.hwm and optz.lwm > optz.hwm: parser.error('hwm must be > than lwm')
 
 	logging.basicConfig(
 		level=logging.DEBUG if optz.debug else logging.WARNING,
@@ -46,14 +174,32 @@ def main():
 		optz.libnflog_timeout = int(optz.libnflog_nlbufsiz / 5.0)
 	if optz.zmq_buffer is None:
 		optz.zmq_buffer = int(optz.libnflog_qthresh / 10.0)
+	optz.batch_size = int(optz.batch_size * 2**10)
 
-	src = nflog.nflog_generator(
-		map(int, optz.src.split(',')),
+	groups = map(int, optz.src.split(','))
+	if optz.workers is None: return run(optz, groups, log)
+
+	workers = optz.workers or len(groups)
+	group_sets = list(groups[n::workers] for n in xrange(min(workers, len(groups))))
+	if optz.worker_cpus == 'auto': optz.worker_cpus = range(len(group_sets))
+	elif optz.worker_cpus: optz.worker_cpus = map(int, optz.worker_cpus.split(','))
+	return supervise(optz, group_sets, log)
+
+
+def run(optz, groups, log, worker=None):
+	from time import time
+	import os, signal, nflog, pcap, wire, metrics, shaper, reactor, partition, cutoff, hdrcomp, spool
+
+	nflog_stats, shaper_stats, cutoff_stats = dict(), dict(), dict()
+	src = nflog.nflog_generator( groups,
+		backend=optz.nflog_backend,
 		qthresh=max(1, optz.libnflog_qthresh),
 		timeout=optz.libnflog_timeout,
 		nlbufsiz=int(optz.libnflog_nlbufsiz * 2**20),
-		extra_attrs=['len', 'ts'] )
-	next(src) # no use for polling here
+		recv_count=optz.libnflog_recv_batch,
+		recv_timeout=optz.batch_size and optz.batch_latency,
+		extra_attrs=['len', 'ts'], stats=nflog_stats )
+	src_fd = next(src) # None for synthetic source
 
 	if optz.user:
 		import pwd
@@ -61,37 +207,176 @@ def main():
 		os.setresgid(*[optz.user.pw_uid]*3)
 		os.setresuid(*[optz.user.pw_gid]*3)
 
-	statsd = metrics.statsd_from_optz(optz)
-	shaper = shaper.compress_pipe_from_optz(optz)
+	reactor = reactor.Reactor()
+	# Stopping loop on SIGTERM (e.g. from supervisor) runs cleanup below, saving --spool position
+	signal.signal(signal.SIGTERM, lambda sig, frame: reactor.stop())
+	dst_addrs = optz.dst.split(',') if optz.partition else [optz.dst]
+	shapers = list( shaper.compress_pipe_from_optz(optz, stats=shaper_stats)
+		for addr in dst_addrs ) # each partition is compressed/shed separately
+	cutoff = cutoff.cutoff_from_optz(optz, stats=cutoff_stats)
+
+	# nflog/shaper counters are incremented by these modules, others - once per batch
+	registry = metrics.registry_from_optz(optz, worker=worker, reactor=reactor)
+	registry.counters('nflog', stats=nflog_stats)
+	registry.counters('shaper', stats=shaper_stats)
+	hdrcomp_stats = registry.counters('hdrcomp') if optz.header_compression else None
+	if cutoff is not None:
+		registry.counters('cutoff', stats=cutoff_stats)
+		registry.gauges['cutoff.flows'] = cutoff.__len__
+	raw_in = registry.counters('raw_in', ['pkt', 'bytes'])
+	zmq_out = registry.counters('zmq', ['sent', 'sent_bytes', 'dropped', 'dropped_bytes'])
+	part = None if not optz.partition else\
+		partition.partitioner_from_optz(optz, len(dst_addrs), 'dst', registry)
+	if part: reactor.call_every(optz.partition_interval, part.rebalance)
 
 	import zmq
 	context = zmq.Context()
 
+	dsts = list()
 	try:
-		with closing(context.socket(zmq.PUSH)) as dst:
-			dst.setsockopt(zmq.SNDHWM, optz.zmq_buffer)
-			dst.setsockopt(zmq.LINGER, 0) # it's lossy either way
-			dst.connect(optz.dst)
-
-			log.debug('Entering NFLOG reader loop')
-			for pkt, pkt_len, ts in src:
-				if pkt is None: continue
-				if statsd:
-					statsd.send('raw_in.pkt')
-					statsd.send(('raw_in.bytes', len(pkt)))
-
-				pkt = pcap.construct(pkt, pkt_len=pkt_len, ts=ts)
-				if pkt is None: continue
-				if shaper:
-					pkt = shaper.send(pkt)
+		for n, (addr, dst_shaper) in enumerate(zip(dst_addrs, shapers)):
+			# capture_ts - of the first packet not yet sent in any frame to this destination,
+			#  spooled - set when live frame was spooled, to hold off replaying older ones
+			dst = dict( sock=context.socket(zmq.PUSH), shaper=dst_shaper, capture_ts=None,
+				hdrcomp=hdrcomp.hdrcomp_from_optz(optz, stats=hdrcomp_stats),
+				spool=spool.spool_from_optz(optz, n, worker, registry, multi=len(dst_addrs) > 1),
+				spooled=False, replay_ts=time(), spool_save_ts=0 )
+			dsts.append(dst)
+			dst['sock'].setsockopt(zmq.SNDHWM, optz.zmq_buffer)
+			dst['sock'].setsockopt(zmq.LINGER, 0) # it's lossy either way
+			dst['sock'].connect(addr)
+
+		# Records are packed into preallocated buffer right after the frame header byte
+		batch = bytearray(optz.batch_size + pcap.rec_hdr.size + 2**16 + 1)
+		batch[:1] = wire.frame_byte()
+		stages_host = os.uname()[1] if optz.stage_timestamps else None
+		# pos/count/capture_ts - of the current batch, timer - its latency deadline
+		state = dict(pos=1, count=0, timer=None, capture_ts=None)
+
+		def send(dst, frame, replay_ts=None):
+			'''Sends frame without blocking, returning True if it was queued by zmq.
+				Frames that can't be sent are spooled (if enabled) as they were passed here,
+					i.e. before header compression and stage timestamps, or dropped otherwise.
+				replay_ts is a capture timestamp of a frame from spool,
+					which is left there (not spooled again) if it can't be sent.'''
+			if replay_ts is None: capture_ts, dst['capture_ts'] = dst['capture_ts'], None
+			else: capture_ts = replay_ts
+			frame_src = frame
+			if dst['hdrcomp'] and not ord(frame[0]) & wire.F_COMPRESSED:
+				frame = wire.frame(dst['hdrcomp'].encode(frame[1:]), wire.F_HDRCOMP)
+			if stages_host:
+				ts, stamps = time(), [(wire.stages['capture'], capture_ts)]
+				if ord(frame[0]) & wire.F_COMPRESSED: stamps.append((wire.stages['compress'], ts))
+				stamps.append((wire.stages['send'], ts))
+				frame = wire.frame_add_stages(frame, stages_host, stamps)
+
+			try: dst['sock'].send(frame, zmq.NOBLOCK)
+			except zmq.ZMQError as err:
+				if err.errno != zmq.EAGAIN: raise
+				if dst['hdrcomp']: dst['hdrcomp'].reset() # receiver will see a gap in frame seqs
+				if replay_ts is not None: return False
+				if dst['spool'] is not None:
+					try: dst['spool'].append(frame_src, capture_ts)
+					except (OSError, IOError) as err:
+						log.warn('Failed to write frame to spool, dropping it: {}'.format(err))
+					else:
+						dst['spooled'] = True
+						return False
+				zmq_out['dropped'] += 1
+				zmq_out['dropped_bytes'] += len(frame)
+				return False
+			else:
+				zmq_out['sent'] += 1
+				zmq_out['sent_bytes'] += len(frame)
+				return True
+
+		def flush():
+			if state['timer']:
+				reactor.cancel(state['timer'])
+				state['timer'] = None
+			pos, count = state['pos'], state['count']
+			if pos == 1: return
+			raw_in['pkt'] += count
+			raw_in['bytes'] += pos - 1 - count * pcap.rec_hdr.size
+			if not part: bodies = [memoryview(batch)[1:pos]]
+			else:
+				bodies = part.split([(memoryview(batch)[:pos], pcap.index(batch, 1, pos))])
+				bodies = list(memoryview(body) if count else None for body, count in bodies)
+			state['pos'] = 1
+			state['count'] = 0
+			for dst, body in zip(dsts, bodies):
+				if body is None: continue
+				if dst['capture_ts'] is None: dst['capture_ts'] = state['capture_ts']
+				if dst['shaper']: frame = dst['shaper'].send(body.tobytes())
+				elif part: frame = wire.frame(body.tobytes())
+				else: frame = memoryview(batch)[:pos] # copied by zmq
+				if frame is not None: send(dst, frame)
+
+		def read():
+			# Packets yielded by netlink backend are only valid until next iteration,
+			#  so these are copied into the batch right away, and None marks the point
+			#  where all buffered netlink datagrams were processed and recv() would block
+			for pkt in src:
+				if pkt is None: break
+				pkt, pkt_len, ts = pkt
+				if cutoff is not None:
+					pkt = cutoff.filter(pkt, pkt_len, ts)
 					if pkt is None: continue
+					pkt, pkt_len = pkt
+				if state['pos'] == 1:
+					state['capture_ts'] = ts or time()
+					if optz.batch_size: state['timer'] = reactor.call_later(optz.batch_latency, flush)
+				state['pos'] = pcap.construct_into( batch,
+					state['pos'], pkt, pkt_len=pkt_len, ts=ts )
+				state['count'] += 1
+				if state['pos'] > optz.batch_size: flush()
+			else: # source exhausted
+				flush()
+				reactor.stop()
+
+		def replay():
+			# Frames from spool are sent only if no live ones were spooled since last call,
+			#  and only while socket is writable, up to --spool-rate bytes/s for each destination
+			ts, rate = time(), optz.spool_rate * 2**20
+			for dst in dsts:
+				spool, spooled, dst['spooled'] = dst['spool'], dst['spooled'], False
+				ts_last, dst['replay_ts'] = dst['replay_ts'], ts
+				if spool is None or spooled or not spool.frames: continue
+				budget = rate * min(ts - ts_last, optz.spool_interval * 2) if rate else None
+				sent = False
+				try:
+					while spool.frames and (budget is None or budget > 0):
+						if not dst['sock'].getsockopt(zmq.EVENTS) & zmq.POLLOUT: break
+						frame, capture_ts = spool.peek()
+						if not send(dst, frame, capture_ts): break
+						spool.pop()
+						sent = True
+						if budget is not None: budget -= len(frame)
+				except (OSError, IOError) as err:
+					log.error('Failed to read frame from spool: {}'.format(err))
+				if sent and ts - dst['spool_save_ts'] > 1.0:
+					spool.save()
+					dst['spool_save_ts'] = ts
 
-				try: dst.send(pkt, zmq.NOBLOCK)
-				except zmq.ZMQError as err:
-					if err.errno != zmq.EAGAIN: raise
+		def shaper_tick():
+			for dst in dsts:
+				frame = dst['shaper'].send(None)
+				if frame is not None: send(dst, frame)
+
+		if src_fd is not None: reactor.add_reader(src_fd, read)
+		else: reactor.call_every(0, read) # synthetic source, always "readable"
+		if shapers[0] and optz.wm_latency: reactor.call_every(optz.wm_latency / 2.0, shaper_tick)
+		if optz.spool: reactor.call_every(optz.spool_interval, replay)
+
+		log.debug('Entering NFLOG reader loop (groups: {})'.format(groups))
+		reactor.run()
 
 	finally:
 		log.debug('Finishing')
+		for dst in dsts:
+			dst['sock'].close()
+			if dst['spool'] is not None: dst['spool'].close()
 		context.term()
 
+
 if __name__ == '__main__': main()
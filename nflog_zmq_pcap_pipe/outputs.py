@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'''Receiver outputs - fifos, rotating pcap files, indexed archive and zmq PUB socket,
+	each with its own bounded queue and writer thread, so that
+	one slow consumer can't stall others or the receiving loop.'''
+
+import itertools as it, operator as op, functools as ft
+from time import time, sleep
+from collections import deque
+import os, threading, logging
+import pcap, wire, archive
+
+import zmq
+
+log = logging.getLogger('outputs')
+
+policies = 'drop-new', 'drop-old', 'block'
+
+
+class OutputError(Exception): pass
+
+
+def add_output_optz(parser):
+	parser.add_argument('-o', '--output', action='append', metavar='spec', default=list(),
+		help='Destination to write pcap stream to, can be specified multiple times.'
+			' Format is "[type:]target[,key=value...]", with following types:'
+			' "fifo:path" (default type) - pcap stream to a fifo, re-opened if reader goes away;'
+			' "file:path[,size=MiB][,count=N]" - pcap files of up to specified size'
+				' (default: 100 MiB), rotated to path.1, path.2, ..., keeping N (default: 10) old ones;'
+			' "pub:zmq-addr[,hwm=N]" - wire-format frames (one per batch, uncompressed)'
+				' on zmq PUB socket bound to specified address.'
+			' Common keys: "name" (for metrics, default: outN), "queue" (MiB) and'
+				' "policy" - override --output-queue and --output-policy for this output,'
+				' "group" - name of the group of outputs to split traffic between by flow'
+				' (see --partition-* options), instead of writing all of it to each one.')
+	parser.add_argument('--output-queue',
+		type=float, metavar='MiB', default=16.0,
+		help='Size of the queue for each output, which its writer thread'
+			' reads batches of packets from (default: %(default)s).')
+	parser.add_argument('--output-buffer',
+		type=float, metavar='KiB', default=256.0,
+		help='Size of the buffer to accumulate data for fifo/file outputs in, to'
+			' write it with as few syscalls as possible (default: %(default)s).')
+	parser.add_argument('--output-latency',
+		type=float, metavar='seconds', default=0.05,
+		help='Max time to keep data in fifo/file output buffer before writing'
+			' it out, if buffer does not fill up (default: %(default)s, 0 - no buffering).')
+	parser.add_argument('--output-policy',
+		metavar='name', choices=policies, default='drop-new',
+		help='What to do when output queue is full: "drop-new" - discard'
+				' incoming batches, "drop-old" - discard oldest queued ones,'
+				' "block" - wait for space, stalling all outputs'
+				' and the receiving socket (default: %(default)s).'
+			' Either way, dropped batches are counted in output.*.dropped metrics.')
+
+def parse_spec(spec):
+	'Returns (type, target, opts) tuple for the "[type:]target[,key=value...]" output spec.'
+	spec = spec.split(',')
+	otype, target = spec[0].split(':', 1) if ':' in spec[0] else ('fifo', spec[0])
+	if otype not in output_types:
+		otype, target = 'fifo', spec[0] # e.g. path with colon in it
+	opts = dict()
+	for opt in spec[1:]:
+		if '=' not in opt: raise OutputError('Invalid output option: {!r}'.format(opt))
+		k, v = opt.split('=', 1)
+		opts[k.strip()] = v.strip()
+	return otype, target, opts
+
+def outputs_from_optz(optz, context, registry=None):
+	'''Returns list of (not yet started) outputs for -o/--output options,
+		with their counters and queue gauges registered in metrics Registry.'''
+	outputs = list()
+	for n, spec in enumerate(optz.output):
+		otype, target, opts = parse_spec(spec)
+		name = opts.pop('name', 'out{}'.format(n))
+		kws = dict( name=name, group=opts.pop('group', None),
+			queue_size=int(float(opts.pop('queue', optz.output_queue)) * 2**20),
+			policy=opts.pop('policy', optz.output_policy),
+			stats=registry.counters('output.{}'.format(name)) if registry else None )
+		try:
+			if otype in ['fifo', 'file', 'archive']:
+				kws.update( buffer_size=int(optz.output_buffer * 2**10),
+					latency=optz.output_latency )
+			if otype == 'file':
+				kws.update( size=int(float(opts.pop('size', 100)) * 2**20),
+					count=int(opts.pop('count', 10)) )
+			elif otype == 'archive':
+				budget = opts.pop('budget', None)
+				kws.update( segment_size=int(float(opts.pop('segment', 256)) * 2**20),
+					segment_time=float(opts.pop('period', 3600)),
+					budget=budget and int(float(budget) * 2**30),
+					hosts=opts.pop('hosts', '0').lower() in ['1', 'yes', 'true'] )
+				# Segments are written sequentially, in chunks of at least 1 MiB
+				kws['buffer_size'] = max(kws['buffer_size'], 2**20)
+			elif otype == 'pub': kws.update(context=context, hwm=int(opts.pop('hwm', 100)))
+		except ValueError as err: raise OutputError('Invalid output option value: {}'.format(err))
+		if opts: raise OutputError('Unknown {} output option(s): {}'.format(otype, ', '.join(opts)))
+		output = output_types[otype](target, **kws)
+		if registry:
+			registry.gauges['output.{}.queue_batches'.format(name)] = output.queue.__len__
+			registry.gauges['output.{}.queue_bytes'.format(name)] = lambda o=output: o.queue_bytes
+			registry.gauges['output.{}.lag'.format(name)] = output.lag
+		outputs.append(output)
+	return outputs
+
+
+class Output(threading.Thread):
+	'''Base class for outputs - daemon thread, writing batches
+			of pcap records from a bounded queue to some destination.
+		Subclasses implement open(), write(bodies) and close() methods,
+			which can raise IOError/OSError/ZMQError on failures, after which
+			destination is closed and re-opened in "retry_delay" seconds,
+			retrying the batch that was being written.
+		Queue size is limited by the total size of queued batches,
+			with "policy" (see "policies") defining what to do when it's full.
+		"group" is only used by the caller, to split traffic between outputs in it.'''
+
+	retry_delay = 1.0
+
+	def __init__(self, name, queue_size=16 * 2**20, policy='drop-new', stats=None, group=None):
+		super(Output, self).__init__(name=name)
+		self.daemon, self.group = True, group
+		if policy not in policies: raise OutputError('Unknown queue policy: {}'.format(policy))
+		self.queue, self.queue_size, self.queue_bytes, self.policy = deque(), queue_size, 0, policy
+		self.cond, self.stopping = threading.Condition(), False
+		self.stats = stats if stats is not None else dict()
+		for k in 'batches', 'pkt', 'bytes', 'dropped', 'dropped_pkt', 'dropped_bytes', 'errors':
+			self.stats.setdefault(k, 0)
+
+	def __str__(self): return self.name
+
+	def put(self, bodies, count, ts=None):
+		'''Queues list of pcap record batches ("count" packets in total),
+				received at "ts" (default - now), applying drop policy if queue is full.
+			Never blocks, unless "block" policy is used.'''
+		size = sum(it.imap(len, bodies))
+		with self.cond:
+			while self.queue and self.queue_bytes + size > self.queue_size:
+				if self.policy == 'drop-new': return self._drop(count, size)
+				elif self.policy == 'drop-old':
+					ts_old, bodies_old, count_old, size_old = self.queue.popleft()
+					self.queue_bytes -= size_old
+					self._drop(count_old, size_old)
+				else: self.cond.wait()
+			self.queue.append((ts or time(), bodies, count, size))
+			self.queue_bytes += size
+			self.cond.notify_all()
+
+	def _drop(self, count, size):
+		self.stats['dropped'] += 1
+		self.stats['dropped_pkt'] += count
+		self.stats['dropped_bytes'] += size
+
+	def lag(self):
+		'Returns time (seconds) that the oldest queued batch has been waiting for.'
+		try: return time() - self.queue[0][0]
+		except IndexError: return 0
+
+	def stop(self, timeout=2.0):
+		'Stops thread after writing out all queued batches, waiting up to "timeout" for it.'
+		with self.cond:
+			self.stopping = True
+			self.cond.notify_all()
+		self.join(timeout)
+
+	def run(self):
+		stats, opened, batch = self.stats, False, None
+		while True:
+			if batch is None:
+				with self.cond:
+					while not self.queue and not self.stopping:
+						delay = self.flush_delay() if opened else None
+						if delay is not None and delay <= 0: break
+						self.cond.wait(delay)
+					if self.queue:
+						batch = self.queue.popleft()
+						self.queue_bytes -= batch[3]
+						self.cond.notify_all()
+					elif self.stopping: break
+			try:
+				if not opened:
+					self.open()
+					opened = True
+					log.debug('(Re-)opened output: {}'.format(self))
+				if batch is None: self.flush() # latency deadline
+				else: self.write(batch[1])
+			except (EnvironmentError, zmq.ZMQError) as err:
+				log.warn('Failed to write to output {}: {}'.format(self, err))
+				stats['errors'] += 1
+				if opened:
+					try: self.close()
+					except (EnvironmentError, zmq.ZMQError): pass
+					opened = False
+				if self.stopping: break
+				sleep(self.retry_delay)
+				continue
+			if batch is not None:
+				ts, bodies, count, size = batch
+				stats['batches'] += 1
+				stats['pkt'] += count
+				stats['bytes'] += size
+				batch = None
+		if opened:
+			try:
+				self.flush()
+				self.close()
+			except (EnvironmentError, zmq.ZMQError) as err:
+				log.warn('Failed to close output {}: {}'.format(self, err))
+
+	def open(self): raise NotImplementedError
+	def write(self, bodies): raise NotImplementedError
+	def close(self): raise NotImplementedError
+
+	def flush(self): pass
+	def flush_delay(self):
+		'Returns seconds until flush() should be called, if there is any buffered data.'
+		return None
+
+
+class PcapOutput(Output):
+	'''Base for outputs writing pcap stream to a file descriptor via pcap.BatchWriter,
+		with data flushed when "buffer_size" bytes are buffered or after "latency" seconds.'''
+
+	def __init__(self, path, buffer_size=256 * 2**10, latency=0.05, **kws):
+		super(PcapOutput, self).__init__(**kws)
+		self.path, self.buffer_size, self.latency = path, buffer_size, latency
+		self.fd = self.dst = None
+
+	def open(self):
+		self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+		self.dst = pcap.BatchWriter(self.fd, self.buffer_size, self.latency)
+
+	def write(self, bodies): return self.dst.write(bodies)
+
+	def flush(self): self.dst.flush()
+	def flush_delay(self): return self.dst.delay()
+
+	def close(self):
+		fd, self.fd, self.dst = self.fd, None, None
+		if fd is not None: os.close(fd)
+
+
+class FifoOutput(PcapOutput):
+	'''Writes pcap stream to a fifo (or any other path, overwriting it),
+		re-opening it (and writing new pcap header) if reader goes away.'''
+
+	def __str__(self): return '{} (fifo: {})'.format(self.name, self.path)
+
+
+class RotatingFileOutput(PcapOutput):
+	'''Writes pcap files of up to "size" bytes, renaming full ones to
+		path.1, path.2, ... (most recent first), keeping up to "count" of these.
+		Existing non-empty file is rotated on open, to always start with a pcap header.'''
+
+	def __init__(self, path, size=100 * 2**20, count=10, **kws):
+		super(RotatingFileOutput, self).__init__(path, **kws)
+		self.size, self.count = size, count
+
+	def __str__(self): return '{} (file: {})'.format(self.name, self.path)
+
+	def rotate(self):
+		path = self.path
+		if self.count <= 0: os.unlink(path)
+		else:
+			for n in xrange(self.count - 1, 0, -1):
+				if os.path.exists('{}.{}'.format(path, n)):
+					os.rename('{}.{}'.format(path, n), '{}.{}'.format(path, n + 1))
+			os.rename(path, '{}.1'.format(path))
+
+	def open(self):
+		if os.path.exists(self.path) and os.stat(self.path).st_size > 0: self.rotate()
+		super(RotatingFileOutput, self).open()
+		self.written = 0
+
+	def write(self, bodies):
+		self.written += super(RotatingFileOutput, self).write(bodies)
+		if self.written >= self.size:
+			self.flush()
+			self.close()
+			self.open()
+
+
+class ArchiveOutput(Output):
+	'''Writes pcap records to archive.Archive - directory of indexed pcap segments,
+		rotated and expired by size/age and total disk budget, see that class for details.'''
+
+	def __init__( self, path, segment_size=256 * 2**20, segment_time=3600,
+			budget=None, hosts=False, buffer_size=2**20, latency=0.05, **kws ):
+		super(ArchiveOutput, self).__init__(**kws)
+		self.path, self.archive = path, archive.Archive( path,
+			segment_size=segment_size, segment_time=segment_time, budget=budget,
+			hosts=hosts, buffer_size=buffer_size, latency=latency )
+
+	def __str__(self): return '{} (archive: {})'.format(self.name, self.path)
+
+	def open(self): self.archive.open()
+	def write(self, bodies): return self.archive.write(bodies)
+	def close(self): self.archive.close()
+
+	def flush(self): self.archive.flush()
+	def flush_delay(self): return self.archive.delay()
+
+
+class PubOutput(Output):
+	'''Re-exports batches as uncompressed wire-format frames (one per batch) on zmq PUB socket.
+		Socket is created and bound in the writer thread, as zmq sockets
+			should not be shared between threads, and PUB drops messages for
+			subscribers that are "hwm" messages behind on its own anyway.'''
+
+	def __init__(self, addr, context, hwm=100, **kws):
+		super(PubOutput, self).__init__(**kws)
+		self.addr, self.context, self.hwm, self.sock = addr, context, hwm, None
+
+	def __str__(self): return '{} (pub: {})'.format(self.name, self.addr)
+
+	def open(self):
+		self.sock = self.context.socket(zmq.PUB)
+		self.sock.setsockopt(zmq.SNDHWM, self.hwm)
+		self.sock.setsockopt(zmq.LINGER, 0)
+		self.sock.bind(self.addr)
+
+	def write(self, bodies):
+		for body in bodies: self.sock.send(wire.frame(body))
+
+	def close(self):
+		sock, self.sock = self.sock, None
+		if sock: sock.close()
+
+
+output_types = dict( fifo=FifoOutput,
+	file=RotatingFileOutput, archive=ArchiveOutput, pub=PubOutput )
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'''Flow-consistent partitioning of pcap record batches between N destinations
+	(e.g. fifos of separate single-threaded IDS instances), by symmetric hash
+	of the flow, so that packets going both ways land in the same one.'''
+
+import itertools as it, operator as op, functools as ft
+from array import array
+import struct, zlib, logging
+import pcap, flows
+
+log = logging.getLogger('partition')
+
+keys = 'flow', 'hosts'
+ports = struct.Struct('!BHH')
+
+
+def add_partition_optz(parser):
+	parser.add_argument('--partition-key',
+		metavar='name', choices=keys, default='flow',
+		help='What to hash to pick partition for each packet: "flow" - protocol,'
+				' addresses and ports, "hosts" - only protocol and addresses, so that'
+				' all fragments of fragmented packets end up in the same partition'
+				' (with "flow", non-first fragments can go to a different one, as they'
+				' have no ports in them). Either way, hash is the same for both'
+				' directions of the flow (default: %(default)s).')
+	parser.add_argument('--partition-buckets',
+		type=int, metavar='count', default=1024,
+		help='Number of hash buckets, which are distributed between'
+			' partitions and can be moved between these on rebalancing (default: %(default)s).')
+	parser.add_argument('--partition-rebalance',
+		type=float, metavar='ratio',
+		help='Move hottest buckets from the most loaded partition to least loaded one(s)'
+				' when load (bytes) of the former is above mean load multiplied by this ratio'
+				' (e.g. 1.5), checked every --partition-interval seconds.'
+			' Flows in moved buckets will be seen mid-stream by the new destination.'
+			' Default is to never move buckets.')
+	parser.add_argument('--partition-interval',
+		type=float, metavar='seconds', default=10.0,
+		help='Interval to measure load of partitions over'
+			' (and rebalance these, if enabled, default: %(default)s).')
+
+def partitioner_from_optz(optz, count, name, registry=None):
+	'''Returns Partitioner for specified number of partitions,
+		with counters for each partition (as "partition.<name>.<n>.*")
+		and imbalance gauge registered in metrics Registry.'''
+	stats = registry.counters('partition.{}'.format(name), ['moves']) if registry else None
+	part = Partitioner( count, buckets=optz.partition_buckets,
+		key=optz.partition_key, threshold=optz.partition_rebalance, stats=stats )
+	if registry:
+		for n, part_stats in enumerate(part.part_stats):
+			registry.counters('partition.{}.{}'.format(name, n), stats=part_stats)
+		registry.gauges['partition.{}.imbalance'.format(name)] = lambda: part.imbalance
+	return part
+
+
+def flow_hash(buff, pos, end, key='flow'):
+	'''Returns direction-independent hash of the IPv4/IPv6 packet
+			flow in buff[pos:end], or 0 for packets that can't be parsed.
+		"key" can be "flow" (protocol, addresses, ports) or "hosts" (no ports).'''
+	flow = flows.parse(buff, pos, end)
+	if not flow: return 0
+	proto, src, dst, sport, dport = flow
+	if key != 'flow': sport = dport = 0
+	if (src, sport) > (dst, dport): src, dst, sport, dport = dst, src, dport, sport
+	return zlib.crc32(src + dst + ports.pack(proto, sport, dport)) & 0xffffffff
+
+
+class Partitioner(object):
+	'''Splits batches of pcap records between "count" partitions by flow hash,
+			via a table of "buckets" (hash modulo number of these, assigned to
+			partitions round-robin initially), counting bytes passed through each bucket.
+		rebalance() should be called periodically (every measurement interval),
+			to calculate imbalance (max / mean partition load) for that interval and,
+			if it's above "threshold", move hottest buckets that fit into the difference
+			from the most loaded partition to the least loaded one, until it's not.'''
+
+	max_moves = 32 # per rebalance() call
+
+	def __init__(self, count, buckets=1024, key='flow', threshold=None, stats=None):
+		if count < 1: raise ValueError('Number of partitions must be positive')
+		if key not in keys: raise ValueError('Unknown partition key: {}'.format(key))
+		self.count, self.key, self.threshold = count, key, threshold
+		buckets = max(buckets, count)
+		self.table = array('H', (n % count for n in xrange(buckets)))
+		self.load = array('L', [0]) * buckets # bytes since last rebalance
+		self.imbalance = None
+		self.stats = stats if stats is not None else dict()
+		self.stats.setdefault('moves', 0)
+		self.part_stats = list(dict(pkt=0, bytes=0) for n in xrange(count))
+
+	def split(self, batches):
+		'''Splits list of (body, offsets) tuples (see pcap.index) into per-partition bodies.
+			Returns list of (body, packet_count) for each partition,
+				where body is a bytearray of concatenated records, possibly empty.'''
+		table, load, nb, key = self.table, self.load, len(self.table), self.key
+		hdr_size = pcap.rec_hdr.size
+		parts = list(bytearray() for n in xrange(self.count))
+		counts = [0] * self.count
+		for body, offsets in batches:
+			view, body_len = memoryview(body), len(body)
+			run_part = run_pos = None # consecutive records going to the same partition
+			for pos, end in it.izip(offsets, it.chain(it.islice(offsets, 1, None), [body_len])):
+				b = flow_hash(view, pos + hdr_size, end, key) % nb
+				n = table[b]
+				load[b] += end - pos
+				counts[n] += 1
+				if n != run_part:
+					if run_part is not None: parts[run_part] += view[run_pos:pos]
+					run_part, run_pos = n, pos
+			if run_part is not None: parts[run_part] += view[run_pos:body_len]
+		for n, stats in enumerate(self.part_stats):
+			stats['pkt'] += counts[n]
+			stats['bytes'] += len(parts[n])
+		return zip(parts, counts)
+
+	def rebalance(self):
+		table, load, count = self.table, self.load, self.count
+		part_load = [0] * count
+		for b, n in enumerate(table): part_load[n] += load[b]
+		total = sum(part_load)
+		if not total:
+			self.imbalance = None
+			return
+		mean = total / float(count)
+		self.imbalance = max(part_load) / mean
+
+		moves = 0
+		while self.threshold and moves < self.max_moves:
+			hot = max(xrange(count), key=part_load.__getitem__)
+			if part_load[hot] <= mean * self.threshold: break
+			cold = min(xrange(count), key=part_load.__getitem__)
+			# Largest bucket that reduces the difference without making "cold" the hottest one
+			diff, bucket = part_load[hot] - part_load[cold], None
+			for b, n in enumerate(table):
+				if n == hot and 0 < load[b] < diff and (bucket is None or load[b] > load[bucket]):
+					bucket = b
+			if bucket is None: break
+			table[bucket] = cold
+			part_load[hot] -= load[bucket]
+			part_load[cold] += load[bucket]
+			moves += 1
+		if moves:
+			log.debug( 'Moved {} bucket(s) between partitions, imbalance:'
+				' {:.2f} -> {:.2f}'.format(moves, self.imbalance, max(part_load) / mean) )
+			self.stats['moves'] += moves
+
+		for b in xrange(len(load)): load[b] = 0
@@ -4,48 +4,190 @@ from __future__ import print_function
 import itertools as it, operator as op, functools as ft
 from time import time, timezone
 from collections import namedtuple
-import xdrlib, logging
+from array import array
+import os, errno, select, struct
 
-'Simple pcap generator'
+'''Simple pcap generator.
+
+	Packets are serialized into ready-to-write pcap records - little-endian
+		record header (ts_sec, ts_usec, incl_len, orig_len) followed by payload,
+		so batches of these are just concatenated records, which can be
+		split without any extra framing and dumped as-is after global header.'''
 
 
 Packet = namedtuple('Packet', 'ts_s ts_us len dump')
 
+rec_hdr = struct.Struct('<IIII')
+
+
+def construct_into(buff, pos, pkt, pkt_len=None, ts=None):
+	'''Pack pcap record for a packet into bytearray buff at pos,
+		extending it if necessary. Returns offset of the record end.'''
+	ts = ts or time()
+	ts_sec = int(ts)
+	incl_len = len(pkt)
+	pkt_end = pos + rec_hdr.size + incl_len
+	if len(buff) < pkt_end: buff.extend(b'\0' * (pkt_end - len(buff)))
+	rec_hdr.pack_into( buff, pos, ts_sec,
+		int((ts - ts_sec) * 1e6), incl_len, pkt_len or incl_len )
+	buff[pos + rec_hdr.size:pkt_end] = pkt
+	return pkt_end
 
 def construct(pkt, pkt_len=None, ts=None):
 	ts = ts or time()
 	ts_sec = int(ts)
-	ts_usec = int((ts - ts_sec) * 1e6)
-	metadata = [ts_sec, ts_usec, pkt_len or 0]
-	dump = xdrlib.Packer()
-	try:
-		dump.pack_farray(3, metadata, dump.pack_uint)
-		dump.pack_bytes(pkt)
-	except xdrlib.Error as err:
-		logging.getLogger('pcap_serializer')\
-			.exception( 'Failed to serialize packet (metadata: %r,'
-				' bytes: %s), skipping: %s %s', metadata, len(pkt), type(err), err )
-		return
-	return dump.get_buffer()
+	return rec_hdr.pack( ts_sec,
+		int((ts - ts_sec) * 1e6), len(pkt), pkt_len or len(pkt) ) + pkt
+
+def construct_batch(pkts, buff=None, pos=0):
+	'''Pack iterable of (pkt, pkt_len, ts) tuples into (preallocated) bytearray.
+		Returns buffer and offset of the last record end in it.'''
+	if buff is None: buff = bytearray()
+	for pkt, pkt_len, ts in pkts: pos = construct_into(buff, pos, pkt, pkt_len, ts)
+	return buff, pos
+
+
+def index(buff, pos=0, end=None, offsets=None):
+	'''Returns array with offsets of all records in buff[pos:end],
+		reusing (clearing) passed "offsets" array, if any.
+		Raises ValueError if last record is truncated.'''
+	if end is None: end = len(buff)
+	if offsets is None: offsets = array('L')
+	else: del offsets[:]
+	hdr_size, unpack = rec_hdr.size, rec_hdr.unpack_from
+	while pos + hdr_size <= end:
+		offsets.append(pos)
+		pos += hdr_size + unpack(buff, pos)[2]
+	if pos != end:
+		raise ValueError( 'Truncated pcap record'
+			' at the end of a batch (parsed up to: {}, end: {})'.format(pos, end) )
+	return offsets
+
+def split(buff, pos=0, end=None):
+	'Returns list of separate records from buff.'
+	offsets = index(buff, pos, end)
+	return list( buff[a:b] for a, b in
+		it.izip(offsets, it.chain(it.islice(offsets, 1, None), [end or len(buff)])) )
 
 
 def loads(dump):
-	dump = xdrlib.Unpacker(dump)
-	ts_s, ts_us, pkt_len = dump.unpack_farray(3, dump.unpack_uint)
-	pkt = dump.unpack_bytes()
-	dump.done()
-	return Packet(ts_s, ts_us, pkt_len, pkt)
+	ts_s, ts_us, pkt_len, orig_len = rec_hdr.unpack_from(dump)
+	pkt = dump[rec_hdr.size:rec_hdr.size + pkt_len]
+	return Packet(ts_s, ts_us, orig_len, pkt)
 
 
+# Link-layer header types that can be stripped to get raw IP packets, with header lengths
+linktypes_raw = frozenset([12, 101, 228, 229]) # raw, raw, ipv4, ipv6
+linktypes_l2 = {1: 14, 113: 16, 276: 20} # ethernet, linux sll, linux sll2
+ethertypes_ip = frozenset([0x0800, 0x86dd])
+
+def reader(src):
+	'''Generator yielding (ts, incl_len, orig_len, pkt) tuples for records from
+			pcap file object, with pkt being a raw IP packet (linktype 12, as in writer()),
+			with link-layer headers stripped and non-IP packets skipped.
+		Raises ValueError for unsupported files.'''
+	hdr = src.read(24)
+	if len(hdr) < 24: raise ValueError('Truncated pcap file header')
+	for endian in '<>':
+		magic, = struct.unpack(endian + 'I', hdr[:4])
+		if magic in (0xa1b2c3d4, 0xa1b23c4d): break
+	else: raise ValueError('Unrecognized pcap file magic: {!r}'.format(hdr[:4]))
+	ts_div = 1e6 if magic == 0xa1b2c3d4 else 1e9
+	linktype = struct.unpack(endian + 'I', hdr[20:24])[0] & 0xffff
+	if linktype in linktypes_raw: l2_len = 0
+	else:
+		try: l2_len = linktypes_l2[linktype]
+		except KeyError: raise ValueError('Unsupported pcap linktype: {}'.format(linktype))
+	hdr_fmt = struct.Struct(endian + 'IIII')
+	while True:
+		hdr = src.read(hdr_fmt.size)
+		if len(hdr) < hdr_fmt.size: break
+		ts_s, ts_frac, incl_len, orig_len = hdr_fmt.unpack(hdr)
+		pkt = src.read(incl_len)
+		if len(pkt) < incl_len: break
+		if l2_len:
+			if incl_len < l2_len: continue
+			pos = l2_len
+			ethertype, = struct.unpack('!H', pkt[pos-2:pos])
+			if linktype == 276: ethertype, = struct.unpack('!H', pkt[:2])
+			while ethertype in (0x8100, 0x88a8) and linktype == 1 and len(pkt) >= pos + 4: # vlan tags
+				ethertype, = struct.unpack('!H', pkt[pos+2:pos+4])
+				pos += 4
+			if ethertype not in ethertypes_ip: continue
+			pkt, incl_len, orig_len = pkt[pos:], incl_len - pos, orig_len - pos
+		yield ts_s + ts_frac / ts_div, incl_len, orig_len, pkt
+
+
+def file_header(utc=True, snaplen=65535):
+	return struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0 if utc else timezone, 0, snaplen, 12)
+
 def writer(write, opaque=True, utc=True, snaplen=65535):
-	from struct import pack
-	write(pack( '=IHHiIII',
-		0xa1b2c3d4, 2, 4, 0 if utc else timezone, 0, snaplen, 12 ))
+	'''Pcap stream writer coroutine.
+		If "opaque" is set (default), accepts serialized records
+			(any number of them concatenated), which are written as-is,
+			otherwise expects Packet tuples.
+		Returns number of bytes written for each sent item.'''
+	write(file_header(utc, snaplen))
 	pkt_out = None
 	while True:
 		pkt = yield pkt_out
-		pkt = loads(pkt) if opaque else pkt
-		pkt_len = len(pkt.dump)
-		pkt = pack('=IIII', pkt.ts_s, pkt.ts_us, pkt_len, pkt.len or pkt_len), pkt.dump
-		pkt_out = sum(it.imap(len, pkt))
-		for pkt in pkt: write(pkt)
+		if not opaque:
+			pkt = rec_hdr.pack(pkt.ts_s, pkt.ts_us, len(pkt.dump), pkt.len or len(pkt.dump)) + pkt.dump
+		write(pkt)
+		pkt_out = len(pkt)
+
+
+class BatchWriter(object):
+	'''Pcap stream writer for a file descriptor, coalescing
+			batches of records (e.g. all frames from a zmq message)
+			in a preallocated buffer, to write these with as few syscalls as possible.
+		Buffer is written out when it's over "size" bytes, or on flush(),
+			which should be called (e.g. from a timer) when delay() reaches zero,
+			i.e. "latency" seconds after the oldest buffered data was added.
+		Batches larger than buffer size are written directly, without copying.
+		Partial writes (e.g. to a fifo with slow reader or O_NONBLOCK set) are retried
+			for the remainder, waiting for fd to become writable on EAGAIN.'''
+
+	def __init__(self, fd, size=256 * 2**10, latency=0.05, utc=True, snaplen=65535):
+		self.fd, self.size, self.latency = fd, size, latency
+		self.buff, self.pos, self.ts = bytearray(size), 0, None
+		self.syscalls = 0
+		self.write([file_header(utc, snaplen)])
+
+	def delay(self):
+		'Returns seconds until buffered data should be flushed, or None if there is none.'
+		if self.ts is None: return None
+		return self.ts + self.latency - time()
+
+	def write(self, bodies):
+		'Adds batches of records from a list, returning their total size in bytes.'
+		buff, size, bs = self.buff, self.size, 0
+		for body in bodies:
+			body_len = len(body)
+			bs += body_len
+			if self.pos + body_len > size:
+				self.flush()
+				if body_len >= size:
+					self._write(body)
+					continue
+			if self.ts is None: self.ts = time()
+			buff[self.pos:self.pos + body_len] = body
+			self.pos += body_len
+		if self.pos >= size or not self.latency: self.flush()
+		return bs
+
+	def flush(self):
+		if self.pos: self._write(memoryview(self.buff)[:self.pos])
+		self.pos, self.ts = 0, None
+
+	def _write(self, buff):
+		buff, fd = memoryview(buff), self.fd
+		while buff:
+			self.syscalls += 1
+			try: n = os.write(fd, buff)
+			except OSError as err:
+				if err.errno == errno.EINTR: continue
+				if err.errno != errno.EAGAIN: raise
+				select.select([], [fd], [])
+				continue
+			buff = buff[n:]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'''Minimal event loop around zmq.Poller, multiplexing zmq sockets,
+	plain fds (e.g. netlink one from nflog_generator) and timers.'''
+
+import itertools as it, operator as op, functools as ft
+from time import time
+import math, heapq, errno, logging
+
+import zmq
+
+log = logging.getLogger('reactor')
+
+
+class Timer(object):
+
+	__slots__ = 'ts', 'interval', 'callback', 'args', 'active'
+
+	def __init__(self, ts, interval, callback, args):
+		self.ts, self.interval, self.callback, self.args = ts, interval, callback, args
+		self.active = True
+
+	def __repr__(self):
+		return '<Timer {} ts={:.3f} interval={}>'.format(
+			getattr(self.callback, '__name__', self.callback), self.ts, self.interval )
+
+
+class Reactor(object):
+	'''Single-threaded loop, calling registered callbacks when
+			sockets/fds are readable and timer callbacks when these are due.
+		Timers are checked after every poll(), so these are never
+			starved by constant traffic, and are run after readers
+			on the same iteration, i.e. see everything that was read by then.
+		Callbacks are called without arguments other than ones passed
+			on registration, and exceptions raised in these break the loop.
+		Loop exits on stop() or when there is nothing left to wait for.'''
+
+	def __init__(self):
+		self.poller, self.readers = zmq.Poller(), dict()
+		self.timers, self.timer_seq = list(), it.count()
+		self.running = False
+
+	def add_reader(self, sock, callback, *args):
+		'Registers zmq socket, fd or object with fileno() to call callback(*args) when readable.'
+		sock = self._fd(sock)
+		self.poller.register(sock, zmq.POLLIN)
+		self.readers[sock] = callback, args
+
+	def remove_reader(self, sock):
+		sock = self._fd(sock)
+		if self.readers.pop(sock, None): self.poller.unregister(sock)
+
+	def _fd(self, sock):
+		# poll() returns plain fds for anything that is not a zmq socket
+		if isinstance(sock, zmq.Socket) or not hasattr(sock, 'fileno'): return sock
+		return sock.fileno()
+
+	def call_later(self, delay, callback, *args):
+		'Returns Timer that calls callback(*args) once after "delay" seconds, unless cancelled.'
+		return self._schedule(Timer(time() + delay, None, callback, args))
+
+	def call_every(self, interval, callback, *args):
+		'''Returns Timer that calls callback(*args) every "interval" seconds until cancelled.
+			Intervals missed due to slow callbacks are skipped, not run in a burst.
+			Zero interval runs callback on every loop iteration, without blocking in poll().'''
+		return self._schedule(Timer(time() + interval, interval, callback, args))
+
+	def cancel(self, timer):
+		timer.active = False # discarded from heap lazily
+
+	def _schedule(self, timer):
+		heapq.heappush(self.timers, (timer.ts, next(self.timer_seq), timer))
+		return timer
+
+	def _run_timers(self):
+		# Due timers are popped before running any, so that
+		#  re-scheduled ones (e.g. with zero interval) only run once per iteration
+		timers, ts_now, due = self.timers, time(), list()
+		while timers and timers[0][0] <= ts_now:
+			timer = heapq.heappop(timers)[2]
+			if timer.active: due.append(timer)
+		for timer in due:
+			if timer.interval is None: continue
+			timer.ts = max(timer.ts + timer.interval, ts_now)
+			self._schedule(timer)
+		for timer in due:
+			if not timer.active: continue # cancelled by other callback
+			if timer.interval is None: timer.active = False
+			timer.callback(*timer.args)
+			if not self.running: break
+
+	def _poll_timeout(self):
+		'Returns ms until nearest active timer (None if there are none), dropping cancelled ones.'
+		timers = self.timers
+		while timers and not timers[0][2].active: heapq.heappop(timers)
+		if not timers: return None
+		return max(0, int(math.ceil((timers[0][0] - time()) * 1000)))
+
+	def stop(self):
+		self.running = False
+
+	def run(self):
+		self.running = True
+		readers = self.readers
+		while self.running:
+			timeout = self._poll_timeout()
+			if timeout is None and not readers:
+				log.debug('Nothing to wait for, exiting loop')
+				break
+			try: events = self.poller.poll(timeout)
+			except zmq.ZMQError as err:
+				if err.errno != errno.EINTR: raise
+				events = list()
+			for sock, ev in events:
+				try: callback, args = readers[sock]
+				except KeyError: continue # removed by other callback
+				callback(*args)
+				if not self.running: break
+			else: self._run_timers()
+		self.running = False
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'Fixed-size ring buffer for serialized pcap records'
+
+import itertools as it, operator as op, functools as ft
+from bisect import bisect_left, bisect_right
+from array import array
+import pcap, flows
+
+
+class PacketRing(object):
+	'''Contiguous preallocated buffer of fixed size,
+			storing ready-to-write pcap records back-to-back,
+			with offsets/lengths of these (in insertion order) in compact arrays.
+		Records are never split - if one doesn't fit before the end of the buffer,
+			it is written at the start, so each one can always be sliced as-is.
+		Adding records evicts oldest ones as necessary by advancing the tail,
+			so memory usage never exceeds the size passed on init (+ index arrays).
+		Each record gets sequential number (seq) upon adding,
+			and records from seq_tail up to seq_head (exclusive) are stored.'''
+
+	def __init__(self, size):
+		self.size, self.buff = size, bytearray(size)
+		self.view = memoryview(self.buff)
+		self.offsets, self.lengths = array('L'), array('L')
+		self.arrays = [self.offsets, self.lengths] # all per-record arrays, compacted together
+		self.tail = 0 # index of the oldest record in offsets/lengths arrays
+		self.seq_base = 0 # seq of the first record in offsets/lengths arrays
+		self.head = 0 # buffer position to write next record at
+		self.used = 0 # bytes taken by stored records
+
+	@property
+	def seq_tail(self): return self.seq_base + self.tail
+	@property
+	def seq_head(self): return self.seq_base + len(self.offsets)
+
+	def __len__(self): return len(self.offsets) - self.tail
+
+	def _evict(self):
+		self.used -= self.lengths[self.tail]
+		self.tail += 1
+		if self.tail == len(self.offsets) or self.tail > max(1024, len(self.offsets) // 2):
+			for arr in self.arrays: del arr[:self.tail]
+			self.seq_base += self.tail
+			self.tail = 0
+
+	def add(self, rec):
+		'''Adds record (str/buffer/memoryview), returning its seq
+			or None if it's larger than the whole buffer and was skipped.'''
+		rec_len = len(rec)
+		if rec_len > self.size: return
+		pos, offsets = self.head, self.offsets
+		if pos + rec_len > self.size:
+			# Records between head and buffer end are the oldest ones
+			while self.tail < len(offsets) and offsets[self.tail] >= pos: self._evict()
+			pos = 0
+		pos_end = pos + rec_len
+		while self.tail < len(offsets) and pos <= offsets[self.tail] < pos_end: self._evict()
+		self.buff[pos:pos_end] = rec
+		offsets.append(pos)
+		self.lengths.append(rec_len)
+		self.head, self.used = pos_end, self.used + rec_len
+		return self.seq_head - 1
+
+	def add_batch(self, body, offsets):
+		'Adds all records from a batch body with specified offsets (see pcap.index).'
+		body = memoryview(body)
+		for a, b in it.izip(offsets, it.chain(it.islice(offsets, 1, None), [len(body)])):
+			self.add(body[a:b])
+
+	def get(self, seq):
+		'Returns memoryview of the record with specified seq, or None if it was evicted.'
+		n = seq - self.seq_base
+		if not self.tail <= n < len(self.offsets): return
+		pos = self.offsets[n]
+		return self.view[pos:pos + self.lengths[n]]
+
+	def __iter__(self):
+		'Yields memoryviews of all stored records, oldest to newest.'
+		view = self.view
+		for pos, rec_len in it.izip(
+				it.islice(self.offsets, self.tail, None),
+				it.islice(self.lengths, self.tail, None) ):
+			yield view[pos:pos + rec_len]
+
+
+class IndexedPacketRing(PacketRing):
+	'''PacketRing that also keeps per-record timestamp, protocol and ports,
+			and an index of record seqs for each src/dst address, to quickly query
+			records by time range (binary search) and host (hash lookup).
+		Records are expected to be raw IPv4/IPv6 packets in pcap records.'''
+
+	def __init__(self, size):
+		super(IndexedPacketRing, self).__init__(size)
+		self.ts, self.ts_max = array('d'), array('d')
+		self.protos, self.sports, self.dports = array('B'), array('H'), array('H')
+		self.arrays.extend([self.ts, self.ts_max, self.protos, self.sports, self.dports])
+		self.hosts, self.hosts_added = dict(), 0 # packed address -> array of seqs
+		self.ts_disorder = 0 # max lag of record timestamp behind newest one
+
+	def add(self, rec):
+		seq = super(IndexedPacketRing, self).add(rec)
+		if seq is None: return
+		ts_s, ts_us, incl_len, orig_len = pcap.rec_hdr.unpack_from(rec)
+		ts = ts_s + ts_us * 1e-6
+		ts_max = max(ts, self.ts_max[-1]) if len(self.ts_max) else ts
+		self.ts_disorder = max(self.ts_disorder, ts_max - ts)
+		self.ts.append(ts)
+		self.ts_max.append(ts_max)
+
+		flow = flows.parse(rec, pcap.rec_hdr.size, pcap.rec_hdr.size + incl_len)
+		if not flow: proto, sport, dport = 0, 0, 0
+		else:
+			proto, src, dst, sport, dport = flow
+			for addr in (src, dst) if src != dst else (src,):
+				try: self.hosts[addr].append(seq)
+				except KeyError: self.hosts[addr] = array('L', [seq])
+				self.hosts_added += 1
+			if self.hosts_added > max(1024, 2 * len(self)): self._hosts_cleanup()
+		self.protos.append(proto)
+		self.sports.append(sport)
+		self.dports.append(dport)
+		return seq
+
+	def _hosts_cleanup(self):
+		seq_tail = self.seq_tail
+		for addr, seqs in self.hosts.items():
+			n = bisect_left(seqs, seq_tail)
+			if n == len(seqs): del self.hosts[addr]
+			elif n: del seqs[:n]
+		self.hosts_added = 0
+
+	def candidates(self, since=None, until=None, host=None):
+		'''Returns ordered sequence (xrange or array) of record seqs that
+				might match specified time range and host (packed address), to check
+				these against all filters via matches(). Returned sequence stays valid
+				after more records are added, but some of these might get evicted by then.'''
+		lo, hi = self.tail, len(self.offsets)
+		# ts_max is non-decreasing, and ts of any record is within ts_disorder from it
+		if since is not None: lo = bisect_left(self.ts_max, since, lo, hi)
+		if until is not None: hi = bisect_right(self.ts_max, until + self.ts_disorder, lo, hi)
+		lo, hi = self.seq_base + lo, self.seq_base + hi
+		if host is None: return xrange(lo, hi)
+		seqs = self.hosts.get(host)
+		if not seqs: return list()
+		return seqs[bisect_left(seqs, lo):bisect_left(seqs, hi)]
+
+	def matches(self, seq, since=None, until=None, host=None, port=None, proto=None):
+		'''Checks whether record with specified seq is still stored and matches all filters:
+				since/until - unix timestamps, port - src or dst port, proto - IP protocol number.
+			"host" filter is ignored here, as it is only checked in candidates().'''
+		n = seq - self.seq_base
+		if not self.tail <= n < len(self.offsets): return False
+		if since is not None and self.ts[n] < since: return False
+		if until is not None and self.ts[n] > until: return False
+		if proto is not None and self.protos[n] != proto: return False
+		if port is not None and self.sports[n] != port and self.dports[n] != port: return False
+		return True
+
+	def query(self, since=None, until=None, host=None, port=None, proto=None):
+		'''Returns list of seqs for records matching all specified filters,
+			with "host" being packed src or dst address, see also matches().'''
+		return list( seq for seq in self.candidates(since, until, host)
+			if self.matches(seq, since, until, host, port, proto) )
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import itertools as it, operator as op, functools as ft
+from collections import OrderedDict
+from random import random
 import logging
+import wire, pcap, flows
+
 log = logging.getLogger('compressor')
 
 
@@ -15,86 +20,249 @@ def add_compress_optz(parser, always_enabled=False):
 			' (on the output to zmq) exceeds this value (default: %(default)s, 0 - disable).')
 	parser.add_argument('--hwm',
 		type=float, metavar='MiB/s', default=5.0,
-		help='High watermark - drop packets after MiB/s'
+		help='High watermark - shed (drop some) packets after MiB/s'
 			' (on the output to zmq) exceeds this value (default: %(default)s, 0 - disable).')
 	parser.add_argument('--wm-interval',
 		type=float, metavar='MiB',
 		help='After how many MiB throughput gets recalculated,'
 			' checked and (possibly) compressed (default: max(2 * hwm, 4 * lwm)).')
+	parser.add_argument('--wm-latency',
+		type=float, metavar='seconds', default=1.0,
+		help='Max time to keep rate-measurement (and compression) window open,'
+			' so that compressed data is sent out and rate is re-checked within'
+			' roughly that time even when traffic stops (default: %(default)s, 0 - disable).')
+	parser.add_argument('--codecs',
+		metavar='name[,name...]', default='zlib-1,zlib-3,zlib-6,zlib-9',
+		help='Comma-separated list of compression codecs to pick from for each window,'
+				' depending on measured compression ratio and cpu usage of these (default: %(default)s).'
+			' Single codec can be specified to always use that one.'
+			' Available: {}.'.format(', '.join(c.name for n, c in sorted(wire.codecs.items()))))
+	parser.add_argument('--codec-cpu',
+		type=float, metavar='fraction', default=0.5,
+		help='Fraction of a cpu core that compression can use at the'
+			' current traffic rate, when picking a codec (default: %(default)s).')
+	parser.add_argument('--shed-flow-head',
+		type=int, metavar='count', default=8,
+		help='Number of first packets of each flow to always pass through'
+				' when shedding traffic above hwm, along with tcp SYN/FIN/RST packets,'
+				' while the rest of it is randomly sampled to keep the rate at hwm'
+				' (default: %(default)s).'
+			' 0 - only do random sampling of all packets, without looking into these.')
+	parser.add_argument('--shed-flow-table',
+		type=int, metavar='count', default=2**16,
+		help='Max number of flows to track packet counts for when shedding,'
+			' with least recently seen ones discarded first (default: %(default)s).')
 
-def compress_pipe_from_optz(optz, always_enabled=False):
+def compress_pipe_from_optz(optz, always_enabled=False, stats=None):
 	if not always_enabled and not optz.rate_control: return None
-	optz.lwm *= 2**20
-	optz.hwm *= 2**20
-	if optz.hwm and optz.lwm > optz.hwm: parser.error('hwm must be > than lwm')
-	if optz.wm_interval is None:
-		optz.wm_interval = max(optz.hwm * 2, optz.lwm * 4)
-	else: optz.wm_interval *= 2**20
+	lwm, hwm = optz.lwm * 2**20, optz.hwm * 2**20 # optz is not modified, as this can be called more than once
+	if hwm and lwm > hwm: raise ValueError('hwm must be > than lwm')
+	if optz.wm_interval is None: win = max(hwm * 2, lwm * 4)
+	else: win = optz.wm_interval * 2**20
+	codecs = list(wire.codec_get(name.strip()) for name in optz.codecs.split(','))
 	pipe = compress_pipe(
-		win=int(optz.wm_interval),
-		lwm=optz.lwm, hwm=optz.hwm, log=log )
+		win=int(win), lwm=lwm, hwm=hwm, log=log,
+		policy=CodecPolicy(codecs, lwm=lwm, hwm=hwm, cpu_max=optz.codec_cpu),
+		shedder=FlowShedder(optz.shed_flow_head, optz.shed_flow_table, stats=stats),
+		latency=optz.wm_latency )
 	next(pipe)
 	return pipe
 
 
-def compress_pipe(win, lwm, hwm, log, pkt_len_fmt='!I'):
-	from time import time
-	from zlib import compressobj
-	from struct import pack
+class CodecPolicy(object):
+	'''Picks compression codec for each compressed window,
+			using moving averages of compression ratio and cpu time per input byte,
+			measured for each codec on windows where it was used.
+		Codec is picked as the least cpu-intensive one that is estimated to bring
+			output rate below lwm (or hwm, if none of them can), within cpu_max
+			fraction of a core, falling back to the best-compressing one.
+		Codecs that weren't used yet are tried first, and the one measured
+			least recently gets re-probed every probe_interval windows,
+			as both ratio and cost depend on the traffic.'''
+
+	def __init__(self, codecs, lwm=0, hwm=0, cpu_max=0.5, probe_interval=20, ewma=0.3):
+		self.codecs, self.lwm, self.hwm, self.cpu_max = codecs, lwm, hwm, cpu_max
+		self.probe_interval, self.ewma = probe_interval, ewma
+		self.stats = dict() # codec id -> [ratio, cpu per byte, window number]
+		self.n = 0 # compressed window counter
+
+	def pick(self, rate):
+		'Returns codec to use for the next window at specified input rate (B/s).'
+		self.n += 1
+		if len(self.codecs) == 1: return self.codecs[0]
+		for codec in self.codecs:
+			if codec.id not in self.stats: return codec
+		stats = self.stats
+		if self.n % self.probe_interval == 0:
+			return min(self.codecs, key=lambda c: stats[c.id][2])
+		ratio, cpu = (lambda c: stats[c.id][0]), (lambda c: stats[c.id][1])
+		usable = list(c for c in self.codecs if rate * cpu(c) <= self.cpu_max)\
+			or [min(self.codecs, key=cpu)]
+		for target in self.lwm, self.hwm:
+			if not target: continue
+			fits = list(c for c in usable if rate * ratio(c) <= target)
+			if fits: return min(fits, key=cpu)
+		return min(usable, key=ratio)
+
+	def update(self, codec, bs_in, bs_out, cpu):
+		'Updates stats for codec with results of compressing bs_in bytes of a window.'
+		if not bs_in: return
+		ratio, cpu = bs_out / float(bs_in), cpu / bs_in
+		try: stats = self.stats[codec.id]
+		except KeyError: self.stats[codec.id] = [ratio, cpu, self.n]
+		else:
+			k = self.ewma
+			stats[0] += k * (ratio - stats[0])
+			stats[1] += k * (cpu - stats[1])
+			stats[2] = self.n
+
+
+class FlowShedder(object):
+	'''Drops part of the traffic to keep its rate at the specified limit,
+			preferring to keep packets that matter most for inspecting it -
+			tcp SYN/FIN/RST ones and first flow_head packets of each flow,
+			randomly sampling the rest (mostly bulk mid-flow data).
+		Sampling chance is updated for each window from its measured rate
+			and share of prioritized packets in the previous one.
+		Packet counts are kept in a bounded LRU table for
+			the flows seen while shedding, so when it starts, all flows
+			get first flow_head packets passed, even if these were seen before.
+		With flow_head=0, packets are only sampled, without parsing these.
+		Counters in "stats" dict are incremented for shed/kept packets.'''
+
+	tcp_prio = flows.tcp_syn | flows.tcp_fin | flows.tcp_rst
+
+	def __init__(self, flow_head=8, flow_table=2**16, stats=None):
+		self.flow_head, self.flow_table = flow_head, flow_table
+		self.flows = OrderedDict() # flow key -> packet count, least recently seen first
+		self.chance = self.chance_prio = 1.0 # sampling chances for bulk/prioritized packets
+		self.win_prio = self.win_bulk = 0 # bytes seen in the current window
+		self.stats = stats if stats is not None else dict()
+		for k in 'shed_pkt', 'shed_bytes', 'prio_pkt', 'sampled_pkt', 'flows_evicted':
+			self.stats.setdefault(k, 0)
+
+	def window(self, rate, limit):
+		'''Updates sampling chances for the next window from input rate (B/s)
+			and rate limit, returning whether anything has to be shed at all.'''
+		prio, total = self.win_prio, self.win_prio + self.win_bulk
+		rate_prio = rate * prio / float(total) if total else 0
+		rate_bulk = rate - rate_prio
+		if rate_prio > limit: # e.g. flood of new flows - sample these too
+			self.chance, self.chance_prio = 0, limit / rate_prio
+		else:
+			self.chance_prio = 1.0
+			self.chance = min(1.0, (limit - rate_prio) / rate_bulk) if rate_bulk > 0 else 1.0
+		self.win_prio = self.win_bulk = 0
+		return rate > limit
+
+	def is_prio(self, body, pos, end):
+		flow = flows.parse_l4(body, pos, end)
+		if not flow: return False
+		proto, src, dst, sport, dport, l4 = flow
+		key, table = flows.flow_key(proto, src, dst, sport, dport), self.flows
+		n = table.pop(key, 0) + 1
+		table[key] = min(n, self.flow_head + 1)
+		if len(table) > self.flow_table:
+			table.popitem(last=False)
+			self.stats['flows_evicted'] += 1
+		if n <= self.flow_head: return True
+		return proto == 6 and bool((flows.tcp_flags(body, l4, end) or 0) & self.tcp_prio)
+
+	def shed(self, body):
+		'Returns body of pcap records with some of them dropped, if necessary.'
+		try: offsets = pcap.index(body)
+		except ValueError: return body
+		chance, chance_prio = self.chance, self.chance_prio
+		stats, hdr_size = self.stats, pcap.rec_hdr.size
+		keep, pos_keep, shed_pkt, shed_bytes = list(), 0, 0, 0
+		for a, b in it.izip(offsets, it.chain(it.islice(offsets, 1, None), [len(body)])):
+			if self.flow_head and self.is_prio(body, a + hdr_size, b):
+				self.win_prio += b - a
+				if chance_prio >= 1.0 or random() < chance_prio:
+					stats['prio_pkt'] += 1
+					continue
+			else:
+				self.win_bulk += b - a
+				if chance >= 1.0 or random() < chance:
+					stats['sampled_pkt'] += 1
+					continue
+			if a > pos_keep: keep.append(body[pos_keep:a])
+			pos_keep, shed_pkt, shed_bytes = b, shed_pkt + 1, shed_bytes + b - a
+		if not shed_pkt: return body
+		stats['shed_pkt'] += shed_pkt
+		stats['shed_bytes'] += shed_bytes
+		if pos_keep < len(body): keep.append(body[pos_keep:])
+		return b''.join(keep)
 
+
+def compress_pipe(win, lwm, hwm, log, policy=None, shedder=None, latency=None):
+	'''Coroutine that accepts bodies of pcap records
+		and returns wire frames (either plain or compressed) for these,
+		or None if nothing should be sent (yet).
+		Codec for each compressed window is picked by
+			CodecPolicy (default one is created if not passed),
+			and traffic above hwm is passed through FlowShedder.
+		Sending None instead of a body closes current window
+			(flushing compressed data, if any, and re-checking rate)
+			if it was open for longer than "latency" seconds,
+			which should be done periodically from an event loop timer,
+			so that windows don't stay open indefinitely when traffic stops.'''
+	from time import time, clock
+
+	if policy is None: policy = CodecPolicy([wire.codec_default], lwm=lwm, hwm=hwm)
+	if shedder is None: shedder = FlowShedder()
 	if not lwm and not hwm: win = None
-	else:
-		bs, ts, rate = 0, time(), 0
-		buff, comp = bytearray(win + 65535), None
-	send = True
+	else: bs, ts, rate = 0, time(), 0
+	hdr_plain = wire.frame_byte()
+	hdr_comp = wire.frame_byte(wire.F_COMPRESSED)
+	codec, comp, comp_buff, comp_bs, comp_cpu, shed = None, None, list(), 0, 0, False
 
 	pkt_out = None
 	while True:
 		pkt = yield pkt_out
-		pkt_out = None
+		pkt_out, tick = None, pkt is None
+
+		if tick: # timer - close window only if it's been open for too long
+			if not win or not latency or time() - ts < latency: continue
+			pkt_len = 0
+		else:
+			pkt_len = len(pkt)
+			if shed: pkt = shedder.shed(pkt)
+			if not pkt: pass # everything was shed
+			elif comp is None: pkt_out = hdr_plain + pkt
+			else: # compress packet
+				cpu = clock()
+				comp_buff.append(comp.compress(pkt))
+				comp_cpu += clock() - cpu
+				comp_bs += len(pkt)
 
-		if win and bs > win:
+		if not win: continue
+		bs += pkt_len
+		if bs > win or tick:
 			ts_now = time()
-			rate = bs / (ts_now - ts)
+			rate = bs / max(ts_now - ts, 1e-6)
 			# log.debug('Rate: {:.2f} MiB/s'.format(rate / 2**20))
 
-			if hwm and rate > hwm:
-				# TODO: send at least some part of them
-				log.warn('Dropping packets due to hwm (rate: {:.2f})'.format(rate / 2**20))
-				send = None
-			else:
-				if send is False: pkt_out = '\x01' + bytes(buff[:bs]) + comp.flush()
-				if lwm and rate > lwm:
-					# log.debug( 'lwm reached (rate: {:.2f}),'
-					# 	' compressing packets'.format(rate / 2**20) )
-					comp = compressobj()
-					send = False
-				else: send = True
-
-			bs, ts = 0, ts_now
+			if comp is not None and comp_bs:
+				# Current packet is always the last one in the compressed window
+				cpu = clock()
+				comp_buff.append(comp.flush())
+				comp_cpu += clock() - cpu
+				pkt_out = hdr_comp + chr(codec.id) + b''.join(comp_buff)
+				policy.update(codec, comp_bs, len(pkt_out), comp_cpu)
+			comp, comp_buff, comp_bs, comp_cpu = None, list(), 0, 0
 
-		if send: pkt_out = '\x00' + pkt
-		elif send is None: pass # drop packet
-		else: # compress packet
-			pkt = comp.compress(pack(pkt_len_fmt, len(pkt)) + pkt)
-			buff[bs:] = pkt
+			shed = hwm and shedder.window(rate, hwm)
+			if shed:
+				log.warn( 'Shedding packets due to hwm (rate: {:.2f} MiB/s,'
+					' sampling chance: {:.1%} / {:.1%} for bulk/prioritized'
+					' packets)'.format(rate / 2**20, shedder.chance, shedder.chance_prio) )
+				rate = hwm
+			if lwm and rate > lwm:
+				codec_prev, codec = codec, policy.pick(rate)
+				if codec is not codec_prev:
+					log.debug( 'Compressing packets with {} codec'
+						' (rate: {:.2f} MiB/s)'.format(codec.name, rate / 2**20) )
+				comp = codec.compressobj()
 
-		if win: bs += len(pkt)
-
-
-def decompress_pipe(pkt_len_fmt='!I'):
-	from struct import unpack, calcsize
-	from zlib import decompress
-	pkt_len_size = calcsize(pkt_len_fmt)
-	pkt_out = list()
-	while True:
-		pkt = yield pkt_out
-		pkt_out = list()
-		if pkt[0] == '\x01':
-			pkt = decompress(pkt[1:])
-			pos, pos_max = 0, len(pkt)
-			while pos != pos_max:
-				pkt_len, = unpack(pkt_len_fmt, pkt[pos:pos+pkt_len_size])
-				pos += pkt_len_size + pkt_len
-				pkt_out.append(pkt[pos - pkt_len:pos])
-		else: pkt_out.append(pkt[1:])
+			bs, ts = 0, ts_now
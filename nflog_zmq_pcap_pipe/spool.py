@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'''On-disk spool for frames that can't be sent right away (receiver is down
+	or slow and zmq send queue is full), to replay these later at a limited rate.
+
+	Spool directory has numbered segment files, each with a sequence of
+		frame records - u32 frame length, f64 capture timestamp and the frame itself,
+		and "pos" file with segment name and offset of the first unsent record in it,
+		so that unsent frames are picked up again after restart.'''
+
+import itertools as it, operator as op, functools as ft
+from time import time
+import os, errno, struct, logging
+import wire
+
+log = logging.getLogger('spool')
+
+rec_hdr = struct.Struct('<Id') # frame length, capture ts
+
+
+def add_spool_optz(parser):
+	parser.add_argument('--spool',
+		metavar='dir',
+		help='Directory to store frames in when they cannot be sent (--zmq-buffer is full),'
+				' e.g. while receiver is restarting or unreachable, instead of dropping these.'
+			' Spooled frames are sent again when socket is writable, at --spool-rate,'
+				' giving way to live traffic. Subdirectory is created there for each'
+				' destination and worker process. Default is to drop frames in such cases.')
+	parser.add_argument('--spool-size',
+		type=float, metavar='MiB', default=1024.0,
+		help='Max size of --spool for each destination, with oldest'
+			' segments of it discarded when it is exceeded (default: %(default)s).')
+	parser.add_argument('--spool-segment',
+		type=float, metavar='MiB', default=16.0,
+		help='Size of --spool segment files, which are removed when'
+			' all frames in them are sent or discarded (default: %(default)s).')
+	parser.add_argument('--spool-rate',
+		type=float, metavar='MiB/s', default=10.0,
+		help='Max rate at which to send frames from --spool, in addition'
+				' to live traffic, should be below what receiver can handle over'
+				' the usual traffic volume (default: %(default)s, 0 - no limit).')
+	parser.add_argument('--spool-interval',
+		type=float, metavar='seconds', default=0.1,
+		help='Interval between attempts to send frames from --spool, skipped'
+			' if any live frames were spooled since the last one (default: %(default)s).')
+
+def spool_from_optz(optz, n=0, worker=None, registry=None, multi=False):
+	'''Returns opened Spool for n-th destination, or None if it's disabled.
+		Metrics are registered with "spool.<n>" prefix if "multi" is set.'''
+	if not optz.spool: return None
+	name = 'dst{}'.format(n) + ('.w{}'.format(worker) if worker is not None else '')
+	prefix = 'spool' if not multi else 'spool.{}'.format(n)
+	stats = registry.counters(prefix) if registry else None
+	spool = Spool( os.path.join(optz.spool, name), int(optz.spool_size * 2**20),
+		int(optz.spool_segment * 2**20), stats=stats )
+	spool.open()
+	if registry:
+		registry.gauges['{}.frames'.format(prefix)] = lambda: spool.frames
+		registry.gauges['{}.bytes'.format(prefix)] = lambda: spool.bytes
+		registry.gauges['{}.lag'.format(prefix)] = spool.lag
+	return spool
+
+
+class Spool(object):
+	'''FIFO queue of frames in segment files of up to "segment_size" bytes,
+			with oldest segments removed (unsent frames in these discarded)
+			when total size of the spool goes over "size" bytes.
+		Frames are added with append(), and taken out by peek() + pop(),
+			so that frame stays in the spool if it can't be sent after peek().
+		frames/bytes attributes are the number/size of frames in the spool,
+			lag() - seconds since capture of the oldest one (0 if there are none).
+		Read position is saved to disk by save() (and on close),
+			so frames sent after last save() might be sent again after restart.
+		Counters in "stats" dict are incremented for added/sent/discarded frames.'''
+
+	def __init__(self, path, size=2**30, segment_size=16 * 2**20, stats=None):
+		self.path, self.size, self.segment_size = path, size, segment_size
+		self.segs = list() # [name, size, frames, ts], oldest first, ts - of the first unsent frame
+		self.fd_w = self.fd_r = self.head = None
+		self.pos = self.seg_next = 0
+		self.frames = self.bytes = 0
+		self.stats = stats if stats is not None else dict()
+		for k in ( 'frames_in', 'bytes_in', 'frames_out', 'bytes_out',
+				'frames_discarded', 'bytes_discarded' ):
+			self.stats.setdefault(k, 0)
+
+	def __len__(self): return self.frames
+
+	def open(self):
+		'''Opens spool directory, creating it if necessary,
+			and picks up all frames remaining in it, if any.'''
+		if not os.path.isdir(self.path): os.makedirs(self.path)
+		names = sorted(name for name in os.listdir(self.path) if name.endswith('.spool'))
+		pos_name, pos = None, 0
+		try:
+			with open(os.path.join(self.path, 'pos')) as src: pos_name, pos = src.read().split()
+			pos = int(pos)
+		except (IOError, ValueError): pass
+		for name in names:
+			if pos_name and name < pos_name: # sent already, but not removed
+				os.unlink(os.path.join(self.path, name))
+				continue
+			seg = self._scan(name, pos if name == pos_name else 0)
+			self.frames, self.bytes = self.frames + seg[2], self.bytes + seg[1]
+			self.segs.append(seg)
+		self.pos = pos if self.segs and self.segs[0][0] == pos_name else 0
+		self.seg_next = max(int(name.split('.', 1)[0]) for name in names + [pos_name or '-1.']) + 1
+		if self.frames:
+			log.debug('Picked up {} frame(s) ({:,d} B) from spool: {}'.format(self.frames, self.bytes, self.path))
+
+	def _scan(self, name, pos=0):
+		'''Returns [name, size, frames, ts] for segment, with size being unsent bytes
+			(after "pos") and ts - capture timestamp of the first of these frames,
+			truncating partially-written record at the end, if any.'''
+		seg_path, frames, ts_first = os.path.join(self.path, name), 0, None
+		with open(seg_path, 'rb+') as src:
+			end = os.fstat(src.fileno()).st_size
+			offset = pos
+			while offset + rec_hdr.size <= end:
+				src.seek(offset)
+				frame_len, ts = rec_hdr.unpack(src.read(rec_hdr.size))
+				if offset + rec_hdr.size + frame_len > end: break
+				if ts_first is None: ts_first = ts
+				offset, frames = offset + rec_hdr.size + frame_len, frames + 1
+			if offset != end:
+				log.warn('Truncating partial record at the end of spool segment: {}'.format(seg_path))
+				src.truncate(offset)
+		return [name, offset - pos, frames, ts_first]
+
+	def append(self, frame, ts=None):
+		'Adds frame to the spool, raising OSError if it cannot be written.'
+		ts = ts or time()
+		rec = rec_hdr.pack(len(frame), ts) + wire.as_bytes(frame)
+		if self.fd_w is None or self._seg_end(self.segs[-1]) + len(rec) > self.segment_size:
+			self._rotate()
+		seg = self.segs[-1]
+		try: n = os.write(self.fd_w, rec)
+		except OSError:
+			os.ftruncate(self.fd_w, self._seg_end(seg)) # in case part of it was written
+			raise
+		if n != len(rec):
+			os.ftruncate(self.fd_w, self._seg_end(seg))
+			raise OSError(errno.ENOSPC, 'Partial write to spool segment')
+		seg[1], seg[2] = seg[1] + n, seg[2] + 1
+		if seg[3] is None: seg[3] = ts
+		self.frames, self.bytes = self.frames + 1, self.bytes + n
+		self.stats['frames_in'] += 1
+		self.stats['bytes_in'] += n
+		self.expire()
+
+	def _seg_end(self, seg):
+		return seg[1] + (self.pos if seg is self.segs[0] else 0)
+
+	def _rotate(self):
+		if self.fd_w is not None: os.close(self.fd_w)
+		name, self.seg_next = '{:012d}.spool'.format(self.seg_next), self.seg_next + 1
+		self.fd_w = os.open( os.path.join(self.path, name),
+			os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644 )
+		self.segs.append([name, 0, 0, None])
+
+	def expire(self):
+		'Removes oldest segments (except current one) until spool size is within limit.'
+		while self.bytes > self.size and len(self.segs) > 1:
+			name, size, frames, ts = self.segs[0]
+			log.debug('Discarding spool segment with {} frame(s): {}'.format(frames, name))
+			self._remove_head()
+			self.stats['frames_discarded'] += frames
+			self.stats['bytes_discarded'] += size
+
+	def _remove_head(self):
+		name, size, frames, ts = self.segs.pop(0)
+		self.frames, self.bytes = self.frames - frames, self.bytes - size
+		if self.fd_r is not None:
+			os.close(self.fd_r)
+			self.fd_r = None
+		self.pos, self.head = 0, None
+		try: os.unlink(os.path.join(self.path, name))
+		except OSError as err:
+			if err.errno != errno.ENOENT: raise
+
+	def peek(self):
+		'Returns (frame, ts) tuple for the oldest frame in the spool, or None if it is empty.'
+		if self.head is not None: return self.head
+		while self.segs and not self.segs[0][2]:
+			if len(self.segs) == 1: return # empty current segment
+			self._remove_head()
+		if not self.segs: return
+		if self.fd_r is None:
+			self.fd_r = os.open(os.path.join(self.path, self.segs[0][0]), os.O_RDONLY)
+		os.lseek(self.fd_r, self.pos, os.SEEK_SET)
+		frame_len, ts = rec_hdr.unpack(os.read(self.fd_r, rec_hdr.size))
+		frame = os.read(self.fd_r, frame_len)
+		if len(frame) != frame_len:
+			raise IOError(errno.EIO, 'Truncated record in spool segment: {}'.format(self.segs[0][0]))
+		self.head = frame, ts
+		self.segs[0][3] = ts
+		return self.head
+
+	def pop(self):
+		'Removes frame returned by last peek() from the spool.'
+		frame, ts = self.head
+		seg, rec_len = self.segs[0], rec_hdr.size + len(frame)
+		self.pos, self.head = self.pos + rec_len, None
+		seg[1], seg[2] = seg[1] - rec_len, seg[2] - 1
+		if not seg[2]: seg[3] = None
+		self.frames, self.bytes = self.frames - 1, self.bytes - rec_len
+		self.stats['frames_out'] += 1
+		self.stats['bytes_out'] += rec_len
+		if not seg[2] and len(self.segs) > 1: self._remove_head()
+
+	def lag(self):
+		'''Returns seconds since capture of the oldest frame, from timestamps kept in memory,
+			never reading anything from disk. Capture time of the last popped frame is used
+			until next peek(), so it can be slightly higher than actual lag in-between.'''
+		for name, size, frames, ts in self.segs:
+			if frames: return time() - ts
+		return 0
+
+	def save(self):
+		'Saves read position in the oldest segment to disk.'
+		if not self.segs: return
+		pos_path = os.path.join(self.path, 'pos')
+		with open(pos_path + '.new', 'wb') as dst: dst.write('{} {}\n'.format(self.segs[0][0], self.pos))
+		os.rename(pos_path + '.new', pos_path)
+
+	def close(self):
+		self.save()
+		for fd in self.fd_w, self.fd_r:
+			if fd is not None: os.close(fd)
+		self.fd_w = self.fd_r = None
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'Synthetic traffic source, standing in for nflog in benchmarks and tests without root'
+
+import itertools as it, operator as op, functools as ft
+from time import time, sleep
+import os, random, struct
+
+
+# Simple IMIX - 7:4:1 of 40/576/1500-byte IP packets
+size_mix = [(40, 7), (576, 4), (1500, 1)]
+
+ipv4_hdr = struct.Struct('!BBHHHBBH4s4s')
+tcp_hdr = struct.Struct('!HHIIBBHHH')
+
+
+def parse_mix(spec):
+	'Parses "size:weight,..." string into a list of (size, weight) tuples.'
+	return list(tuple(map(int, v.split(':', 1))) for v in spec.split(','))
+
+def packets(count=1024, mix=None, flows=64, seed=0):
+	'''Returns list of raw IPv4/TCP packets with sizes from the (size, weight) mix,
+			belonging to specified number of flows, with SYN flag on the first packet of each.
+		Payloads are half text-like (compressible) and half random bytes.'''
+	rng = random.Random(seed)
+	sizes = list(it.chain.from_iterable(it.repeat(size, weight) for size, weight in mix or size_mix))
+	text = b''.join('GET /{} HTTP/1.1\r\nHost: example.com\r\n\r\n'.format(n) for n in xrange(64))
+	flow_addrs = list(
+		( struct.pack('!I', 0x0a000000 | rng.getrandbits(16)),
+			struct.pack('!I', 0x0a010000 | rng.getrandbits(16)),
+			rng.randint(1024, 65535), rng.choice([80, 443, 53, 22]) )
+		for n in xrange(flows) )
+	seen, pkts = set(), list()
+	for n in xrange(count):
+		size, flow = max(40, rng.choice(sizes)), rng.randrange(flows)
+		src, dst, sport, dport = flow_addrs[flow]
+		flags = 0x10 if flow in seen else 0x02 # ACK or SYN
+		seen.add(flow)
+		payload_len = size - 40
+		payload = text[:payload_len // 2]
+		payload += os.urandom(payload_len - len(payload))
+		pkts.append(b''.join([
+			ipv4_hdr.pack(0x45, 0, size, n & 0xffff, 0, 64, 6, 0, src, dst),
+			tcp_hdr.pack(sport, dport, n, 0, 0x50, flags, 1024, 0, 0),
+			payload ]))
+	return pkts
+
+
+def nflog_generator( qids, pool=1024, mix=None, pps=None,
+		count=None, recv_count=16, extra_attrs=None, **kws ):
+	'''nflog_generator-compatible source, endlessly (or up to "count")
+			yielding packets from a pool of pre-generated ones (see packets()),
+			with None after every recv_count of them, as a batch boundary.
+		"pps" limits rate of packets, if specified (default - as fast as possible).
+		Keywords for other backends (qthresh, timeout, etc) are ignored.'''
+	if isinstance(extra_attrs, bytes): extra_attrs = [extra_attrs]
+	pkts = packets(pool, mix)
+	for attr in extra_attrs or list():
+		if attr not in ['len', 'ts', 'mark', 'prefix', 'indev', 'outdev']:
+			raise NotImplementedError('Unknown nflog attribute: {}'.format(attr))
+
+	yield None # no fd to poll
+	ts_start, sent = time(), 0
+	pkts = it.cycle(pkts) if count is None else it.islice(it.cycle(pkts), count)
+	while True:
+		ts = time()
+		if pps:
+			delay = ts_start + float(sent) / pps - ts
+			if delay > 0: sleep(delay)
+		for pkt in it.islice(pkts, recv_count):
+			sent += 1
+			if not extra_attrs: yield pkt
+			else:
+				result = [pkt]
+				for attr in extra_attrs:
+					if attr == 'len': result.append(len(pkt))
+					elif attr == 'ts': result.append(ts)
+					else: result.append(None)
+				yield result
+		if count is not None and sent >= count: break
+		yield None
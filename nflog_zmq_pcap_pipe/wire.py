@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'''Framing for batches of pcap records, sent as zmq messages.
+
+	Each frame starts with a single byte - frame format version
+		in the high nibble and flags in the low one, followed by
+		one or more (possibly compressed) concatenated pcap records.
+	If F_STAGES flag is set, header byte is followed by a block with
+		sender host name and timestamps of pipeline stages that frame went through.
+	If F_COMPRESSED flag is set, header byte (and stages block)
+		is followed by codec id byte (see "codecs" registry) and compressed records.
+	If F_HDRCOMP flag is set, records in the (decompressed) body are
+		header-compressed and have to be decoded by receiver, see hdrcomp module.
+
+	Functions here accept frames as str or memoryview (e.g. of zmq.Frame buffer,
+		received with copy=False), returning slices of same type where possible,
+		so that uncompressed bodies can be passed on without copying.'''
+
+import itertools as it, operator as op, functools as ft
+from collections import namedtuple
+import struct, zlib, bz2
+
+
+version = 1
+
+F_COMPRESSED = 0x01 # body is compressed, with codec id byte before it
+F_STAGES = 0x02 # stage timestamps block follows header byte
+F_HDRCOMP = 0x04 # records are header-compressed (stateful, per-sender)
+
+class WireError(ValueError): pass
+
+
+Codec = namedtuple('Codec', 'id name compressobj decompress')
+codecs, codecs_by_name = dict(), dict() # id -> Codec, name -> Codec
+
+def codec_register(cid, name, compressobj, decompress):
+	'''Adds codec to the registry.
+		compressobj must return object with zlib.compressobj-like compress/flush methods,
+			and decompress should accept whole compressed body, returning decompressed one.'''
+	assert 0 < cid < 256 and cid not in codecs, cid
+	codecs[cid] = codecs_by_name[name] = Codec(cid, name, compressobj, decompress)
+
+def codec_get(name):
+	try: return codecs_by_name[name]
+	except KeyError:
+		raise WireError( 'Unknown or unavailable compression'
+			' codec: {!r} (available: {})'.format(name, ', '.join(sorted(codecs_by_name))) )
+
+for n in xrange(1, 10):
+	codec_register(n, 'zlib-{}'.format(n), ft.partial(zlib.compressobj, n), zlib.decompress)
+	codec_register( 0x10 + n, 'bz2-{}'.format(n),
+		ft.partial(bz2.BZ2Compressor, n), bz2.decompress )
+
+try:
+	try: import lzma
+	except ImportError: from backports import lzma
+	lzma.LZMACompressor
+except (ImportError, AttributeError): pass
+else:
+	for n in xrange(0, 10):
+		codec_register( 0x20 + n, 'lzma-{}'.format(n),
+			ft.partial(lzma.LZMACompressor, preset=n), lzma.decompress )
+
+try: import lz4.frame
+except ImportError: pass
+else:
+	class LZ4CompressObj(object):
+		def __init__(self):
+			self.comp = lz4.frame.LZ4FrameCompressor()
+			self.hdr = self.comp.begin()
+		def compress(self, data):
+			data, self.hdr = self.hdr + self.comp.compress(bytes(data)), b''
+			return data
+		def flush(self): return self.hdr + self.comp.flush()
+	codec_register(0x30, 'lz4', LZ4CompressObj, lz4.frame.decompress)
+
+try: import zstandard
+except ImportError: pass
+else:
+	def _zstd_decompress(data):
+		# Streaming-compressed frames don't have content size in them
+		return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+	for n in 1, 3, 6, 9, 19:
+		codec_register( 0x40 + n, 'zstd-{}'.format(n),
+			lambda n=n: zstandard.ZstdCompressor(level=n).compressobj(), _zstd_decompress )
+
+codec_default = codecs_by_name['zlib-6']
+
+
+def frame_flags(frame):
+	return ord(frame[0]) & 0xf
+
+def frame_byte(flags=0):
+	return chr(version << 4 | flags)
+
+def as_bytes(buff):
+	'Returns str for str, bytearray or memoryview, as bytes(memoryview) is its repr on python2.'
+	return buff.tobytes() if isinstance(buff, memoryview) else bytes(buff)
+
+def frame(body, flags=0):
+	return frame_byte(flags) + as_bytes(body)
+
+
+# Stages block: u8 host name length, host name, u8 count, count * (u8 stage, f64 unix time)
+stages = dict(capture=1, send=2, compress=3, decompress=4, receive=5, write=6)
+stages_names = dict((v, k) for k, v in stages.viewitems())
+stage_ts = struct.Struct('<Bd')
+
+def stages_block(host, stamps):
+	'Returns stages block for host name and a list of (stage, ts) tuples.'
+	host = host[:255]
+	return b''.join(it.chain(
+		[chr(len(host)), host, chr(len(stamps))],
+		(stage_ts.pack(stage, ts) for stage, ts in stamps) ))
+
+def _stages_len(frame):
+	try:
+		host_len = ord(frame[1])
+		return 2 + host_len + ord(frame[2 + host_len]) * stage_ts.size
+	except IndexError: raise WireError('Truncated stages block in frame')
+
+def frame_stages(frame):
+	'''Returns (host, [(stage, ts), ...]) tuple from the frame
+		stages block or None if frame has no F_STAGES flag set.'''
+	if not ord(frame[0]) & F_STAGES: return
+	end = 1 + _stages_len(frame)
+	if len(frame) < end: raise WireError('Truncated stages block in frame')
+	host_len = ord(frame[1])
+	host, pos, stamps = frame[2:2 + host_len], 3 + host_len, list()
+	while pos < end:
+		stamps.append(stage_ts.unpack_from(frame, pos))
+		pos += stage_ts.size
+	return as_bytes(host), stamps
+
+def frame_add_stages(frame, host, stamps):
+	'Returns frame with stages block added to it, replacing existing one, if any.'
+	hdr = ord(frame[0])
+	body = frame[1 + (_stages_len(frame) if hdr & F_STAGES else 0):]
+	return chr(hdr | F_STAGES) + stages_block(host, stamps) + as_bytes(body)
+
+def stage_delays(stamps):
+	'Yields (stage_name, delay) tuples for stage timestamps relative to capture one.'
+	ts0 = None
+	for stage, ts in stamps:
+		if stage == stages['capture']: ts0 = ts
+		elif ts0 is not None: yield stages_names.get(stage, stage), ts - ts0
+
+
+def unframe(frame):
+	'''Returns body of a frame with pcap records,
+			decompressed if necessary, raising WireError for unknown formats.
+		Uncompressed body is a slice of the frame, i.e. memoryview for memoryview frame.'''
+	ver_flags = ord(frame[0])
+	ver, flags = ver_flags >> 4, ver_flags & 0xf
+	if ver != version:
+		raise WireError( 'Unsupported frame format version {} (flags: {:#x}),'
+			' sender might be running incompatible version'.format(ver, flags) )
+	pos = 1 if not flags & F_STAGES else 1 + _stages_len(frame)
+	if not flags & F_COMPRESSED: return frame[pos:]
+	try: codec = codecs[ord(frame[pos])]
+	except (KeyError, IndexError):
+		raise WireError( 'Unknown or unavailable compression codec id'
+			' {!r} in frame, sender might be using newer version'.format(frame[pos:pos+1]) )
+	# Most decompress() functions only accept str/buffer, not memoryview on python2
+	try: return codec.decompress(as_bytes(frame[pos+1:]))
+	except Exception as err:
+		raise WireError('Failed to decompress frame ({}): {}'.format(codec.name, err))
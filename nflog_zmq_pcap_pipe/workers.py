@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+'''Pool of worker threads for cpu-heavy per-message work (e.g. decompression),
+	which can run in parallel as zlib/bz2/lzma release the GIL, with results
+	merged back in order and handed to the event loop via a wakeup pipe.'''
+
+import itertools as it, operator as op, functools as ft
+from collections import deque
+import os, errno, fcntl, threading, logging
+
+log = logging.getLogger('workers')
+
+
+class OrderedPool(object):
+	'''Runs func(*args) for submitted jobs in "size" threads, returning results
+			via results() in the same order as jobs were submitted with the same "key"
+			(e.g. sender), while results for different keys can overtake each other,
+			so that slow job for one key does not hold back all others.
+		fileno() is a pipe that becomes readable when some results are ready,
+			to register in event loop (see reactor.Reactor.add_reader) to call results().
+		full() is set when there are "max_pending" jobs in flight,
+			which caller should stop submitting new jobs on (e.g. stop reading socket).
+		Exceptions in func are logged, with None returned as the result.'''
+
+	def __init__(self, func, size, max_pending=None):
+		self.func, self.size = func, size
+		self.max_pending = max_pending or size * 16
+		self.jobs, self.cond = deque(), threading.Condition()
+		self.seqs = dict() # key -> (next seq to submit, next seq to return)
+		self.done = dict() # key -> {seq: result}
+		self.pending, self.stopping = 0, False
+		self.wakeup_r, self.wakeup_w = os.pipe()
+		for fd in self.wakeup_r, self.wakeup_w:
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.threads = list()
+		for n in xrange(size):
+			thread = threading.Thread(target=self._run, name='worker-{}'.format(n))
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def fileno(self): return self.wakeup_r
+
+	def full(self): return self.pending >= self.max_pending
+
+	def submit(self, key, *args):
+		seq, seq_ret = self.seqs.get(key, (0, 0))
+		self.seqs[key] = seq + 1, seq_ret
+		with self.cond:
+			self.pending += 1
+			self.jobs.append((key, seq, args))
+			self.cond.notify()
+
+	def results(self):
+		'Returns list of results that are ready, ordered by submission for each key.'
+		try:
+			while os.read(self.wakeup_r, 4096): pass
+		except OSError as err:
+			if err.errno != errno.EAGAIN: raise
+		res = list()
+		with self.cond:
+			for key, done in self.done.items():
+				seq_next, seq = self.seqs[key]
+				seq0 = seq
+				while seq in done:
+					res.append(done.pop(seq))
+					seq += 1
+				if seq == seq0: continue
+				self.pending -= seq - seq0
+				if not done: del self.done[key]
+				if seq == seq_next: del self.seqs[key] # nothing in flight, start over
+				else: self.seqs[key] = seq_next, seq
+		return res
+
+	def _run(self):
+		while True:
+			with self.cond:
+				while not self.jobs and not self.stopping: self.cond.wait()
+				if not self.jobs: break
+				key, seq, args = self.jobs.popleft()
+			try: res = self.func(*args)
+			except Exception:
+				log.exception('Failed to process job in worker thread')
+				res = None
+			with self.cond:
+				self.done.setdefault(key, dict())[seq] = res
+			try: os.write(self.wakeup_w, b'x')
+			except OSError as err:
+				if err.errno != errno.EAGAIN: raise # pipe is full of wakeups already
+
+	def close(self, timeout=2.0):
+		'Stops threads after processing queued jobs, discarding any results not yet returned.'
+		with self.cond:
+			self.stopping = True
+			self.cond.notify_all()
+		for thread in self.threads: thread.join(timeout)
+		for fd in self.wakeup_r, self.wakeup_w: os.close(fd)
@@ -48,4 +48,5 @@ setup(
 		'console_scripts': [
 			'{} = nflog_zmq_pcap_pipe.{}:main'.format(name, name.replace('-', '_'))
 			for name in [ 'nflog-zmq-send', 'nflog-zmq-compress',
-				'nflog-zmq-decompress', 'nflog-pcap-recv', 'nflog-pcap-query' ] ] } )
+				'nflog-zmq-decompress', 'nflog-pcap-recv', 'nflog-pcap-query',
+				'nflog-pcap-replay', 'nflog-pipe-bench' ] ] } )
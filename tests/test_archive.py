@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nflog_zmq_pcap_pipe'))
+import pcap, synthetic, archive
+
+
+def body(pkts, ts):
+	buff, pos = bytearray(), 0
+	for pkt in pkts: pos = pcap.construct_into(buff, pos, pkt, ts=ts)
+	return bytes(buff[:pos])
+
+
+class ArchiveTest(unittest.TestCase):
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix='nflog-archive-test.')
+		self.pkts = synthetic.packets(500, flows=16)
+
+	def tearDown(self): shutil.rmtree(self.path)
+
+	def test_open_segment(self):
+		arc = archive.Archive(self.path)
+		arc.open()
+		try:
+			arc.write([body(self.pkts[:50], 1000.0)])
+			arc.flush()
+			self.assertEqual(len(archive.read_index(arc.seg_path)), 1)
+			self.assertEqual(len(list(archive.query(self.path, since=999.0))), 50)
+			for n in xrange(1, 10): arc.write([body(self.pkts[n*50:(n+1)*50], 1000.0 + n)])
+			arc.dst.flush() # data on disk, but not indexed yet
+			self.assertEqual(len(list(archive.query(self.path))), 500)
+			self.assertEqual(len(list(archive.query(self.path, since=1009.0))), 50)
+		finally: arc.close()
+		self.assertEqual(len(list(archive.query(self.path, since=1005.0))), 250)
+
+	def test_no_index(self):
+		arc = archive.Archive(self.path)
+		arc.open()
+		for n in xrange(10): arc.write([body(self.pkts[n*50:(n+1)*50], 1000.0 + n)])
+		arc.close()
+		os.unlink(arc.seg_path + '.idx')
+		self.assertEqual(len(list(archive.query(self.path, since=1005.0, until=1006.0))), 100)
+
+
+if __name__ == '__main__': unittest.main()
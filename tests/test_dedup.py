@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nflog_zmq_pcap_pipe'))
+import pcap, synthetic, hdrcomp, dedup
+
+
+def body(pkts, ttl_dec=0):
+	'Returns batch of pcap records for packets, with IPv4 TTL decremented by ttl_dec.'
+	buff, pos = bytearray(), 0
+	for pkt in pkts:
+		pkt = bytearray(pkt)
+		pkt[8] -= ttl_dec
+		pos = pcap.construct_into(buff, pos, bytes(pkt), ts=1000.0)
+	return bytes(buff[:pos])
+
+
+class DedupTest(unittest.TestCase):
+
+	def test_header_compressed(self):
+		# Same packets captured at two hops by separate header-compressing senders,
+		#  decoded and filtered same as in nflog_pcap_recv.write()
+		pkts = synthetic.packets(256, flows=16)
+		comp1, comp2 = hdrcomp.HeaderCompressor(), hdrcomp.HeaderCompressor()
+		dec, filter_dups = hdrcomp.HeaderDecompressor(), dedup.Dedup(window=10.0)
+		res = list()
+		for frame in bytes(comp1.encode(body(pkts))), bytes(comp2.encode(body(pkts, 1))):
+			batch = dec.decode(memoryview(frame))
+			res.append(filter_dups.filter(batch, pcap.index(batch), ts=1000.0))
+		(body1, offsets1), (body2, offsets2) = res
+		self.assertEqual(body1, body(pkts))
+		self.assertEqual(len(offsets1), len(pkts))
+		self.assertEqual(len(offsets2), 0)
+		self.assertEqual(filter_dups.stats['dup_pkt'], len(pkts))
+
+	def test_buffer_types(self):
+		batch = body(synthetic.packets(64, flows=4))
+		for buff in batch, bytearray(batch), memoryview(batch):
+			filter_dups = dedup.Dedup(window=10.0)
+			self.assertEqual(filter_dups.filter(buff, pcap.index(buff), ts=1000.0)[0], batch)
+			self.assertEqual(len(filter_dups.filter(buff, pcap.index(buff), ts=1000.0)[1]), 0)
+
+
+if __name__ == '__main__': unittest.main()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os, sys, random, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nflog_zmq_pcap_pipe'))
+import pcap, synthetic, hdrcomp
+
+
+def bodies(seed, count=8, pkts_per_body=64):
+	'Returns list of pcap record batches with packets of same 16 flows, but different contents.'
+	pkts, res = synthetic.packets(count * pkts_per_body, flows=16, seed=0), list()
+	rng = random.Random(seed)
+	for n in xrange(count):
+		buff, pos = bytearray(), 0
+		for pkt in pkts[n * pkts_per_body:(n + 1) * pkts_per_body]:
+			pos = pcap.construct_into(buff, pos, pkt, ts=1000.0 + n + rng.random())
+		res.append(bytes(buff[:pos]))
+	return res
+
+
+class HeaderCompressionTest(unittest.TestCase):
+
+	def test_streams_interleaved(self):
+		# Same random module state, as in worker processes forked from the same parent
+		random.seed(0)
+		comp1 = hdrcomp.HeaderCompressor()
+		random.seed(0)
+		comp2 = hdrcomp.HeaderCompressor()
+		dec = hdrcomp.HeaderDecompressor()
+		for body1, body2 in zip(bodies(1), bodies(2)):
+			frame1, frame2 = bytes(comp1.encode(body1)), bytes(comp2.encode(body2))
+			self.assertNotEqual(hdrcomp.stream(frame1), hdrcomp.stream(frame2))
+			self.assertEqual(bytes(dec.decode(frame1)), body1)
+			self.assertEqual(bytes(dec.decode(frame2)), body2)
+		self.assertEqual(dec.stats['lost_pkt'], 0)
+		self.assertEqual(dec.stats['resyncs'], 0)
+
+	def test_streams_forked(self):
+		r, w = os.pipe()
+		pid = os.fork()
+		if not pid:
+			try: os.write(w, repr(hdrcomp.stream(hdrcomp.HeaderCompressor().encode(b''))))
+			finally: os._exit(0)
+		os.close(w)
+		with os.fdopen(r) as src: stream_child = src.read()
+		os.waitpid(pid, 0)
+		stream = hdrcomp.stream(hdrcomp.HeaderCompressor().encode(b''))
+		self.assertNotEqual(repr(stream), stream_child)
+
+
+if __name__ == '__main__': unittest.main()